@@ -24,7 +24,15 @@ except Exception:
 from qwen_llm import Qwen
 from langchain_core.prompts import PromptTemplate
 from langchain.chains import LLMChain
-from prompts import ANALYSIS_PROMPT
+from prompts import ANALYSIS_PROMPT, fit_analysis_inputs
+from log_writer import get_writer
+from tracing import span
+from rollup import build_rollup
+from csv_loader import load_csv
+from code_guard import CodeRejected, compile_checked
+from plot_guard import plot_guard
+from result_view import print_result
+from column_select import profile_columns, select_columns
 
 # ----------------------------
 # 配置区（请按需修改）
@@ -35,6 +43,7 @@ os.environ["OPENAI_API_KEY"] = "sk-c5f85b787a954210a04b8fe8f9481ee2"
 # 如使用 Qwen，请替换为 LangChain 支持的代理方式（见下方说明）
 
 DATA_FILE = "data.csv"
+EXECUTION_LOG = "execution_debug.log"
 
 
 
@@ -53,31 +62,36 @@ chain = LLMChain(llm=llm, prompt=prompt)
 # ----------------------------
 
 def load_data(filepath):
-    # 尝试多种常见编码以提高兼容性（例如 Windows 上的 GBK）
-    last_exc = None
-    for enc in ("utf-8", "utf-8-sig", "gbk", "latin1"):
+    # 编码（如 Windows 上的 GBK）、整行引号、千分位等问题由 csv_loader 采样识别并一次修复
+    with span("csv_load", source="file") as sp:
         try:
-            df = pd.read_csv(filepath, encoding=enc)
-            print(f"✅ 数据加载成功（encoding={enc}），共 {len(df)} 行，列名：{list(df.columns)}\n")
-            return df
+            df, plan = load_csv(filepath)
         except Exception as e:
-            last_exc = e
-
-    print(f"❌ 数据加载失败：{last_exc}")
-    exit()
-
-def get_analysis_code(question, columns, plot_file="output_plot.png"):
+            sp["status"] = "error"
+            print(f"❌ 数据加载失败：{e}")
+            exit()
+        sp.update(encoding=plan.encoding, repairs=plan.notes, rows=len(df), cols=df.shape[1])
+    print(f"✅ 数据加载成功（{plan.describe()}），共 {len(df)} 行，列名：{list(df.columns)}\n")
+    return df
+
+def get_analysis_code(question, columns, plot_file="output_plot.png", rollup=None, profile=None):
     from datetime import datetime
     current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    response = chain.invoke({
-        "question": question,
-        "columns": ", ".join(columns),
-        "plot_file": plot_file,
-        "current_time": current_time,
-    })
+    with span("get_analysis_code", n_columns=len(columns)) as sp:
+        # 宽表只把与问题相关的列（带类型）放进 prompt；匹配不可靠时仍给出全部列名（见 column_select.py）
+        if profile is not None:
+            selection = select_columns(question, profile)
+            columns_text = selection.prompt_text()
+            sp.update(prompt_columns=len(selection.columns), pruned=selection.pruned, confident=selection.confident)
+        else:
+            columns_text = ", ".join(columns)
+        hints = f"💡 {rollup.describe()}\n" if rollup is not None else ""
+        fitted = fit_analysis_inputs(columns_text, question, plot_file, current_time, hints)
+        sp.update(prompt_tokens=fitted.tokens)
+        response = chain.invoke(fitted.values)
     return response['text'].strip()
 
-def execute_code(code, df):
+def execute_code(code, df, rollup=None):
     result = None
     # 在执行用户/模型生成的代码前，对 DataFrame 做浅拷贝并清洗，
     # 避免 matplotlib 将超大整数或带引号的 id 字段误判为数值/日期，触发 C 扩展溢出。
@@ -92,23 +106,35 @@ def execute_code(code, df):
 
     # 安全执行环境
     safe_locals = {'df': safe_df, 'pd': pd, 'np': np, 'result': None}
+    if rollup is not None:
+        # 预聚合立方体（见 rollup.py），常见的分组求和/计数可直接从中读取
+        safe_locals['rollup'] = rollup
     plot_generated = False
 
+    # 执行前静态检查（import/属性白名单、列名存在性）并取缓存的 code 对象，
+    # 不合法的代码在这里立即失败，不会执行到一半才报错
     try:
-        exec(code, {}, safe_locals)
+        with span("code_check", code_chars=len(code)):
+            code_obj = compile_checked(code, safe_df.columns)
+    except CodeRejected as e:
+        get_writer(EXECUTION_LOG).log("CODE_REJECTED", errors=e.errors, code=code)
+        return f"⚠️ 代码未通过检查：{e}", False
+
+    try:
+        # 绘图保护：超大序列在 matplotlib 层自动降采样/聚合，渲染时间与数据量无关
+        with span("execute_code", rows=len(safe_df), code_chars=len(code)) as sp, plot_guard() as plot_report:
+            exec(code_obj, {}, safe_locals)
+            if plot_report.reductions:
+                sp["plot_reductions"] = [r.describe() for r in plot_report.reductions]
         result = safe_locals.get('result')
         if os.path.exists("output_plot.png"):
             plot_generated = True
     except Exception as e:
         import traceback
         tb = traceback.format_exc()
-        # 写入单独的执行错误日志，便于排查 C 扩展溢出类错误
-        try:
-            with open('execution_debug.log', 'a', encoding='utf-8') as lf:
-                lf.write(f"[{pd.Timestamp.utcnow().isoformat()}] EXECUTION_EXCEPTION: {str(e)}\n")
-                lf.write(tb + "\n")
-        except Exception:
-            pass
+        # 写入单独的执行错误日志（结构化记录，后台线程落盘），便于排查 C 扩展溢出类错误
+        get_writer(EXECUTION_LOG).log("EXECUTION_EXCEPTION", error=str(e), error_type=type(e).__name__,
+                                      traceback=tb, code=code)
         result = f"⚠️ 执行错误：{str(e)}\n详细堆栈已写入 execution_debug.log"
 
     return result, plot_generated
@@ -116,12 +142,8 @@ def execute_code(code, df):
 def display_result(result, has_plot=False):
     print("\n🔍 分析结果：")
     print("-" * 40)
-    if isinstance(result, pd.DataFrame):
-        print(result.to_string(index=False))
-    elif isinstance(result, (int, float)):
-        print(result)
-    else:
-        print(result)
+    # DataFrame 分页流式输出（有行数上限），不会对大结果整体 to_string
+    print_result(result)
     
     if has_plot:
         print("\n🖼️  已生成图表：output_plot.png")
@@ -137,6 +159,8 @@ def main():
     print("输入 'quit' 退出\n")
 
     df = load_data(DATA_FILE)
+    rollup = build_rollup(df)
+    profile = profile_columns(df)
 
     while True:
         query = input("\n❓ 请输入你的分析问题：").strip()
@@ -148,13 +172,14 @@ def main():
 
         # Step 1: 生成代码
         print("🧠 正在生成分析代码...")
-        code = get_analysis_code(query, df.columns.tolist(), plot_file="output_plot.png")
+        code = get_analysis_code(query, df.columns.tolist(), plot_file="output_plot.png", rollup=rollup,
+                                 profile=profile)
         print("💡 生成的代码：")
         print(code)
 
         # Step 2: 执行代码
         print("⚙️ 正在执行...")
-        result, has_plot = execute_code(code, df)
+        result, has_plot = execute_code(code, df, rollup=rollup)
 
         # Step 3: 展示结果
         display_result(result, has_plot)
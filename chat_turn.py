@@ -0,0 +1,508 @@
+# chat_turn.py
+"""对话一轮（turn）的核心逻辑，不依赖 Streamlit。
+
+streamlit_chat.py 与压测工具（loadtest.py）都调用这里的 run_turn，不各自维护一份流程：
+- 数据摘要、对话上下文、意图判断 prompt、SQL 生成 prompt 的组装（按 token 预算，见 prompt_budget.py）；
+- 是否需要生成 SQL 的判定（启发式 + 模型意图判断）与模型输出中 SQL 的提取；
+- 追问模式：对上一次查询结果的进一步汇总/筛选/作图，直接在会话缓存的完整结果（Arrow 列式表）上
+  生成并执行分析代码（execute_code），不再向数据库发起查询；结果超过 FOLLOWUP_MAX_MB 时不缓存用于追问；
+  结果被自动行数上限截断时不走启发式捷径，并在意图判断、分析 prompt 与结果说明中注明“非全量”；
+- run_turn()：无界面地完整跑一轮——判定（route_turn）、生成 SQL、校验、执行（失败时自动修复）、
+  追问分析或直接回复。Streamlit 中以 execute=False 调用，“执行”需要用户点击按钮，
+  按钮再调用 execute_sql()；run_turn(execute=True) 相当于用户立即确认执行。
+
+模型调用与 SQL 执行通过可替换的回调传入，Streamlit 中走作业调度（jobs.run_job），
+压测时可直接调用或提交到同一个调度器。
+"""
+
+import logging
+import os
+import re
+import tempfile
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Callable, List, Optional, Tuple
+
+import pandas as pd
+
+import local_sql
+from column_select import select_columns
+from db import GuardDecision, execute_guarded
+from jobs import JobCancelled
+from prompt_budget import DATA_SUMMARY, HISTORY, RESULT, SCHEMA, Section, fit
+from prompts import build_analysis_prompt
+from result_view import ResultPager
+from sql_guard import check_select
+from sql_repair import RepairOutcome, auto_repair
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_MAX_TOKENS = 800    # 数据摘要 / 上次结果摘要在 prompt 中的上限
+REQUEST_MAX_TOKENS = 2000   # 意图判断时用户请求的上限（粘贴了大段文本时）
+
+FOLLOWUP_MAX_MB = float(os.getenv("ANALYTIBOT_FOLLOWUP_MAX_MB", "256"))   # 可用于追问的结果大小上限
+
+ANALYSIS_KEYWORDS = ('分析', '描述', '统计', '汇总', '可视化', '画图', '总结', '解释', '洞察', '趋势', '分布', '关联')
+
+# 指代上一次结果的说法：出现时优先在缓存结果上分析，而不是重新查询
+# （“再”“继续”之类也常用于发起新的查询，不作为依据）
+FOLLOWUP_KEYWORDS = ('上面', '上述', '刚才', '刚刚', '这些', '这个结果', '该结果', '结果中', '结果里',
+                     '其中', '在此基础上')
+# 解释、原因类问题交给对话回复（模型能看到上次结果摘要），不走代码分析
+FOLLOWUP_EXCLUDE = ('解释', '为什么', '原因', '建议', '含义')
+FOLLOWUP = 'LAST_RESULT'   # 意图判断时表示“基于上次结果回答”的返回值
+
+# predict(prompt, label) -> 模型回复；label 用于作业名称与追踪
+Predict = Callable[[str, str], str]
+
+
+def build_dataset_summary(df: pd.DataFrame, max_chars=None, columns=None) -> str:
+    # columns 不为 None 时只摘要这些列（宽表按问题裁剪后的相关列），避免相关列被截断
+    note = ''
+    if columns is not None:
+        keep = set(columns)
+        note = f"（共 {df.shape[1]} 列，仅列出与问题相关的 {len(keep)} 列）"
+        df = df[[c for c in df.columns if str(c) in keep]]
+    cols = [str(c) for c in df.columns]
+    types = {str(c): str(df[c].dtype) for c in df.columns}
+    sample_lines = []
+    try:
+        sample = df.head(5).astype(str).to_dict(orient='records')
+        for r in sample:
+            sample_lines.append(' | '.join([f"{k}:{v}" for k, v in r.items()]))
+    except Exception:
+        sample_lines = []
+    summary = f"COLUMNS{note}: {', '.join(cols)}\nTYPES: {types}\nSAMPLE:\n" + '\n'.join(sample_lines)
+    # 长度通常交给 prompt 组装时按 token 预算裁剪；显式给出 max_chars 时仍按字符截断
+    if max_chars is not None and len(summary) > max_chars:
+        return summary[:max_chars] + '...'
+    return summary
+
+
+def summary_columns(user_input: str, df, profile) -> Optional[List[str]]:
+    """宽表只摘要与本次问题相关的列；匹配不可靠或列数不多时返回 None（保留全部列）。"""
+    if df is None or profile is None:
+        return None
+    selection = select_columns(user_input, profile)
+    return selection.names if selection.pruned else None
+
+
+def build_conversation(history: list, current_time: str, data_summary: str = '',
+                       last_sql: str = '', last_result: Optional[ResultPager] = None) -> str:
+    """对话回复 prompt：当前时间 + 对话历史 + 数据摘要 + 上次 SQL 结果摘要。
+
+    超预算时先裁剪较早的对话，再裁剪上次结果与数据摘要。
+    """
+    conv_lines = []
+    for m in history:
+        role = 'User' if m['role'] == 'user' else 'Assistant'
+        conv_lines.append(f"{role}: {m['content']}")
+    conv_sections = [
+        # 显式加入当前时间，确保模型能看到今天的日期
+        Section('time', f"当前时间：{current_time}\n"),
+        Section('history', "\n".join(conv_lines), HISTORY, keep='tail'),
+    ]
+    if data_summary:
+        conv_sections.append(Section('dataset', '\n\n--- DATASET SUMMARY ---\n' + data_summary,
+                                     DATA_SUMMARY, max_tokens=SUMMARY_MAX_TOKENS))
+    # 若之前执行过 SQL，把其结果摘要也加入对话上下文，便于模型在后续分析时参考
+    if last_result is not None:
+        try:
+            last_lines = ['\n\n--- LAST SQL RESULT ---']
+            if last_sql:
+                last_lines.append(f'LAST_SQL: {last_sql}')
+            last_lines.append(build_dataset_summary(last_result.head(5)))
+            conv_sections.append(Section('last_result', "\n".join(last_lines), RESULT,
+                                         max_tokens=SUMMARY_MAX_TOKENS))
+        except Exception:
+            # 若构建摘要失败则忽略，不阻塞主流程
+            pass
+    return fit(conv_sections, name='chat_reply').text
+
+
+def heuristic_needs_sql(text: str, table_candidates: Optional[list] = None) -> bool:
+    """用户是否明确要求写 SQL / 查询某张表。"""
+    if not text:
+        return False
+    t = text.lower()
+    # 明确的写 SQL 请求或常见关键词
+    if '帮我写' in t and ('sql' in t or '查询' in t):
+        return True
+    if re.search(r'写(一条|一个)?\s*(sql|查询)', t):
+        return True
+    # 如果直接包含表名提示（如查询 wx_tm_market_goods_data）
+    if re.search(r'查询\s+([\w\.]+)', t):
+        return True
+    # 若已知的表名出现在请求中，则也触发
+    if table_candidates:
+        for tbl in table_candidates:
+            if tbl and tbl.lower() in t:
+                return True
+    return False
+
+
+def decide_need_sql(user_input: str, table_candidates: Optional[list] = None, generate_sql: bool = False) -> bool:
+    """是否直接进入 SQL 生成：数据分析/描述类请求优先不生成 SQL（除非显式请求 SQL）。"""
+    explicit_sql_request = heuristic_needs_sql(user_input, table_candidates)
+    is_analysis_request = any(kw in (user_input or '') for kw in ANALYSIS_KEYWORDS)
+    if is_analysis_request and not explicit_sql_request:
+        return False
+    return bool(generate_sql) or explicit_sql_request
+
+
+def build_intent_prompt(user_input: str, current_time: str, last_columns: Optional[list] = None,
+                        last_truncated_at: int = 0) -> str:
+    # 更保守的意图检测：只有当用户明确要求查询数据库、写 SQL、或指定表名时才返回 SQL。
+    # 对于常见的数据分析请求（例如：描述数据、计算统计量、作图建议、解释模型结果等），请返回 NO_SQL。
+    intent_prompt = (
+        "当前时间：" + current_time + "\n"
+        "请判断下面的用户请求是否确实需要对数据库表执行查询并返回结果。"
+        " 仅在用户明确要求：\n  - 运行或构造 SQL 查询；\n  - 指定表名或列名需要从数据库检索；\n  - 或明确写出如 '请帮我写 SQL' / '查询 <table>' 等需求时，才返回一条合法的 SELECT SQL 语句。"
+    )
+    intent_prompt += "\n如果不需要查询数据库（例如用户要求对已加载的数据做统计分析、可视化、解读或建议），请只返回 NO_SQL。"
+    tail = "\n请仅返回一行：要么是一条 SQL（以 SELECT 开头，不要任何解释、标点或分号），要么返回 NO_SQL。"
+    sections = [Section('instruction', intent_prompt)]
+    if last_columns:
+        # 上一次查询的完整结果已缓存：对它的再汇总、筛选、排序、作图无需再查数据库
+        text = (f"\n上一次查询结果已缓存，列为：{', '.join(map(str, last_columns))}。"
+                f"若该请求是对这份结果的进一步汇总、筛选、排序、计算或作图，且这些列足以回答，请只返回 {FOLLOWUP}。")
+        if last_truncated_at:
+            text += (f"注意：该结果被自动限制为前 {last_truncated_at} 行，并不完整；"
+                     "需要全量求和、计数、排名等结果时请返回 SQL 重新查询。")
+        sections.append(Section('last_result', text, SCHEMA))
+        tail = f"\n请仅返回一行：一条 SQL（以 SELECT 开头，不要任何解释、标点或分号）、{FOLLOWUP} 或 NO_SQL。"
+    sections += [
+        Section('request', f"\n用户请求：{user_input}", HISTORY, max_tokens=REQUEST_MAX_TOKENS),
+        Section('tail', tail),
+    ]
+    return fit(sections, name='intent').text
+
+
+def parse_intent(response: str) -> str:
+    """意图判断的回复：首个非空行为 NO_SQL 时返回空串，为 LAST_RESULT 时返回 FOLLOWUP，否则视为 SQL 返回。"""
+    for ln in (response or '').splitlines():
+        s = ln.strip()
+        if not s:
+            continue
+        if s.upper() == 'NO_SQL':
+            return ''
+        if s.upper() == FOLLOWUP:
+            return FOLLOWUP
+        return s
+    return ''
+
+
+def first_line(text: str) -> str:
+    """清理模型输出，取首个非空行作为 SQL。"""
+    for ln in (text or '').splitlines():
+        s = ln.strip()
+        if s:
+            return s
+    return ''
+
+
+def build_sql_prompt(current_time: str, conversation: str, data_summary: str = '',
+                     local_describe: Optional[str] = None, schema_ctx: str = '') -> str:
+    """SQL 生成 prompt。local_describe 不为 None 时目标为上传数据（DuckDB 表 df），否则为数据库。"""
+    # 给模型明确的指令，要求仅返回 SQL 查询，不要多余文字
+    sql_prompt = (
+        "当前时间：" + current_time + "\n"
+        "请基于下面的对话，生成一个只包含单条 SELECT SQL 查询的语句，"
+        "仅使用目标表，并使用 CURRENT_DATE 替代当天日期相关条件。"
+    )
+    sql_prompt += (
+        "\n如果目标表的列名可能未知，请返回一条或多条安全的探测 SQL（每行一条、仅使用 SELECT），"
+        "用于定位列名或查看样例数据。例如：查询 `information_schema.columns` 获取列名，或使用 `SELECT * FROM <table> LIMIT 10` 查看样本。"
+        "不要包含分号或任何注释，也不要包含插入/更新/删除等写操作。"
+    )
+    schema_text = ''
+    if local_describe is not None:
+        sql_prompt += ("\n目标为已上传的数据，请使用 DuckDB 语法，只能查询表 df，"
+                       "列名包含中文或特殊字符时用双引号括起来。\n")
+        schema_text = f"{local_describe}\n"
+    elif schema_ctx:
+        # 只注入与问题相关的表结构，而不是全部表名或完全不给 schema
+        schema_text = f"\n与问题相关的表结构（按相关度检索，请优先使用这些表和列）：\n{schema_ctx}\n"
+    return fit([
+        Section('instruction', sql_prompt),
+        Section('schema', schema_text, SCHEMA),
+        Section('dataset', f"数据摘要：\n{data_summary}\n" if data_summary else '',
+                DATA_SUMMARY, max_tokens=SUMMARY_MAX_TOKENS),
+        Section('conversation', f"对话：\n{conversation}\n", HISTORY, keep='tail'),
+        Section('tail', "只返回 SQL，不要解释。"),
+    ], name='sql_generate').text
+
+
+def repair_schema_info(schema_ctx: str, allowed=None, df=None) -> str:
+    """自动修复时给模型的 schema 提示：检索到的相关表结构，否则列出可用表名。"""
+    if schema_ctx:
+        schema_info = f'相关表结构：\n{schema_ctx}\n'
+    elif allowed:
+        schema_info = '可用表：' + ', '.join(sorted(allowed)[:100]) + '\n'
+    else:
+        schema_info = ''
+    if df is not None:
+        cols = ', '.join(list(df.columns)[:30])
+        schema_info += f'当前上传数据列（示例）: {cols}\n'
+    return schema_info
+
+
+def followup_ready(last_result: Optional[ResultPager]) -> bool:
+    """上一次结果可用于追问：存在、非空且不超过 FOLLOWUP_MAX_MB。"""
+    return (last_result is not None and last_result.num_rows > 0
+            and last_result.nbytes <= FOLLOWUP_MAX_MB * 2**20)
+
+
+def is_followup(user_input: str, last_result: Optional[ResultPager], table_candidates: Optional[list] = None) -> bool:
+    """启发式追问判定（跳过模型的意图判断）：有可用且完整的上次结果、没有显式要求写 SQL，
+    问题指代上一次结果并提到了结果中的列（如“上面这些按城市汇总一下”）。其余情况交给模型判断。"""
+    if (not followup_ready(last_result) or last_result.truncated_at
+            or heuristic_needs_sql(user_input, table_candidates)):
+        return False
+    text = user_input or ''
+    if not any(kw in text for kw in FOLLOWUP_KEYWORDS) or any(kw in text for kw in FOLLOWUP_EXCLUDE):
+        return False
+    return any(len(str(c)) >= 2 and str(c) in text for c in last_result.columns)
+
+
+def build_followup_prompt(user_input: str, last_result: ResultPager, last_sql: str = '',
+                          plot_file: str = 'output_plot.png') -> str:
+    """追问的分析代码 prompt：df 即上一次查询的完整结果，列名带类型。"""
+    sample = last_result.head(5)
+    columns = ', '.join(f"{c}({sample[c].dtype})" for c in sample.columns)
+    if last_result.truncated_at:
+        hints = (f"💡 df 为上一次查询结果的前 {last_result.num_rows} 行（查询被自动限制为 {last_result.truncated_at} 行，"
+                 "不是完整结果；求和、计数等只代表这些行，请在结果中注明）")
+    else:
+        hints = f"💡 df 为上一次查询的完整结果（{last_result.num_rows} 行）"
+    if last_sql:
+        hints += f"，来自 SQL：{last_sql}"
+    return build_analysis_prompt(columns, user_input, plot_file, hints + "。\n")
+
+
+def _strip_code_fence(text: str) -> str:
+    lines = (text or '').strip().splitlines()
+    if lines and lines[0].startswith('```'):
+        lines = lines[1:]
+    if lines and lines[-1].strip() == '```':
+        lines = lines[:-1]
+    return '\n'.join(lines).strip()
+
+
+@dataclass
+class FollowupResult:
+    code: str = ''
+    result: Any = None              # 分析结果：DataFrame / 数值 / 字典 / 文本
+    plot: Optional[bytes] = None    # 生成的图表（PNG）
+    rows: int = 0                   # 分析所基于的缓存结果行数
+    truncated: bool = False         # 缓存结果被自动行数上限截断（分析不代表全量数据）
+    error: str = ''
+
+    def describe(self) -> str:
+        """写入对话历史的简短说明。"""
+        if self.error:
+            return f'[追问分析失败] {self.error}'
+        if isinstance(self.result, pd.DataFrame):
+            text = f'rows={len(self.result)}, cols={list(self.result.columns)}'
+        else:
+            text = str(self.result)[:300]
+        scope = f'上次结果的前 {self.rows} 行（被行数上限截断，非全量）' if self.truncated else f'上次结果（{self.rows} 行）'
+        return f'[基于{scope}分析，未重新查询] {text}' + ('（含图表）' if self.plot else '')
+
+
+def run_followup(user_input: str, last_result: ResultPager, predict: Predict, last_sql: str = '',
+                 run_code: Optional[Callable[[Callable], Any]] = None) -> FollowupResult:
+    """在缓存的上一次结果上生成并执行分析代码，不访问数据库。run_code(fn) 用于把执行提交到调度器。"""
+    # 延迟导入：analytibot 在导入时创建默认的模型客户端
+    from analytibot import execute_code
+    run_code = run_code or (lambda fn: fn())
+    out = FollowupResult(rows=last_result.num_rows, truncated=bool(last_result.truncated_at))
+    # 每次使用独立的图表文件，避免并发会话互相覆盖或误读旧图
+    plot_file = os.path.join(tempfile.gettempdir(), f'analytibot_followup_{uuid.uuid4().hex}.png').replace('\\', '/')
+    with span("followup_analysis", rows=out.rows) as sp:
+        out.code = _strip_code_fence(predict(build_followup_prompt(user_input, last_result, last_sql, plot_file),
+                                             '生成追问分析代码'))
+        if not out.code or out.code.startswith(('[失败]', '[错误]')):
+            out.error = out.code or '模型未生成分析代码'
+            sp["status"] = "no_code"
+            return out
+        try:
+            result, _ = run_code(lambda: execute_code(out.code, last_result.to_pandas()))
+        finally:
+            if os.path.exists(plot_file):
+                with open(plot_file, 'rb') as f:
+                    out.plot = f.read()
+                os.remove(plot_file)
+        if isinstance(result, str) and result.startswith('⚠️'):
+            out.error = result
+            sp["status"] = "failed"
+        out.result = result
+        sp["plot"] = out.plot is not None
+    return out
+
+
+def route_turn(user_input: str, last_result: Optional[ResultPager], predict: Predict, current_time: str,
+               table_candidates: Optional[list] = None) -> Tuple[bool, bool, str]:
+    """判定一轮对话的走向，返回 (need_sql, followup, 意图判断直接给出的 SQL)。
+
+    先走启发式（显式 SQL 请求、指代上次结果的追问），都不命中时再请模型判断；
+    上次结果不可用（不存在、过大）时模型返回 FOLLOWUP 也不走追问。
+    """
+    need_sql = decide_need_sql(user_input, table_candidates)
+    followup = not need_sql and is_followup(user_input, last_result, table_candidates)
+    intent_sql = ''
+    if not need_sql and not followup:
+        last_columns = last_result.columns if followup_ready(last_result) else None
+        truncated_at = last_result.truncated_at if last_columns is not None else 0
+        intent = parse_intent(predict(build_intent_prompt(user_input, current_time, last_columns, truncated_at),
+                                      '判断是否需要查询'))
+        followup = intent == FOLLOWUP and last_columns is not None
+        intent_sql = '' if intent == FOLLOWUP else intent
+        need_sql = bool(intent_sql)
+    return need_sql, followup, intent_sql
+
+
+@dataclass
+class ChatState:
+    """一个会话在多轮之间保留的状态（Streamlit 中对应 session_state 的同名键）。"""
+    history: list = field(default_factory=list)
+    df: Optional[pd.DataFrame] = None
+    column_profile: object = None
+    last_exec_sql: str = ''
+    last_exec_result: Optional[ResultPager] = None
+
+
+@dataclass
+class TurnResult:
+    need_sql: bool = False
+    generated_sql: str = ''
+    reply: str = ''
+    executed: bool = False
+    rows: int = 0
+    repaired: bool = False
+    error: str = ''
+    llm_calls: int = 0
+    followup: Optional[FollowupResult] = None
+    executed_sql: str = ''                  # 实际执行的 SQL（自动修复后为修正后的 SQL）
+    result: Optional[pd.DataFrame] = None   # 执行结果
+    decision: Optional[GuardDecision] = None   # 代价守卫的决定（EXPLAIN 估算、自动追加的 LIMIT）
+    repair: Optional[RepairOutcome] = None     # 执行失败后的自动修复结果
+
+
+def run_turn(state: ChatState, user_input: str, predict: Predict, engine=None, allowed_tables=None,
+             local: bool = False, schema_context: Optional[Callable[[str], str]] = None,
+             table_candidates: Optional[list] = None, llm=None, execute: bool = True,
+             run_sql: Optional[Callable[[Callable], object]] = None) -> TurnResult:
+    """无界面地跑完一轮对话（streamlit_chat.py 以 execute=False 调用，执行由按钮触发 execute_sql）。
+
+    engine / allowed_tables：SQL 执行目标与白名单（local=True 时为上传数据的 LocalEngine）；
+    schema_context(question) 返回检索到的表结构；llm 用于自动修复（需要 predict 接口）；
+    run_sql(fn) 用于把执行/修复提交到调度器，默认直接调用。
+    """
+    res = TurnResult()
+    run_sql = run_sql or (lambda fn: fn())
+
+    def _predict(prompt: str, label: str) -> str:
+        res.llm_calls += 1
+        return predict(prompt, label)
+
+    with span("chat_turn") as sp:
+        state.history.append({'role': 'user', 'content': user_input})
+        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        data_summary = ''
+        if state.df is not None:
+            data_summary = build_dataset_summary(
+                state.df, columns=summary_columns(user_input, state.df, state.column_profile))
+        conversation = build_conversation(state.history, current_time, data_summary,
+                                          state.last_exec_sql, state.last_exec_result)
+        res.need_sql, followup, res.generated_sql = route_turn(user_input, state.last_exec_result, _predict,
+                                                               current_time, table_candidates)
+        if followup:
+            # 追问：在缓存的上次结果上分析，不再查询数据库
+            res.followup = run_followup(user_input, state.last_exec_result, _predict, state.last_exec_sql,
+                                        run_code=run_sql)
+            res.error = res.followup.error
+            state.history.append({'role': 'assistant', 'content': res.followup.describe()})
+            sp.update(need_sql=False, followup=True, llm_calls=res.llm_calls)
+            return res
+        if not res.need_sql:
+            res.reply = _predict(conversation, '模型回复')
+            if res.reply:
+                state.history.append({'role': 'assistant', 'content': res.reply})
+            sp.update(need_sql=False, llm_calls=res.llm_calls)
+            return res
+
+        schema_ctx = schema_context(user_input) if (schema_context is not None and not local) else ''
+        local_describe = None
+        if local and state.df is not None:
+            local_describe = local_sql.describe_local_table(state.df)
+        generated = _predict(build_sql_prompt(current_time, conversation, data_summary, local_describe, schema_ctx),
+                             '生成 SQL')
+        res.generated_sql = first_line(generated)
+        sp.update(need_sql=True, llm_calls=res.llm_calls)
+        if not res.generated_sql:
+            res.error = f"[模型未生成 SQL] {generated}"
+            state.history.append({'role': 'assistant', 'content': res.error})
+            return res
+        state.history.append({'role': 'assistant', 'content': f'[生成的 SQL] {res.generated_sql}'})
+        analysis = check_select(res.generated_sql, allowed_tables)
+        if not analysis.ok:
+            res.error = '模型生成的 SQL 未通过安全校验：' + '；'.join(analysis.errors)
+            state.history.append({'role': 'assistant', 'content': f'[生成的 SQL 被拒绝] {res.generated_sql}'})
+            return res
+        if not execute or engine is None:
+            return res
+        execute_sql(state, res.generated_sql, engine, user_input, allowed_tables=allowed_tables, local=local,
+                    schema_context=schema_context, llm=llm, run_sql=run_sql, res=res)
+    return res
+
+
+def execute_sql(state: ChatState, sql: str, engine, user_input: str = '', allowed_tables=None, local: bool = False,
+                schema_context: Optional[Callable[[str], str]] = None, llm=None,
+                run_sql: Optional[Callable[[Callable], object]] = None,
+                res: Optional[TurnResult] = None) -> TurnResult:
+    """执行已通过校验的 SQL，失败时自动修复（llm 为 None 时不修复），成功后更新会话的上次结果。
+
+    run_turn(execute=True) 在生成 SQL 后直接调用；Streamlit 中由用户点击“执行”按钮后调用。
+    用户取消（JobCancelled）不进入自动修复，原样抛出。
+    """
+    res = res if res is not None else TurnResult(need_sql=True, generated_sql=sql)
+    run_sql = run_sql or (lambda fn: fn())
+    final_sql = sql
+    with span("chat_execute") as sp:
+        try:
+            df_res, res.decision = run_sql(lambda: execute_guarded(engine, final_sql))
+        except JobCancelled:
+            raise
+        except Exception as e:
+            err = str(e)
+            state.history.append({'role': 'assistant', 'content': f'[执行失败] {err}'})
+            if llm is None:
+                res.error = err
+                return res
+            # 自动修复：按问题 + 失败 SQL + 错误信息检索相关表结构
+            ctx = schema_context(f'{user_input} {final_sql} {err}') if (schema_context is not None and not local) else ''
+            schema_info = repair_schema_info(ctx, allowed_tables, state.df)
+            outcome = res.repair = run_sql(lambda: auto_repair(llm, engine, final_sql, err,
+                                                               allowed_tables=allowed_tables, schema_info=schema_info))
+            res.llm_calls += 1 if len(outcome.probes) == 0 else 2
+            if outcome.probes:
+                state.history.append({'role': 'assistant',
+                                      'content': f'[自动探测 SQL] {[p.sql for p in outcome.probes]}'})
+            if not outcome.ok:
+                res.error = outcome.error
+                state.history.append({'role': 'assistant', 'content': f'[修正失败] {outcome.error}'})
+                return res
+            df_res, final_sql, res.repaired = outcome.df, outcome.final_sql, True
+        res.executed = True
+        res.executed_sql = final_sql
+        res.result = df_res
+        res.rows = len(df_res)
+        state.last_exec_sql = final_sql
+        state.last_exec_result = ResultPager.from_df(df_res)
+        done = '[自动修复后 SQL 执行完成] ' + final_sql if res.repaired else '[SQL 执行完成]'
+        state.history.append({'role': 'assistant', 'content': f'{done} rows={res.rows}, cols={list(df_res.columns)}'})
+        sp.update(rows=res.rows, repaired=res.repaired)
+    return res
@@ -0,0 +1,210 @@
+# code_guard.py
+"""模型生成的分析代码在执行前的静态检查与编译缓存。
+
+- 只解析一次 AST：拒绝白名单以外的 import、危险内置函数、双下划线属性与
+  文件/进程类属性（remove 等通用方法名只在 os/shutil 等模块上拒绝）；对 `df['列']`、`df.groupby('列')` 等直接引用检查列名是否存在；
+- 通过检查后 compile()，按 (代码哈希, 列签名) 缓存 code 对象：同一段代码在
+  同一份数据上重跑时跳过解析与编译；不通过的结果同样缓存，再次提交立即失败。
+
+错误在执行前以 CodeRejected 抛出，不会出现执行到一半才失败的情况。
+"""
+
+import ast
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+ALLOWED_MODULES = frozenset({
+    "pandas", "numpy", "matplotlib", "seaborn", "scipy",
+    "math", "statistics", "datetime", "time", "calendar", "decimal",
+    "re", "json", "collections", "itertools", "functools",
+})
+FORBIDDEN_NAMES = frozenset({
+    "eval", "exec", "compile", "open", "__import__", "globals", "locals", "vars",
+    "getattr", "setattr", "delattr", "input", "breakpoint", "exit", "quit", "help",
+})
+# 任何对象上都不允许访问的属性：没有正常的分析用途，或是通往 os/sys 等模块的途径（如 pd.io.common.os）
+FORBIDDEN_ATTRS = frozenset({
+    "system", "popen", "rmtree", "chmod", "chown",
+    "read_pickle", "to_pickle", "read_sql", "read_sql_query", "read_sql_table", "to_sql",
+    "os", "sys", "shutil", "subprocess", "builtins", "importlib",
+})
+# 文件/进程操作模块，以及只在这些模块上才禁止的通用方法名（list.remove、df.rename 等照常可用）
+DANGEROUS_MODULES = frozenset({"os", "sys", "shutil", "subprocess", "pathlib", "io", "builtins", "importlib"})
+MODULE_ONLY_ATTRS = frozenset({
+    "remove", "unlink", "rmdir", "removedirs", "rename", "renames", "replace", "makedirs", "mkdir",
+    "kill", "exit", "open", "walk", "listdir", "scandir", "environ", "putenv",
+})
+# 这些方法的字符串参数（及 by= 等关键字）按列名处理
+COLUMN_METHODS = frozenset({"groupby", "sort_values", "pivot_table", "value_counts", "drop_duplicates", "set_index"})
+COLUMN_KEYWORDS = frozenset({"by", "index", "columns", "values", "subset", "keys"})
+# 会改变 df 列名的方法（与 df.columns = [...] 一样，之后的列集合无法静态确定）
+COLUMN_RESET_METHODS = frozenset({"rename", "assign", "set_axis"})
+
+CODE_CACHE_SIZE = 256
+
+
+class CodeRejected(ValueError):
+    """生成的代码未通过静态检查。"""
+
+    def __init__(self, errors: List[str]):
+        super().__init__("；".join(errors))
+        self.errors = errors
+
+
+@dataclass
+class CodeAnalysis:
+    code: str
+    errors: List[str] = field(default_factory=list)
+    tree: Optional[ast.AST] = None
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+
+def _string_args(node: ast.AST) -> List[str]:
+    """提取字面量字符串或字符串列表/元组。"""
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return [node.value]
+    if isinstance(node, (ast.List, ast.Tuple)):
+        out = []
+        for elt in node.elts:
+            if isinstance(elt, ast.Constant) and isinstance(elt.value, str):
+                out.append(elt.value)
+        return out
+    return []
+
+
+def _is_df(node: ast.AST) -> bool:
+    return isinstance(node, ast.Name) and node.id == "df"
+
+
+class _Checker(ast.NodeVisitor):
+    def __init__(self, columns: Optional[frozenset]):
+        self.errors: List[str] = []
+        self.columns = columns
+        self.column_refs: List[Tuple[str, int]] = []
+        self.created: set = set()
+        self.df_reassigned = False
+
+    def _err(self, node: ast.AST, msg: str) -> None:
+        self.errors.append(f"第 {getattr(node, 'lineno', '?')} 行：{msg}")
+
+    def visit_Import(self, node: ast.Import) -> None:
+        for alias in node.names:
+            if alias.name.split(".")[0] not in ALLOWED_MODULES:
+                self._err(node, f"不允许导入 {alias.name}")
+        self.generic_visit(node)
+
+    def visit_ImportFrom(self, node: ast.ImportFrom) -> None:
+        if node.level or (node.module or "").split(".")[0] not in ALLOWED_MODULES:
+            self._err(node, f"不允许导入 {node.module}")
+        self.generic_visit(node)
+
+    def visit_Name(self, node: ast.Name) -> None:
+        if node.id in FORBIDDEN_NAMES:
+            self._err(node, f"不允许使用 {node.id}")
+        if node.id == "df" and isinstance(node.ctx, ast.Store):
+            self.df_reassigned = True
+        self.generic_visit(node)
+
+    def visit_Attribute(self, node: ast.Attribute) -> None:
+        if node.attr.startswith("__") or node.attr in FORBIDDEN_ATTRS:
+            self._err(node, f"不允许访问属性 {node.attr}")
+        elif (node.attr in MODULE_ONLY_ATTRS and isinstance(node.value, ast.Name)
+              and node.value.id in DANGEROUS_MODULES):
+            self._err(node, f"不允许访问 {node.value.id}.{node.attr}")
+        if _is_df(node.value) and node.attr == "columns" and isinstance(node.ctx, ast.Store):
+            self.df_reassigned = True
+        self.generic_visit(node)
+
+    def visit_Subscript(self, node: ast.Subscript) -> None:
+        if _is_df(node.value):
+            names = _string_args(node.slice)
+            if isinstance(node.ctx, ast.Store):
+                self.created.update(names)
+            else:
+                self.column_refs.extend((n, node.lineno) for n in names)
+        self.generic_visit(node)
+
+    def visit_Call(self, node: ast.Call) -> None:
+        func = node.func
+        if isinstance(func, ast.Attribute) and _is_df(func.value) and func.attr in COLUMN_METHODS:
+            for arg in node.args[:1]:
+                self.column_refs.extend((n, node.lineno) for n in _string_args(arg))
+            for kw in node.keywords:
+                if kw.arg in COLUMN_KEYWORDS:
+                    self.column_refs.extend((n, node.lineno) for n in _string_args(kw.value))
+        if isinstance(func, ast.Attribute) and _is_df(func.value):
+            if func.attr in COLUMN_RESET_METHODS:
+                self.df_reassigned = True
+            elif func.attr == "insert" and len(node.args) >= 2:
+                self.created.update(_string_args(node.args[1]))
+        self.generic_visit(node)
+
+    def finish(self) -> None:
+        # df 被重新赋值（如 df = df.assign(...)）或列名被改写（df.columns = [...]、rename）后
+        # 列集合无法静态确定，跳过列名检查
+        if self.columns is None or self.df_reassigned:
+            return
+        missing = []
+        for name, line in self.column_refs:
+            if name not in self.columns and name not in self.created and name not in missing:
+                missing.append(name)
+                self.errors.append(f"第 {line} 行：列 {name!r} 不存在于数据中")
+
+
+def analyze_code(code: str, columns: Optional[Iterable] = None) -> CodeAnalysis:
+    """解析并静态检查代码；columns 为 None 时不检查列名。"""
+    analysis = CodeAnalysis(code=code)
+    try:
+        analysis.tree = ast.parse(code, mode="exec")
+    except SyntaxError as e:
+        analysis.errors.append(f"语法错误（第 {e.lineno} 行）：{e.msg}")
+        return analysis
+    checker = _Checker(frozenset(str(c) for c in columns) if columns is not None else None)
+    checker.visit(analysis.tree)
+    checker.finish()
+    analysis.errors = checker.errors
+    return analysis
+
+
+def _cache_key(code: str, columns: Optional[Iterable]) -> Tuple[str, str]:
+    code_hash = hashlib.sha256(code.encode("utf-8")).hexdigest()
+    sig = "" if columns is None else "\x1f".join(str(c) for c in columns)
+    return code_hash, hashlib.sha256(sig.encode("utf-8")).hexdigest()
+
+
+_CACHE: "OrderedDict[Tuple[str, str], Tuple[Optional[object], List[str]]]" = OrderedDict()
+_CACHE_LOCK = threading.Lock()
+
+
+def compile_checked(code: str, columns: Optional[Iterable] = None, filename: str = "<analysis>"):
+    """返回可直接传给 exec 的 code 对象；未通过检查时抛出 CodeRejected。
+
+    结果（包括失败结果）按 (代码哈希, 列签名) 做 LRU 缓存。
+    """
+    columns = list(columns) if columns is not None else None
+    key = _cache_key(code, columns)
+    with _CACHE_LOCK:
+        hit = _CACHE.get(key)
+        if hit is not None:
+            _CACHE.move_to_end(key)
+    if hit is None:
+        analysis = analyze_code(code, columns)
+        code_obj = compile(analysis.tree, filename, "exec") if analysis.ok else None
+        hit = (code_obj, analysis.errors)
+        with _CACHE_LOCK:
+            _CACHE[key] = hit
+            while len(_CACHE) > CODE_CACHE_SIZE:
+                _CACHE.popitem(last=False)
+    code_obj, errors = hit
+    if code_obj is None:
+        raise CodeRejected(errors)
+    return code_obj
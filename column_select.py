@@ -0,0 +1,182 @@
+# column_select.py
+"""按问题挑选相关列，缩小宽表（数百列）上的分析 prompt。
+
+加载数据时对每列做一次画像（类型 + 文本列的高频取值，较大的数据只抽样），
+之后每个问题只做纯内存打分：
+- 列名整体出现在问题中；
+- 列名拆词（中文 bigram、下划线/驼峰拆分，见 schema_index.tokenize）与问题重合，
+  出现在大量列名中的词（如 metric_1..metric_300 中的 metric）不参与打分；
+- 问题中出现了该列的某个高频取值（如“北京” -> city 列）；
+- 问题涉及时间（趋势、每月……）时加入日期列。
+
+列数不多时不裁剪。只有取值/时间命中而没有任何列名命中（例如英文列名配中文问题，
+度量列无从匹配），或列名得分低于 MIN_CONFIDENCE 时，视为不可靠，退回完整列名列表，
+避免把真正需要的列裁掉。
+"""
+
+import logging
+import os
+import re
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, List
+
+import pandas as pd
+
+from schema_index import tokenize
+
+logger = logging.getLogger(__name__)
+
+PRUNE_MIN_COLUMNS = int(os.getenv("ANALYTIBOT_PRUNE_MIN_COLUMNS", "40"))   # 列数不超过该值时不裁剪
+PRUNE_MAX_COLUMNS = int(os.getenv("ANALYTIBOT_PRUNE_MAX_COLUMNS", "30"))   # 裁剪后最多保留的列数
+PROFILE_SAMPLE_ROWS = 100_000
+TOP_VALUES = 20
+MAX_VALUE_CHARS = 40
+MIN_CONFIDENCE = 3.0
+COMMON_TERM_RATIO = 0.1   # 出现在超过该比例列名中的词不具区分度
+
+# 得分权重
+NAME_IN_QUESTION = 10.0
+TERM_MATCH = 3.0
+VALUE_MATCH = 5.0
+TIME_MATCH = 2.0
+
+TIME_WORDS = ("趋势", "每天", "每日", "按天", "每周", "按周", "每月", "按月", "月度", "年度", "季度",
+              "日期", "时间", "同比", "环比", "最近", "上个月", "本月", "今年", "去年", "trend", "daily", "monthly")
+
+
+@dataclass
+class ColumnProfile:
+    name: str
+    dtype: str
+    kind: str                      # text / number / datetime / bool
+    top_values: List[str] = field(default_factory=list)
+    terms: FrozenSet[str] = frozenset()
+
+
+@dataclass
+class DatasetProfile:
+    columns: List[ColumnProfile]
+    rows: int
+    common_terms: FrozenSet[str] = frozenset()
+
+    @property
+    def names(self) -> List[str]:
+        return [c.name for c in self.columns]
+
+
+def _kind(s: pd.Series) -> str:
+    k = s.dtype.kind
+    if k == "b":
+        return "bool"
+    if k in ("i", "u", "f", "c"):
+        return "number"
+    if k == "M":
+        return "datetime"
+    return "text"
+
+
+def profile_columns(df: pd.DataFrame, sample_rows: int = PROFILE_SAMPLE_ROWS, top_n: int = TOP_VALUES) -> DatasetProfile:
+    """每列的类型与高频取值（文本列），加载数据时计算一次。"""
+    sample = df if len(df) <= sample_rows else df.sample(sample_rows, random_state=0)
+    cols = []
+    for col in df.columns:
+        s = sample[col]
+        kind = _kind(s)
+        top: List[str] = []
+        if kind == "text":
+            try:
+                values = s.dropna().astype(str).value_counts().head(top_n).index
+                top = [v for v in values if 0 < len(v) <= MAX_VALUE_CHARS]
+            except Exception:
+                top = []
+        cols.append(ColumnProfile(name=str(col), dtype=str(s.dtype), kind=kind, top_values=top,
+                                  terms=frozenset(tokenize(str(col)))))
+    term_df = Counter(t for c in cols for t in c.terms)
+    limit = max(2, int(len(cols) * COMMON_TERM_RATIO))
+    return DatasetProfile(columns=cols, rows=len(df),
+                          common_terms=frozenset(t for t, n in term_df.items() if n > limit))
+
+
+def _mentions(q_lower: str, name: str) -> bool:
+    """列名是否整体出现在问题中；英文/数字列名要求词边界（metric_1 不匹配 metric_12）。"""
+    if len(name) < 2:
+        return False
+    if name.isascii():
+        return re.search(r"(?<![a-z0-9_])" + re.escape(name) + r"(?![a-z0-9_])", q_lower) is not None
+    # 中文列名以数字结尾时（备注1）同样不能匹配更长的编号（备注13）
+    return re.search(re.escape(name) + (r"(?!\d)" if name[-1].isdigit() else ""), q_lower) is not None
+
+
+@dataclass
+class ColumnSelection:
+    columns: List[ColumnProfile]
+    total: int
+    confident: bool
+    reasons: Dict[str, str] = field(default_factory=dict)
+
+    @property
+    def pruned(self) -> bool:
+        return len(self.columns) < self.total
+
+    @property
+    def names(self) -> List[str]:
+        return [c.name for c in self.columns]
+
+    def prompt_text(self) -> str:
+        """给分析 prompt 的列说明：裁剪后带类型，未裁剪时与原来一样只列列名。"""
+        if not self.pruned:
+            return ", ".join(self.names)
+        cols = ", ".join(f"{c.name}({c.dtype})" for c in self.columns)
+        return f"{cols}\n（数据共 {self.total} 列，以上为与问题相关的 {len(self.columns)} 列）"
+
+
+def _score(question: str, q_lower: str, q_terms: set, col: ColumnProfile, wants_time: bool):
+    """返回 (总分, 其中列名部分的得分, 命中原因)。"""
+    score = 0.0
+    why = []
+    if _mentions(q_lower, col.name.lower()):
+        score += NAME_IN_QUESTION
+        why.append("列名")
+    overlap = col.terms & q_terms
+    if overlap:
+        score += TERM_MATCH * len(overlap)
+        why.append("词:" + "/".join(sorted(overlap)))
+    name_score = score
+    for v in col.top_values:
+        if len(v) >= 2 and v in question:
+            score += VALUE_MATCH
+            why.append(f"取值:{v}")
+            break
+    if wants_time and col.kind == "datetime":
+        score += TIME_MATCH
+        why.append("时间")
+    return score, name_score, why
+
+
+def select_columns(question: str, profile: DatasetProfile, max_columns: int = PRUNE_MAX_COLUMNS,
+                   min_columns: int = PRUNE_MIN_COLUMNS, min_confidence: float = MIN_CONFIDENCE) -> ColumnSelection:
+    """返回与问题相关的列（保持原列顺序）；列数较少或匹配不可靠时返回全部列。"""
+    full = ColumnSelection(columns=list(profile.columns), total=len(profile.columns), confident=True)
+    if len(profile.columns) <= min_columns or not question:
+        return full
+    q_lower = question.lower()
+    q_terms = set(tokenize(question)) - profile.common_terms
+    wants_time = any(w in q_lower for w in TIME_WORDS)
+    scored = []
+    best_name = 0.0
+    reasons: Dict[str, str] = {}
+    for idx, col in enumerate(profile.columns):
+        score, name_score, why = _score(question, q_lower, q_terms, col, wants_time)
+        best_name = max(best_name, name_score)
+        if score > 0:
+            scored.append((score, idx))
+            reasons[col.name] = "，".join(why)
+    if best_name < min_confidence:
+        full.confident = False
+        return full
+    keep = sorted(idx for _, idx in sorted(scored, key=lambda t: (-t[0], t[1]))[:max_columns])
+    chosen = [profile.columns[i] for i in keep]
+    return ColumnSelection(columns=chosen, total=len(profile.columns), confident=True,
+                           reasons={c.name: reasons[c.name] for c in chosen})
+
@@ -12,3 +12,11 @@ DEFAULT_DB_CONFIG = {
 
 # 可选：把你的 DashScope/Bailian API Key 放在这里以便本地使用（仅在本地环境下使用，不要提交真实密钥）
 # DASHSCOPE_API_KEY = "sk-..."
+
+# 可选：执行模型生成 SQL 前的代价守卫阈值（未配置时使用 db.py 中的默认值）
+# QUERY_GUARD_CONFIG = {
+#     "max_rows_examined": 5_000_000,   # EXPLAIN 估算扫描行数上限
+#     "max_full_scan_rows": 1_000_000,  # 存在全表扫描时的扫描行数上限
+#     "row_cap": 10_000,                # 未带 LIMIT 时自动追加的行数上限
+#     "max_execution_ms": 30_000,       # MAX_EXECUTION_TIME（毫秒）
+# }
@@ -0,0 +1,235 @@
+# csv_loader.py
+"""统一的 CSV 加载：先采样识别常见的导出问题，再一次带类型的解析。
+
+常见的“坏”导出：
+- 整行被引号包住（"2024-01-01,北京,手机,50000,120"），pandas 只能读出一列；
+- GBK 编码，或 GBK 被按 latin1 误解码后又存成 UTF-8 的乱码（mojibake）；
+- 数值带千分位（"1,234"），被读成字符串。
+
+load_csv() 只读取开头一段样本做判断，然后在原始字节上按块做流式预处理
+（bytes.replace / decode，均为 C 实现），直接喂给 pd.read_csv 一次解析，
+不需要先读成单列再 str.split，也不会丢失列类型。
+"""
+
+import io
+import logging
+import re
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple, Union
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_BYTES = 64 * 1024       # 采样大小
+CHUNK_BYTES = 1024 * 1024      # 流式预处理的块大小
+FALLBACK_ENCODINGS = ("utf-8", "gbk", "latin1")
+
+_THOUSANDS = re.compile(r"^[+-]?\d{1,3}(,\d{3})+(\.\d+)?$")
+_CJK = re.compile(r"[一-鿿]")
+
+
+@dataclass
+class CsvRepairPlan:
+    """采样得到的修复方案。"""
+    encoding: str = "utf-8"
+    outer_quoted: bool = False     # 整行被一对引号包住
+    unescape_quotes: bool = False  # 去掉外层引号后，内部 "" 还原为 "
+    mojibake: bool = False         # UTF-8 文本实为 GBK 字节按 latin1 解码的结果
+    thousands: Optional[str] = None
+    notes: List[str] = field(default_factory=list)
+
+    @property
+    def needs_prepass(self) -> bool:
+        return self.outer_quoted or self.mojibake
+
+    def describe(self) -> str:
+        return "；".join(self.notes) if self.notes else "无需修复"
+
+
+def _complete_lines(sample: bytes, at_eof: bool) -> bytes:
+    """截掉样本末尾不完整的一行（避免切断多字节字符）。"""
+    if at_eof:
+        return sample
+    cut = sample.rfind(b"\n")
+    return sample[:cut + 1] if cut >= 0 else sample
+
+
+def _detect_encoding(sample: bytes) -> Tuple[str, str]:
+    """返回 (pd.read_csv 使用的 encoding, 样本解码后的文本)。"""
+    if sample.startswith(b"\xef\xbb\xbf"):
+        return "utf-8-sig", sample.decode("utf-8-sig", errors="replace")
+    for enc in ("utf-8", "gbk"):
+        try:
+            return enc, sample.decode(enc)
+        except UnicodeDecodeError:
+            continue
+    return "latin1", sample.decode("latin1")
+
+
+def _looks_like_mojibake(text: str) -> bool:
+    """全是 latin1 范围字符、无中文，但按 latin1 编码回去能以 GBK 解出中文。"""
+    if _CJK.search(text) or not any(0x80 <= ord(c) <= 0xFF for c in text):
+        return False
+    try:
+        fixed = text.encode("latin1").decode("gbk")
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return False
+    return bool(_CJK.search(fixed))
+
+
+def sniff(sample: bytes, at_eof: bool = False) -> CsvRepairPlan:
+    """根据文件开头的样本判断编码与需要的修复。"""
+    plan = CsvRepairPlan()
+    sample = _complete_lines(sample, at_eof)
+    plan.encoding, text = _detect_encoding(sample)
+    if plan.encoding == "gbk":
+        plan.notes.append("GBK 编码")
+
+    if plan.encoding.startswith("utf-8") and _looks_like_mojibake(text):
+        plan.mojibake = True
+        plan.encoding = "gbk"
+        text = text.encode("latin1").decode("gbk")
+        plan.notes.append("修复 GBK 乱码")
+
+    lines = [ln for ln in text.splitlines() if ln.strip()]
+    if lines and all(_is_outer_quoted(ln) for ln in lines):
+        plan.outer_quoted = True
+        plan.unescape_quotes = any('""' in ln[1:-1] for ln in lines)
+        plan.notes.append("去除整行外层引号")
+        lines = [ln[1:-1] for ln in lines]
+        if plan.unescape_quotes:
+            lines = [ln.replace('""', '"') for ln in lines]
+
+    if lines and _has_thousands(lines):
+        plan.thousands = ","
+        plan.notes.append("识别千分位数字")
+    return plan
+
+
+def _is_outer_quoted(line: str) -> bool:
+    # 不容忍首尾空白：流式预处理只按 `"\n"` 边界替换
+    if len(line) < 2 or line[0] != '"' or line[-1] != '"':
+        return False
+    inner = line[1:-1]
+    # 内部只能有成对转义的引号，且至少包含一个分隔符（否则只是单列的普通引用字段）
+    return "," in inner and '"' not in inner.replace('""', "")
+
+
+def _has_thousands(lines: List[str]) -> bool:
+    try:
+        sample_df = pd.read_csv(io.StringIO("\n".join(lines)), dtype=str, keep_default_na=False)
+    except Exception:
+        return False
+    for col in sample_df.columns:
+        vals = [v for v in sample_df[col] if v]
+        if vals and all(_THOUSANDS.match(v) or v.replace(".", "", 1).lstrip("+-").isdigit() for v in vals) \
+                and any(_THOUSANDS.match(v) for v in vals):
+            return True
+    return False
+
+
+def _strip_outer_quotes(data: bytes) -> bytes:
+    """去掉块内每行首尾的引号。块总是从行首开始，因此行间的 `"\n"` 可整体替换。"""
+    lead = data.startswith(b'"')
+    data = data.replace(b'"\r\n"', b"\r\n").replace(b'"\n"', b"\n")
+    if lead:
+        data = data[1:]
+    for end in (b'"\r\n', b'"\n', b'"'):
+        if data.endswith(end):
+            return data[:-len(end)] + end[1:]
+    return data
+
+
+class _RepairingReader(io.RawIOBase):
+    """按块读取原始字节，在整行边界上应用修复后再交给解析器。"""
+
+    def __init__(self, raw, plan: CsvRepairPlan, chunk_size: int = CHUNK_BYTES):
+        self._raw = raw
+        self._plan = plan
+        self._chunk_size = chunk_size
+        self._carry = b""
+        self._out = b""
+        self._eof = False
+
+    def readable(self) -> bool:
+        return True
+
+    def _transform(self, data: bytes) -> bytes:
+        if self._plan.mojibake:
+            data = data.decode("utf-8", errors="replace").encode("latin1", errors="replace")
+        if self._plan.outer_quoted:
+            data = _strip_outer_quotes(data)
+            if self._plan.unescape_quotes:
+                data = data.replace(b'""', b'"')
+        return data
+
+    def _fill(self) -> None:
+        while not self._out and not self._eof:
+            chunk = self._raw.read(self._chunk_size)
+            if not chunk:
+                self._eof = True
+                self._out, self._carry = self._transform(self._carry), b""
+                return
+            data = self._carry + chunk
+            cut = data.rfind(b"\n")
+            if cut < 0:
+                self._carry = data
+                continue
+            self._carry = data[cut + 1:]
+            self._out = self._transform(data[:cut + 1])
+
+    def readinto(self, buf) -> int:
+        self._fill()
+        n = min(len(buf), len(self._out))
+        buf[:n] = self._out[:n]
+        self._out = self._out[n:]
+        return n
+
+
+def _open(source) -> io.BufferedIOBase:
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return io.BytesIO(bytes(source))
+    if hasattr(source, "read"):
+        return source
+    return open(source, "rb")
+
+
+def load_csv(source: Union[str, bytes, io.IOBase], **read_csv_kwargs) -> Tuple[pd.DataFrame, CsvRepairPlan]:
+    """加载 CSV（路径、bytes 或二进制文件对象），返回 (DataFrame, 修复方案)。
+
+    采样判断失误（例如样本之后才出现非 UTF-8 字节）时按 FALLBACK_ENCODINGS 重试。
+    """
+    fh = _open(source)
+    owns = fh is not source
+    try:
+        start = fh.tell() if fh.seekable() else 0
+        sample = fh.read(SAMPLE_BYTES)
+        at_eof = len(sample) < SAMPLE_BYTES
+        plan = sniff(sample, at_eof=at_eof)
+
+        encodings = [plan.encoding] + [e for e in FALLBACK_ENCODINGS if e != plan.encoding]
+        last_exc: Optional[Exception] = None
+        for enc in encodings:
+            if plan.mojibake and enc != "gbk":
+                # 乱码修复假定内容为 GBK；退回时放弃修复，按普通文件读取
+                plan.mojibake = False
+            fh.seek(start)
+            stream = io.BufferedReader(_RepairingReader(fh, plan)) if plan.needs_prepass else fh
+            kwargs = dict(read_csv_kwargs)
+            if plan.thousands:
+                kwargs.setdefault("thousands", plan.thousands)
+            try:
+                df = pd.read_csv(stream, encoding=enc, **kwargs)
+            except UnicodeDecodeError as e:
+                last_exc = e
+                logger.info("按 %s 解析失败，尝试下一个编码：%s", enc, e)
+                continue
+            if enc != plan.encoding:
+                plan.notes.append(f"回退编码 {enc}")
+                plan.encoding = enc
+            return df, plan
+        raise last_exc  # type: ignore[misc]
+    finally:
+        if owns:
+            fh.close()
@@ -0,0 +1,345 @@
+# datastore.py
+"""跨会话共享、按内容去重、总内存有上限的数据集存储。
+
+每个 Streamlit 会话原本在 session_state 中各自持有一份完整 DataFrame：十个人上传同一个
+1 GB 导出文件就是十份副本，空闲会话的数据也永远不释放。这里改为进程内共享存储：
+
+- 数据集按内容哈希（上传文件）或来源版本（快照名 + 版本号）作为 key，相同内容只解析、保存一份；
+  派生结果（预聚合 rollup、列画像）同样按数据集只计算一次；
+- 会话只在 session_state 中保存 key，每次重跑通过 get() 取得共享的 DataFrame。
+  该对象由各会话共享：需要修改时先 copy()（分析代码执行前本来就会复制）；
+  Arrow 来源（Parquet/Feather 上传、快照、落盘读回）零拷贝得到的只读列会复制为普通数组，
+  无论数据集来自哪里、是否落过盘，get() 返回的对象行为一致；
+- 每个数据集记录引用它的会话及其最近访问时间，超过 SESSION_IDLE_S 未访问的会话自动解除引用；
+- 内存中的数据集总大小超过 DATASET_MEMORY_MB 时，按 LRU 把数据集落盘为 Arrow IPC 文件
+  （优先无人引用的数据集），再次访问时内存映射读回；无人引用且超过 SESSION_IDLE_S 的数据集连同文件一起删除。
+
+render_memory_page() 展示各数据集与各会话的内存占用（pages/ 下的“数据内存”页面）。
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from tracing import span
+
+try:
+    import pyarrow as pa  # type: ignore
+except Exception:  # 可选依赖：未安装时不落盘，只按引用计数释放
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+DATASET_MEMORY_MB = float(os.getenv("ANALYTIBOT_DATASET_MEMORY_MB", "4096"))
+DATASET_SPILL_DIR = os.getenv("ANALYTIBOT_DATASET_SPILL_DIR", "dataset_spill")
+SESSION_IDLE_S = float(os.getenv("ANALYTIBOT_SESSION_IDLE_S", "1800"))
+
+Loader = Callable[[], Tuple[pd.DataFrame, Any]]
+
+
+def _writable(df: pd.DataFrame) -> pd.DataFrame:
+    """把 Arrow 零拷贝转换得到的只读列复制为可写数组（其余列不复制）。"""
+    for i in range(df.shape[1]):
+        values = df.iloc[:, i].to_numpy()
+        if not values.flags.writeable:
+            df.isetitem(i, df.iloc[:, i].copy())
+    return df
+
+
+def content_key(content: bytes) -> str:
+    return "sha256:" + hashlib.sha256(content).hexdigest()
+
+
+def _df_bytes(df: pd.DataFrame) -> int:
+    # deep=True 会遍历字符串列；每个数据集只在加入存储时计算一次
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+@dataclass
+class _Entry:
+    key: str
+    label: str
+    df: Optional[pd.DataFrame]
+    nbytes: int
+    rows: int
+    meta: Any = None
+    spill_path: Optional[str] = None
+    spillable: bool = True
+    refs: Dict[str, float] = field(default_factory=dict)   # 会话 -> 最近访问时间
+    derived: Dict[str, Any] = field(default_factory=dict)
+    released_at: float = field(default_factory=time.time)
+    loads: int = 0
+
+    @property
+    def in_memory(self) -> bool:
+        return self.df is not None
+
+
+@dataclass
+class DatasetInfo:
+    key: str
+    label: str
+    rows: int
+    nbytes: int
+    in_memory: bool
+    spilled: bool
+    sessions: List[str]
+
+
+class DatasetStore:
+    def __init__(self, memory_mb: float = DATASET_MEMORY_MB, spill_dir: str = DATASET_SPILL_DIR,
+                 idle_s: float = SESSION_IDLE_S):
+        self.budget = int(memory_mb * 1024 * 1024)
+        self.spill_dir = spill_dir
+        self.idle_s = idle_s
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()   # LRU：最近使用的在末尾
+        self._sessions: Dict[str, str] = {}                          # 会话 -> 当前数据集 key
+        self._session_local: Dict[str, int] = {}                     # 会话自行上报的私有内存（如执行结果）
+        self._lock = threading.RLock()
+        self._key_locks: Dict[str, threading.Lock] = {}
+
+    # ---- 加入与引用 ----
+
+    def put(self, session: str, key: str, loader: Loader, label: str = "") -> Tuple[str, Any, bool]:
+        """把 key 对应的数据集设为该会话的当前数据集；不存在时调用 loader() -> (df, meta) 加载。
+
+        返回 (key, meta, 是否复用了已有数据集)。同一 key 并发加载时只有一个会话真正调用 loader。
+        """
+        with self._key_lock(key):
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._attach(session, entry)
+                    return key, entry.meta, True
+            with span("dataset_load", label=label) as sp:
+                df, meta = loader()
+                df = _writable(df)
+                entry = _Entry(key=key, label=label, df=df, nbytes=_df_bytes(df), rows=len(df), meta=meta)
+                sp.update(rows=entry.rows, bytes=entry.nbytes)
+            with self._lock:
+                self._entries[key] = entry
+                self._attach(session, entry)
+                self._enforce(keep=key)
+        return key, meta, False
+
+    def _key_lock(self, key: str) -> threading.Lock:
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def put_bytes(self, session: str, content: bytes, parse: Callable[[bytes], Tuple[pd.DataFrame, Any]],
+                  label: str = "") -> Tuple[str, Any, bool]:
+        """上传文件：按内容哈希去重，已有相同内容时不再解析。"""
+        return self.put(session, content_key(content), lambda: parse(content), label)
+
+    def _attach(self, session: str, entry: _Entry) -> None:
+        """调用方持有锁。会话切换数据集时解除对旧数据集的引用。"""
+        old = self._sessions.get(session)
+        if old is not None and old != entry.key:
+            self._detach(session, old)
+        self._sessions[session] = entry.key
+        entry.refs[session] = time.time()
+        self._entries.move_to_end(entry.key)
+
+    def _detach(self, session: str, key: str) -> None:
+        entry = self._entries.get(key)
+        if entry is not None and entry.refs.pop(session, None) is not None and not entry.refs:
+            entry.released_at = time.time()
+
+    def release(self, session: str) -> None:
+        """会话不再使用任何数据集（清空数据）。"""
+        with self._lock:
+            key = self._sessions.pop(session, None)
+            self._session_local.pop(session, None)
+            if key is not None:
+                self._detach(session, key)
+            self._sweep()
+
+    # ---- 读取 ----
+
+    def get(self, key: str, session: Optional[str] = None) -> Optional[pd.DataFrame]:
+        """取得共享的只读 DataFrame（已落盘时读回内存）；数据集已被删除时返回 None。"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if session is not None:
+                if self._sessions.get(session) != key:
+                    self._attach(session, entry)
+                else:
+                    entry.refs[session] = time.time()
+            self._entries.move_to_end(key)
+            if entry.in_memory:
+                return entry.df
+        # 读回放在全局锁外，其他会话不被阻塞；同一数据集的并发读回由 key 锁串行化
+        with self._key_lock(key):
+            with self._lock:
+                if entry.in_memory:
+                    return entry.df
+            with span("dataset_unspill", label=entry.label, bytes=entry.nbytes):
+                table = pa.ipc.open_file(pa.memory_map(entry.spill_path, "r")).read_all()
+                # 内存映射上的零拷贝列是只读的，复制后与首次加载的对象行为一致，也不再占用映射
+                df = _writable(table.to_pandas(split_blocks=True))
+                del table
+            with self._lock:
+                entry.df = df
+                entry.loads += 1
+                self._enforce(keep=key)
+            return df
+
+    def derived(self, key: str, name: str, build: Callable[[pd.DataFrame], Any]) -> Any:
+        """数据集的派生结果（rollup、列画像等），每个数据集只计算一次，随数据集一起释放。"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if name in entry.derived:
+                return entry.derived[name]
+        df = self.get(key)
+        value = build(df) if df is not None else None
+        with self._lock:
+            return entry.derived.setdefault(name, value)
+
+    def report_local(self, session: str, nbytes: int) -> None:
+        """会话上报自己私有的内存占用（如缓存的执行结果），只用于展示。"""
+        with self._lock:
+            self._session_local[session] = int(nbytes)
+
+    # ---- 内存上限与清理 ----
+
+    def memory_bytes(self) -> int:
+        with self._lock:
+            return sum(e.nbytes for e in self._entries.values() if e.in_memory)
+
+    def _spill(self, entry: _Entry) -> bool:
+        """调用方持有锁。落盘（只写一次，数据集不可变）后释放内存中的 DataFrame。"""
+        if pa is None or not entry.spillable:
+            return False
+        if entry.spill_path is None:
+            path = os.path.join(self.spill_dir, entry.key.replace(":", "_") + ".arrow")
+            try:
+                os.makedirs(self.spill_dir, exist_ok=True)
+                table = pa.Table.from_pandas(entry.df, preserve_index=True)
+                with span("dataset_spill", label=entry.label, bytes=entry.nbytes):
+                    with pa.OSFile(path + ".partial", "wb") as sink:
+                        with pa.ipc.new_file(sink, table.schema) as writer:
+                            writer.write_table(table)
+                    os.replace(path + ".partial", path)
+            except Exception as e:
+                # 混合类型的 object 列等无法无损转换为 Arrow：保留在内存中
+                logger.warning("数据集 %s 无法落盘，保留在内存中：%s", entry.label or entry.key, e)
+                entry.spillable = False
+                return False
+            entry.spill_path = path
+        entry.df = None
+        return True
+
+    def _enforce(self, keep: Optional[str] = None) -> None:
+        """调用方持有锁。先清理过期引用，再按 LRU 落盘直到内存低于上限（优先无人引用的数据集）。"""
+        self._sweep()
+        used = sum(e.nbytes for e in self._entries.values() if e.in_memory)
+        if used <= self.budget:
+            return
+        candidates = [e for e in self._entries.values() if e.in_memory and e.key != keep]
+        candidates.sort(key=lambda e: bool(e.refs))   # 稳定排序：无人引用的在前，其余保持 LRU 顺序
+        for entry in candidates:
+            if used <= self.budget:
+                break
+            if self._spill(entry):
+                used -= entry.nbytes
+        if used > self.budget:
+            logger.warning("数据集内存 %.0f MB 超过上限 %.0f MB（当前数据集无法落盘或本身超过上限）",
+                           used / 1024 / 1024, self.budget / 1024 / 1024)
+
+    def _sweep(self) -> None:
+        """调用方持有锁。解除空闲会话的引用，删除无人引用且已空闲 idle_s 的数据集。"""
+        now = time.time()
+        for entry in self._entries.values():
+            for session, seen in list(entry.refs.items()):
+                if now - seen > self.idle_s:
+                    del entry.refs[session]
+                    if self._sessions.get(session) == entry.key:
+                        del self._sessions[session]
+                        self._session_local.pop(session, None)
+                    if not entry.refs:
+                        entry.released_at = now
+        for key in [k for k, e in self._entries.items() if not e.refs and now - e.released_at > self.idle_s]:
+            entry = self._entries.pop(key)
+            self._key_locks.pop(key, None)
+            if entry.spill_path and os.path.exists(entry.spill_path):
+                try:
+                    os.remove(entry.spill_path)
+                except OSError:
+                    pass
+
+    # ---- 展示 ----
+
+    def datasets(self) -> List[DatasetInfo]:
+        with self._lock:
+            self._sweep()
+            return [DatasetInfo(key=e.key, label=e.label, rows=e.rows, nbytes=e.nbytes, in_memory=e.in_memory,
+                                spilled=e.spill_path is not None, sessions=sorted(e.refs))
+                    for e in reversed(self._entries.values())]
+
+    def sessions(self) -> List[Dict[str, Any]]:
+        """各会话的内存：共享数据集按引用会话数均摊，另列出会话私有部分。"""
+        with self._lock:
+            out = []
+            for session, key in self._sessions.items():
+                entry = self._entries.get(key)
+                shared = entry.nbytes if entry is not None and entry.in_memory else 0
+                n = len(entry.refs) if entry is not None else 1
+                out.append({"session": session, "dataset": entry.label if entry else key,
+                            "shared_bytes": shared, "sharers": n, "attributed_bytes": shared // max(1, n),
+                            "local_bytes": self._session_local.get(session, 0),
+                            "idle_s": time.time() - (entry.refs.get(session, 0) if entry else 0)})
+            return sorted(out, key=lambda r: -(r["attributed_bytes"] + r["local_bytes"]))
+
+
+STORE = DatasetStore()
+
+
+def _mb(n: int) -> str:
+    return f"{n / 1024 / 1024:,.1f} MB"
+
+
+def render_memory_page() -> None:
+    """Streamlit 页面：共享数据集与各会话的内存占用。"""
+    import streamlit as st
+
+    from jobs import session_user
+
+    st.title("数据内存")
+    used = STORE.memory_bytes()
+    datasets = STORE.datasets()
+    c1, c2, c3 = st.columns(3)
+    c1.metric("内存中的数据集", _mb(used), f"上限 {_mb(STORE.budget)}", delta_color="off")
+    c2.metric("数据集", len(datasets), f"已落盘 {sum(1 for d in datasets if not d.in_memory)}", delta_color="off")
+    c3.metric("会话", len(STORE.sessions()))
+
+    st.subheader("数据集")
+    if datasets:
+        st.dataframe(pd.DataFrame([{
+            "数据集": d.label or d.key, "行数": d.rows, "大小": _mb(d.nbytes),
+            "位置": "内存" if d.in_memory else "磁盘", "引用会话数": len(d.sessions),
+        } for d in datasets]), hide_index=True, use_container_width=True)
+    else:
+        st.caption("暂无数据集。")
+
+    st.subheader("会话")
+    me = session_user()
+    rows = STORE.sessions()
+    if rows:
+        st.dataframe(pd.DataFrame([{
+            "会话": ("当前会话 " if r["session"] == me else "") + r["session"][:8], "数据集": r["dataset"],
+            "共享数据（均摊）": _mb(r["attributed_bytes"]), "共享人数": r["sharers"],
+            "私有结果": _mb(r["local_bytes"]), "空闲": f"{r['idle_s']:.0f}s",
+        } for r in rows]), hide_index=True, use_container_width=True)
+    else:
+        st.caption("暂无会话持有数据集。")
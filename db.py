@@ -0,0 +1,224 @@
+# db.py
+"""数据库连接池与执行前的查询代价守卫。
+
+- `get_engine(url)`：按 URL 复用带连接池的 Engine，避免每次执行都 create_engine；
+- `prepare_query(engine, sql)`：执行前运行 EXPLAIN FORMAT=JSON，超过阈值或 EXPLAIN 失败的查询直接拒绝，
+  未带 LIMIT 的查询自动追加行数上限（LIMIT 过大时改写为上限），并为 SELECT 加上 MAX_EXECUTION_TIME 提示；
+- `run_query(engine, sql)`：以语句级 MAX_EXECUTION_TIME 提示执行并返回 DataFrame
+  （不设置会话变量，避免超时设置随连接池连接泄漏给快照、导出等其他使用者）；
+  实现了 `execute_df(sql)` 的本地引擎（见 local_sql.py）直接由其自身执行。
+
+阈值可在 config.py 中通过 QUERY_GUARD_CONFIG（dict）配置，或用环境变量覆盖：
+ANALYTIBOT_MAX_ROWS_EXAMINED / ANALYTIBOT_MAX_FULL_SCAN_ROWS / ANALYTIBOT_SQL_ROW_CAP /
+ANALYTIBOT_SQL_TIMEOUT_MS。
+"""
+
+import logging
+import os
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import pandas as pd
+from sqlalchemy import create_engine
+
+from result_view import TRUNCATED_ATTR
+from singleflight import SQL_FLIGHT, flight_key, normalize_sql
+from sql_guard import (QueryCost, explain_cost, replace_top_level_limit, strip_trailing, top_level_limit,
+                       top_level_select_end)
+
+try:
+    from config import QUERY_GUARD_CONFIG  # type: ignore
+except Exception:
+    QUERY_GUARD_CONFIG = None
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class QueryGuardConfig:
+    max_rows_examined: int = 5_000_000   # EXPLAIN 估算扫描行数上限，超过则拒绝
+    max_full_scan_rows: int = 1_000_000  # 存在全表扫描时允许的扫描行数上限
+    row_cap: int = 10_000                # 未带 LIMIT 时自动追加的行数上限
+    max_execution_ms: int = 30_000       # MAX_EXECUTION_TIME（毫秒）与驱动读超时
+    refuse_on_exceed: bool = True        # False 时超限仅告警
+
+    @classmethod
+    def load(cls) -> "QueryGuardConfig":
+        cfg = cls()
+        overrides = dict(QUERY_GUARD_CONFIG or {})
+        env_map = {
+            "max_rows_examined": "ANALYTIBOT_MAX_ROWS_EXAMINED",
+            "max_full_scan_rows": "ANALYTIBOT_MAX_FULL_SCAN_ROWS",
+            "row_cap": "ANALYTIBOT_SQL_ROW_CAP",
+            "max_execution_ms": "ANALYTIBOT_SQL_TIMEOUT_MS",
+        }
+        for attr, env in env_map.items():
+            if os.getenv(env):
+                overrides[attr] = os.getenv(env)
+        for k, v in overrides.items():
+            if hasattr(cfg, k):
+                try:
+                    setattr(cfg, k, type(getattr(cfg, k))(v))
+                except (TypeError, ValueError):
+                    logger.warning("忽略非法的查询守卫配置 %s=%r", k, v)
+        return cfg
+
+
+_ENGINES: Dict[str, object] = {}
+_ENGINES_LOCK = threading.Lock()
+
+
+def get_engine(url: str, guard: Optional[QueryGuardConfig] = None, purpose: str = "query"):
+    """返回按 URL 复用的 Engine（带连接池与驱动级读超时）。
+
+    purpose 不同的 Engine 使用各自的连接池与超时（如 export：长时间流式读取，不受交互查询超时限制）。
+    """
+    cache_key = url if purpose == "query" else f"{purpose}|{url}"
+    with _ENGINES_LOCK:
+        eng = _ENGINES.get(cache_key)
+        if eng is None:
+            guard = guard or QueryGuardConfig.load()
+            kwargs = {"pool_pre_ping": True, "pool_recycle": 3600}
+            connect_args = {}
+            if url.startswith("mysql+pymysql"):
+                # 驱动级读超时作为兜底：即使服务端忽略 MAX_EXECUTION_TIME 也不会无限等待
+                connect_args = {"connect_timeout": 10}
+                if guard.max_execution_ms > 0:
+                    timeout_s = max(1, guard.max_execution_ms // 1000 + 5)
+                    connect_args.update(read_timeout=timeout_s, write_timeout=timeout_s)
+            if url.startswith("sqlite"):
+                kwargs.pop("pool_recycle")
+            eng = create_engine(url, connect_args=connect_args, **kwargs)
+            _ENGINES[cache_key] = eng
+        return eng
+
+
+@dataclass
+class GuardDecision:
+    sql: str                                 # 实际将执行的 SQL（可能已被改写）
+    refused: bool = False
+    reason: str = ""
+    cost: Optional[QueryCost] = None
+    notes: List[str] = field(default_factory=list)
+    row_cap: int = 0                         # 自动施加的行数上限（0 表示未限制）
+
+
+def _add_execution_hint(sql: str, ms: int) -> str:
+    """在最外层查询的 SELECT 后插入 MAX_EXECUTION_TIME 优化器提示（WITH 语句插在 CTE 之后的主 SELECT）。"""
+    if "max_execution_time" in sql.lower():
+        return sql
+    try:
+        pos = top_level_select_end(sql)
+    except ValueError:
+        pos = None
+    if pos is None:
+        return sql
+    return sql[:pos] + f" /*+ MAX_EXECUTION_TIME({int(ms)}) */" + sql[pos:]
+
+
+def prepare_query(engine, sql: str, guard: Optional[QueryGuardConfig] = None) -> GuardDecision:
+    """执行前检查：EXPLAIN 估算代价、超限拒绝、追加行数上限与执行时间提示。"""
+    guard = guard or QueryGuardConfig.load()
+    try:
+        # 行尾注释、分号都要去掉，否则追加的 LIMIT 会落进注释里
+        sql = strip_trailing(sql)
+    except ValueError:
+        sql = sql.strip().rstrip(";").strip()
+    decision = GuardDecision(sql=sql)
+
+    cost = explain_cost(engine, sql)
+    decision.cost = cost
+    if cost is not None and cost.error:
+        # 代价未知时不放行：EXPLAIN 失败通常意味着 SQL 本身有误，错误信息交给调用方修复
+        decision.refused = True
+        decision.reason = cost.error
+        return decision
+    if cost is not None:
+        over = None
+        if cost.rows_examined > guard.max_rows_examined:
+            over = f"预计扫描约 {int(cost.rows_examined)} 行，超过上限 {guard.max_rows_examined}"
+        elif cost.full_scan_tables and cost.rows_examined > guard.max_full_scan_rows:
+            over = (f"对 {', '.join(cost.full_scan_tables)} 全表扫描约 {int(cost.rows_examined)} 行，"
+                    f"超过上限 {guard.max_full_scan_rows}；请添加带索引列的 WHERE 条件")
+        if over:
+            if guard.refuse_on_exceed:
+                decision.refused = True
+                decision.reason = over
+                return decision
+            decision.notes.append(over)
+
+    try:
+        limit = top_level_limit(sql)
+    except ValueError:
+        limit = None
+    if guard.row_cap > 0:
+        if limit is None:
+            sql = f"{sql} LIMIT {guard.row_cap}"
+            decision.row_cap = guard.row_cap
+            decision.notes.append(f"已自动追加 LIMIT {guard.row_cap}")
+        elif limit > guard.row_cap:
+            # 直接改写最外层 LIMIT，不包一层子查询（MySQL 中 join 出的重名列无法作为派生表）
+            sql = replace_top_level_limit(sql, guard.row_cap)
+            decision.row_cap = guard.row_cap
+            decision.notes.append(f"LIMIT {limit} 超过上限，已限制为 {guard.row_cap} 行")
+
+    if getattr(engine.dialect, "name", "") == "mysql" and guard.max_execution_ms > 0:
+        sql = _add_execution_hint(sql, guard.max_execution_ms)
+    decision.sql = sql
+    return decision
+
+
+def engine_key(engine) -> str:
+    """区分不同数据源的合并 key：本地引擎提供 flight_key，SQLAlchemy Engine 使用 URL（密码已隐藏）。"""
+    key = getattr(engine, "flight_key", None)
+    if key:
+        return key
+    url = getattr(engine, "url", None)
+    return str(url) if url is not None else f"engine:{id(engine)}"
+
+
+def run_query(engine, sql: str, guard: Optional[QueryGuardConfig] = None) -> pd.DataFrame:
+    """在连接池连接上执行只读查询；MySQL 下以语句级提示限制执行时间。
+
+    同一数据源上相同 SQL 的并发执行会被合并为一次（见 singleflight.py），
+    共享结果的调用方拿到副本，避免彼此修改同一个 DataFrame。
+    """
+    guard = guard or QueryGuardConfig.load()
+    key = flight_key(engine_key(engine), normalize_sql(sql))
+    df, shared = SQL_FLIGHT.do(key, lambda: _run_query(engine, sql, guard))
+    return df.copy() if shared else df
+
+
+def _run_query(engine, sql: str, guard: QueryGuardConfig) -> pd.DataFrame:
+    if hasattr(engine, "execute_df"):
+        # 本地引擎（如 local_sql.LocalEngine）自行执行并返回 DataFrame
+        return engine.execute_df(sql)
+    if getattr(engine.dialect, "name", "") == "mysql" and guard.max_execution_ms > 0:
+        # 未经 prepare_query 的 SQL 也带上提示（已有提示时不重复添加）
+        sql = _add_execution_hint(sql, guard.max_execution_ms)
+    with engine.connect() as conn:
+        return pd.read_sql_query(sql, con=conn)
+
+
+class QueryRefused(RuntimeError):
+    """查询在执行前被代价守卫拒绝。"""
+
+    def __init__(self, decision: GuardDecision):
+        super().__init__(f"查询已在执行前拒绝：{decision.reason}")
+        self.decision = decision
+
+
+def execute_guarded(engine, sql: str, guard: Optional[QueryGuardConfig] = None):
+    """prepare_query + run_query；被拒绝时抛出 QueryRefused。返回 (DataFrame, GuardDecision)。
+
+    行数达到自动追加的上限时，结果可能不完整：在 df.attrs[TRUNCATED_ATTR] 中记录上限。
+    """
+    guard = guard or QueryGuardConfig.load()
+    decision = prepare_query(engine, sql, guard)
+    if decision.refused:
+        raise QueryRefused(decision)
+    df = run_query(engine, decision.sql, guard)
+    if decision.row_cap and len(df) >= decision.row_cap:
+        df.attrs[TRUNCATED_ATTR] = decision.row_cap
+    return df, decision
@@ -0,0 +1,322 @@
+# export.py
+"""把完整的 SQL 结果或分析结果流式导出为 CSV / Parquet 文件。
+
+界面上只分页展示结果；需要完整数据时用这里的导出：
+- export_sql()：重新校验并执行 SQL（代价守卫照常生效，但不追加行数上限），
+  通过服务端游标（stream_results）分块取回，每块写入文件后即丢弃；
+  本地 DuckDB 引擎按 Arrow RecordBatch 分批读取；
+- export_result()：分析结果（DataFrame 或 result_view.ResultPager）按块切片写出；
+- CSV 支持 gzip / zstd 压缩，Parquet 使用列内压缩（zstd / gzip / snappy），
+  每块写成一个 row group；progress(rows, chunks) 回调用于展示进度。
+
+无论结果多大，内存中只保留当前一块（EXPORT_CHUNK_ROWS 行）。
+"""
+
+import dataclasses
+import gzip
+import logging
+import os
+import re
+import time
+from dataclasses import dataclass
+from typing import Callable, Iterator, Optional
+
+import pandas as pd
+from sqlalchemy import text
+
+from db import QueryGuardConfig, QueryRefused, get_engine, prepare_query
+from jobs import JobCancelled, run_job
+from sql_guard import check_select
+from tracing import span
+
+try:
+    import pyarrow as pa  # type: ignore
+    import pyarrow.parquet as pq  # type: ignore
+except Exception:  # 可选依赖：未安装时只能导出未压缩或 gzip 的 CSV
+    pa = None
+    pq = None
+
+logger = logging.getLogger(__name__)
+
+EXPORT_DIR = os.getenv("ANALYTIBOT_EXPORT_DIR", "exports")
+EXPORT_CHUNK_ROWS = int(os.getenv("ANALYTIBOT_EXPORT_CHUNK_ROWS", "100000"))
+# 超过该大小的文件不再提供浏览器下载按钮（下载按钮需要把文件读入内存），只提示服务器路径
+EXPORT_DOWNLOAD_MAX_MB = int(os.getenv("ANALYTIBOT_EXPORT_DOWNLOAD_MAX_MB", "200"))
+# 导出自己的执行超时（毫秒，0 表示不限制）：完整结果往往远大于交互查询，不沿用 ANALYTIBOT_SQL_TIMEOUT_MS
+EXPORT_TIMEOUT_MS = int(os.getenv("ANALYTIBOT_EXPORT_TIMEOUT_MS", "3600000"))
+
+FORMATS = ("csv", "parquet")
+COMPRESSIONS = {
+    "csv": (None, "gzip", "zstd"),
+    "parquet": ("zstd", "snappy", "gzip", None),
+}
+_SUFFIX = {None: "", "gzip": ".gz", "zstd": ".zst"}
+_NAME_RE = re.compile(r"[^0-9A-Za-z_\-\u0080-\uffff]+")
+
+Progress = Callable[[int, int], None]
+
+
+@dataclass
+class ExportResult:
+    path: str
+    fmt: str
+    compression: Optional[str]
+    rows: int
+    chunks: int
+    bytes: int
+    elapsed_s: float
+
+    @property
+    def file_name(self) -> str:
+        return os.path.basename(self.path)
+
+    def describe(self) -> str:
+        return (f"{self.rows} 行，{self.chunks} 块，{self.bytes / 1024 / 1024:.1f} MB，"
+                f"耗时 {self.elapsed_s:.1f}s")
+
+
+def export_path(name: str, fmt: str, compression: Optional[str]) -> str:
+    """EXPORT_DIR 下的文件路径；名称中的非法字符替换为下划线，并加上时间戳避免覆盖。"""
+    safe = _NAME_RE.sub("_", name).strip("_") or "export"
+    ext = "parquet" if fmt == "parquet" else "csv" + _SUFFIX[compression]
+    return os.path.join(EXPORT_DIR, f"{safe}_{time.strftime('%Y%m%d_%H%M%S')}.{ext}")
+
+
+def _check_options(fmt: str, compression: Optional[str]) -> None:
+    if fmt not in FORMATS:
+        raise ValueError(f"不支持的导出格式：{fmt}")
+    if compression not in COMPRESSIONS[fmt]:
+        raise ValueError(f"{fmt} 不支持压缩方式 {compression}")
+    if (fmt == "parquet" or compression == "zstd") and pa is None:
+        raise RuntimeError("未安装 pyarrow，无法导出 Parquet 或 zstd 压缩文件（pip install pyarrow）")
+
+
+class _CsvSink:
+    """逐块追加 CSV；首块写表头。UTF-8 带 BOM，便于 Excel 直接打开中文。"""
+
+    def __init__(self, path: str, compression: Optional[str]):
+        if compression == "gzip":
+            self._fh = gzip.open(path, "wb", compresslevel=6)
+        elif compression == "zstd":
+            self._fh = pa.CompressedOutputStream(path, "zstd")
+        else:
+            self._fh = open(path, "wb")
+        self._first = True
+
+    def write(self, chunk: pd.DataFrame) -> None:
+        data = chunk.to_csv(index=False, header=self._first)
+        self._fh.write(data.encode("utf-8-sig" if self._first else "utf-8"))
+        self._first = False
+
+    def close(self) -> None:
+        self._fh.close()
+
+
+class _ParquetSink:
+    """每块写成一个 row group；后续块按首块的 schema 对齐。"""
+
+    def __init__(self, path: str, compression: Optional[str]):
+        self._path = path
+        self._compression = compression or "none"
+        self._writer = None
+        self._schema = None
+
+    def _table(self, chunk: pd.DataFrame):
+        if self._schema is None:
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            # 首块中全为空的列类型为 null，后续块无法写入，统一按字符串保存
+            fields = [pa.field(f.name, pa.string()) if pa.types.is_null(f.type) else f for f in table.schema]
+            self._schema = pa.schema(fields)
+            return table.cast(self._schema)
+        try:
+            return pa.Table.from_pandas(chunk, schema=self._schema, preserve_index=False)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            # 类型漂移：首块为文本的列中出现数字时按文本写入；反过来（数值列出现文本）无法对齐
+            fixed = chunk.copy()
+            for f in self._schema:
+                if pa.types.is_string(f.type) and f.name in fixed.columns:
+                    fixed[f.name] = fixed[f.name].astype("string")
+            try:
+                return pa.Table.from_pandas(fixed, schema=self._schema, preserve_index=False, safe=False)
+            except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError) as e:
+                raise ValueError(f"结果中的列类型前后不一致，无法写入同一个 Parquet 文件，请改用 CSV 导出：{e}") from e
+
+    def write(self, chunk: pd.DataFrame) -> None:
+        table = self._table(chunk)
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self._path, self._schema, compression=self._compression)
+        self._writer.write_table(table)
+
+    def close(self) -> None:
+        if self._writer is None:
+            # 没有任何数据块：仍写出一个（可能无列的）空文件
+            self._writer = pq.ParquetWriter(self._path, self._schema or pa.schema([]), compression=self._compression)
+        self._writer.close()
+
+
+def _write_chunks(chunks: Iterator[pd.DataFrame], path: str, fmt: str, compression: Optional[str],
+                  progress: Optional[Progress], columns: Callable[[], Optional[list]]) -> ExportResult:
+    """把分块写入临时文件，完成后原子改名；失败时删除临时文件。"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".partial"
+    sink = _ParquetSink(tmp, compression) if fmt == "parquet" else _CsvSink(tmp, compression)
+    start = time.perf_counter()
+    rows = n = 0
+    try:
+        for chunk in chunks:
+            sink.write(chunk)
+            rows += len(chunk)
+            n += 1
+            if progress is not None:
+                progress(rows, n)
+        if n == 0 and columns() is not None:
+            # 空结果也输出表头/schema（列名在读取结果后才知道，因此延迟获取）
+            sink.write(pd.DataFrame(columns=list(columns())))
+        sink.close()
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            sink.close()
+        except Exception:
+            pass
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return ExportResult(path=path, fmt=fmt, compression=compression, rows=rows, chunks=n,
+                        bytes=os.path.getsize(path), elapsed_s=time.perf_counter() - start)
+
+
+def _sql_chunks(engine, sql: str, guard: QueryGuardConfig, chunk_rows: int, meta: dict) -> Iterator[pd.DataFrame]:
+    if hasattr(engine, "iter_batches"):
+        # 本地 DuckDB：按 RecordBatch 分批取回
+        reader = engine.iter_batches(sql, chunk_rows)
+        meta["columns"] = reader.schema.names
+        for batch in reader:
+            yield batch.to_pandas()
+        return
+    if hasattr(engine, "execute_df"):
+        df = engine.execute_df(sql)
+        meta["columns"] = list(df.columns)
+        for offset in range(0, len(df), chunk_rows):
+            yield df.iloc[offset:offset + chunk_rows]
+        return
+    with engine.connect() as conn:
+        # 服务端游标：驱动逐块取回结果，不把整个结果集缓存在客户端
+        conn = conn.execution_options(stream_results=True)
+        for chunk in pd.read_sql_query(text(sql), conn, chunksize=chunk_rows):
+            meta.setdefault("columns", list(chunk.columns))
+            yield chunk
+
+
+def _export_engine(engine, guard: QueryGuardConfig):
+    """MySQL 导出使用独立的 Engine：驱动读超时按导出超时设置，不占用交互查询的连接池。"""
+    if getattr(getattr(engine, "dialect", None), "name", "") != "mysql":
+        return engine
+    return get_engine(engine.url.render_as_string(hide_password=False), guard, purpose="export")
+
+
+def export_sql(engine, sql: str, fmt: str = "parquet", compression: Optional[str] = "zstd",
+               path: Optional[str] = None, allowed_tables=None, guard: Optional[QueryGuardConfig] = None,
+               chunk_rows: int = EXPORT_CHUNK_ROWS, progress: Optional[Progress] = None,
+               name: str = "query") -> ExportResult:
+    """重新执行只读 SELECT 并流式写出完整结果。
+
+    SQL 先经 check_select 校验（allowed_tables 为 None 表示不限制表），再经代价守卫；
+    导出不受界面的行数上限（row_cap）限制，执行超时为 EXPORT_TIMEOUT_MS（语句级提示，不设置会话变量），
+    被守卫拒绝时抛出 QueryRefused。
+    """
+    _check_options(fmt, compression)
+    analysis = check_select(sql, allowed_tables)
+    if not analysis.ok:
+        raise ValueError("SQL 未通过安全校验：" + "；".join(analysis.errors))
+    guard = dataclasses.replace(guard or QueryGuardConfig.load(), row_cap=0, max_execution_ms=EXPORT_TIMEOUT_MS)
+    engine = _export_engine(engine, guard)
+    decision = prepare_query(engine, sql, guard)
+    if decision.refused:
+        raise QueryRefused(decision)
+    path = path or export_path(name, fmt, compression)
+    meta: dict = {}
+    with span("export", source="sql", fmt=fmt, compression=compression or "none") as sp:
+        result = _write_chunks(_sql_chunks(engine, decision.sql, guard, chunk_rows, meta), path, fmt,
+                               compression, progress, columns=lambda: meta.get("columns"))
+        sp.update(rows=result.rows, chunks=result.chunks, bytes=result.bytes)
+    logger.info("已导出 SQL 结果到 %s：%s", path, result.describe())
+    return result
+
+
+def export_result(result, fmt: str = "parquet", compression: Optional[str] = "zstd", path: Optional[str] = None,
+                  chunk_rows: int = EXPORT_CHUNK_ROWS, progress: Optional[Progress] = None,
+                  name: str = "result") -> ExportResult:
+    """导出分析结果（DataFrame 或 ResultPager），按 chunk_rows 切片写出。"""
+    from result_view import ResultPager
+
+    _check_options(fmt, compression)
+    pager = result if isinstance(result, ResultPager) else ResultPager(result)
+    path = path or export_path(name, fmt, compression)
+
+    def chunks() -> Iterator[pd.DataFrame]:
+        for offset in range(0, pager.num_rows, chunk_rows):
+            yield pager.rows(offset, chunk_rows)
+
+    with span("export", source="result", fmt=fmt, compression=compression or "none") as sp:
+        res = _write_chunks(chunks(), path, fmt, compression, progress, columns=lambda: pager.columns)
+        sp.update(rows=res.rows, chunks=res.chunks, bytes=res.bytes)
+    return res
+
+
+def render_export(key: str, result=None, sql: Optional[str] = None, engine_factory=None,
+                  allowlist_factory=None, name: str = "result") -> None:
+    """Streamlit 导出控件：给出 sql 与 engine_factory 时重新执行 SQL 导出完整结果，否则导出 result。
+
+    engine_factory / allowlist_factory 只在点击导出时调用，避免每次重跑都连接数据库。
+    """
+    import streamlit as st
+
+    c1, c2 = st.columns(2)
+    fmt = c1.radio("导出格式", FORMATS, horizontal=True, key=f"{key}_fmt")
+    options = [c for c in COMPRESSIONS[fmt] if c != "zstd" or pa is not None]
+    compression = c2.selectbox("压缩", options, format_func=lambda c: c or "不压缩", key=f"{key}_comp")
+    if not st.button("导出完整结果", key=f"{key}_btn"):
+        last = st.session_state.get(f"{key}_file")
+        if last and os.path.exists(last):
+            _offer_download(st, last, key)
+        return
+
+    total = getattr(result, "num_rows", None) if sql is None else None
+    # 工厂函数可能读取 session_state，必须在脚本线程中调用，不能放进作业
+    engine = engine_factory() if sql is not None else None
+    allowed = allowlist_factory() if sql is not None and allowlist_factory is not None else None
+
+    def work(ctx):
+        def progress(rows: int, chunks: int) -> None:
+            # 每写出一块上报一次进度，同时作为取消检查点（已写出的临时文件会被删除）
+            ctx.report(min(1.0, rows / total) if total else None, f"已写出 {rows} 行（{chunks} 块）")
+
+        if sql is not None:
+            return export_sql(engine, sql, fmt=fmt, compression=compression, allowed_tables=allowed,
+                              progress=progress, name=name)
+        return export_result(result, fmt=fmt, compression=compression, progress=progress, name=name)
+
+    status = st.empty()
+    try:
+        # 导出作为低优先级作业执行，不占用留给对话的线程（见 jobs.py）
+        res = run_job("export", work, "导出完整结果")
+    except JobCancelled:
+        status.info("已取消导出。")
+        return
+    except Exception as e:
+        st.error(f"导出失败：{e}")
+        return
+    status.success(f"已导出 {res.file_name}：{res.describe()}")
+    st.session_state[f"{key}_file"] = res.path
+    _offer_download(st, res.path, key)
+
+
+def _offer_download(st, path: str, key: str) -> None:
+    size_mb = os.path.getsize(path) / 1024 / 1024
+    if size_mb > EXPORT_DOWNLOAD_MAX_MB:
+        st.info(f"文件较大（{size_mb:.0f} MB），请从服务器路径获取：{os.path.abspath(path)}")
+        return
+    with open(path, "rb") as fh:
+        st.download_button(f"下载 {os.path.basename(path)}", fh, file_name=os.path.basename(path),
+                           key=f"{key}_download")
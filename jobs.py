@@ -0,0 +1,348 @@
+# jobs.py
+"""进程内的公平作业调度：有界工作线程池 + 按用户并发上限 + 优先级队列。
+
+Streamlit 的每个会话原本在自己的脚本线程里直接调用模型、执行 SQL / 分析代码、导出、
+抽取快照，重活没有总量限制，多人同时使用时主机被压满，对话也随之变慢。
+这里把这些工作提交为作业，由共享的工作线程池执行：
+
+- 优先级：chat（对话中的模型调用）> query（SQL / 分析代码执行）> export > snapshot；
+- 每个用户（Streamlit 会话）同时运行的作业不超过 JOB_PER_USER，其余排队；
+  同一优先级内先调度当前运行作业最少的用户，再按提交顺序，避免一个人的批量任务占满线程；
+- 总线程数 JOB_WORKERS，其中 JOB_INTERACTIVE_RESERVE 个只留给 chat 作业，
+  导出与快照再多也不会让对话排不上队；
+- 作业可取消：排队中的直接移除；运行中的置取消标志，作业函数在检查点
+  （JobContext.check / 进度回调）处中止，无法中断的调用（如一次模型请求）结束后丢弃结果。
+
+run_job() 是 Streamlit 侧的封装：提交后在页面上显示排队/运行状态与取消按钮，
+完成后返回结果；render_jobs() 列出当前会话的作业。
+"""
+
+import contextvars
+import itertools
+import logging
+import os
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+from tracing import REGISTRY, span
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.getenv("ANALYTIBOT_JOB_WORKERS", "8"))
+JOB_PER_USER = int(os.getenv("ANALYTIBOT_JOB_PER_USER", "2"))
+JOB_INTERACTIVE_RESERVE = int(os.getenv("ANALYTIBOT_JOB_INTERACTIVE_RESERVE", "2"))
+JOB_HISTORY = 200   # 保留的已结束作业数（供状态查询）
+
+# 作业类型 -> 优先级（数值越小越先调度）
+PRIORITIES = {"chat": 0, "query": 1, "export": 2, "snapshot": 3}
+INTERACTIVE_KINDS = frozenset({"chat"})
+
+QUEUED, RUNNING, CANCELLING, DONE, FAILED, CANCELLED = (
+    "queued", "running", "cancelling", "done", "failed", "cancelled")
+FINISHED = frozenset({DONE, FAILED, CANCELLED})
+STATUS_TEXT = {QUEUED: "排队中", RUNNING: "运行中", CANCELLING: "正在取消", DONE: "已完成",
+               FAILED: "失败", CANCELLED: "已取消"}
+
+QUEUE_SECONDS = REGISTRY.histogram("analytibot_job_queue_seconds", "作业排队等待时间")
+JOBS_TOTAL = REGISTRY.counter("analytibot_jobs_total", "结束的作业数（按类型与结果）")
+
+
+class JobCancelled(Exception):
+    """作业被取消。"""
+
+
+@dataclass
+class Job:
+    id: str
+    user: str
+    kind: str
+    label: str
+    fn: Callable[["JobContext"], Any] = field(repr=False)
+    priority: int
+    seq: int
+    submitted_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    status: str = QUEUED
+    progress: Optional[float] = None   # 0~1，未知时为 None
+    message: str = ""
+    result: Any = field(default=None, repr=False)
+    error: Optional[BaseException] = field(default=None, repr=False)
+    cancel_event: threading.Event = field(default_factory=threading.Event, repr=False)
+    done_event: threading.Event = field(default_factory=threading.Event, repr=False)
+    context: Optional[contextvars.Context] = field(default=None, repr=False)
+
+    @property
+    def done(self) -> bool:
+        return self.status in FINISHED
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self.done_event.wait(timeout)
+
+    def elapsed_s(self) -> float:
+        end = self.finished_at or time.time()
+        return end - (self.started_at or self.submitted_at)
+
+    def describe(self) -> str:
+        text = f"{self.label or self.kind}：{STATUS_TEXT.get(self.status, self.status)}"
+        if self.status == QUEUED:
+            text += f"（已等待 {time.time() - self.submitted_at:.0f}s）"
+        elif self.status in (RUNNING, CANCELLING):
+            text += f"（{self.elapsed_s():.0f}s）"
+        if self.message:
+            text += f" {self.message}"
+        return text
+
+
+class JobContext:
+    """传给作业函数：检查取消、上报进度。"""
+
+    def __init__(self, job: Job):
+        self._job = job
+
+    @property
+    def cancelled(self) -> bool:
+        return self._job.cancel_event.is_set()
+
+    def check(self) -> None:
+        if self._job.cancel_event.is_set():
+            raise JobCancelled(f"作业 {self._job.label or self._job.kind} 已取消")
+
+    def report(self, progress: Optional[float] = None, message: str = "") -> None:
+        """更新进度并检查取消（在循环中调用即可作为取消检查点）。"""
+        if progress is not None:
+            self._job.progress = max(0.0, min(1.0, progress))
+        if message:
+            self._job.message = message
+        self.check()
+
+
+class JobScheduler:
+    def __init__(self, workers: int = JOB_WORKERS, per_user: int = JOB_PER_USER,
+                 interactive_reserve: int = JOB_INTERACTIVE_RESERVE):
+        self.workers = max(1, workers)
+        self.per_user = max(1, per_user)
+        self.interactive_reserve = min(max(0, interactive_reserve), self.workers - 1)
+        self._cond = threading.Condition()
+        self._queue: List[Job] = []
+        self._jobs: Dict[str, Job] = {}
+        self._finished: List[str] = []
+        self._running: Dict[str, int] = {}   # user -> 运行中的作业数
+        self._running_heavy = 0               # 非交互作业占用的线程数
+        self._threads: List[threading.Thread] = []
+        self._seq = itertools.count()
+
+    # ---- 提交与查询 ----
+
+    def submit(self, user: str, kind: str, fn: Callable[[JobContext], Any], label: str = "") -> Job:
+        if kind not in PRIORITIES:
+            raise ValueError(f"未知的作业类型：{kind}（可选：{', '.join(PRIORITIES)}）")
+        job = Job(id=uuid.uuid4().hex[:12], user=user, kind=kind, label=label, fn=fn,
+                  priority=PRIORITIES[kind], seq=next(self._seq),
+                  context=contextvars.copy_context())   # 作业内的 span 挂在提交方的 trace 下
+        with self._cond:
+            self._jobs[job.id] = job
+            self._queue.append(job)
+            if len(self._threads) < self.workers:
+                t = threading.Thread(target=self._worker, name=f"analytibot-job-{len(self._threads)}", daemon=True)
+                self._threads.append(t)
+                t.start()
+            self._cond.notify_all()
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def jobs_for(self, user: str) -> List[Job]:
+        with self._cond:
+            return sorted((j for j in self._jobs.values() if j.user == user), key=lambda j: j.seq)
+
+    def position(self, job: Job) -> int:
+        """排队中的作业前面还有几个可能先于它调度的作业（同级或更高优先级）。"""
+        with self._cond:
+            if job.status != QUEUED:
+                return 0
+            return sum(1 for j in self._queue if j is not job and (j.priority, j.seq) < (job.priority, job.seq))
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {"queued": len(self._queue), "running": sum(self._running.values()),
+                    "workers": len(self._threads), "users": len(self._running)}
+
+    def cancel(self, job_id: str) -> bool:
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None or job.done:
+                return False
+            job.cancel_event.set()
+            if job.status == QUEUED:
+                self._queue.remove(job)
+                self._finish(job, CANCELLED)
+            else:
+                job.status = CANCELLING
+            return True
+
+    # ---- 调度 ----
+
+    def _pick(self) -> Optional[Job]:
+        """调用方持有锁。按 (优先级, 该用户运行中作业数, 提交顺序) 选出可运行的作业。"""
+        best = None
+        best_key = None
+        heavy_cap = self.workers - self.interactive_reserve
+        for job in self._queue:
+            running = self._running.get(job.user, 0)
+            if running >= self.per_user:
+                continue
+            if job.kind not in INTERACTIVE_KINDS and self._running_heavy >= heavy_cap:
+                continue
+            key = (job.priority, running, job.seq)
+            if best_key is None or key < best_key:
+                best, best_key = job, key
+        return best
+
+    def _worker(self) -> None:
+        while True:
+            with self._cond:
+                job = self._pick()
+                while job is None:
+                    self._cond.wait()
+                    job = self._pick()
+                self._queue.remove(job)
+                self._running[job.user] = self._running.get(job.user, 0) + 1
+                heavy = job.kind not in INTERACTIVE_KINDS
+                if heavy:
+                    self._running_heavy += 1
+                job.status = RUNNING
+                job.started_at = time.time()
+            QUEUE_SECONDS.observe(job.started_at - job.submitted_at, kind=job.kind)
+            status = DONE
+            try:
+                job.result = job.context.run(self._run, job)
+            except JobCancelled:
+                status = CANCELLED
+            except BaseException as e:
+                job.error = e
+                status = FAILED
+            with self._cond:
+                self._running[job.user] -= 1
+                if not self._running[job.user]:
+                    del self._running[job.user]
+                if heavy:
+                    self._running_heavy -= 1
+                if job.cancel_event.is_set():
+                    # 无法中断的调用在取消后才结束：结果丢弃
+                    status, job.result = CANCELLED, None
+                self._finish(job, status)
+                self._cond.notify_all()
+
+    @staticmethod
+    def _run(job: Job) -> Any:
+        with span("job", kind=job.kind, label=job.label,
+                  queued_s=round(job.started_at - job.submitted_at, 3)) as sp:
+            try:
+                return job.fn(JobContext(job))
+            except JobCancelled:
+                sp["status"] = "cancelled"
+                raise
+
+    def _finish(self, job: Job, status: str) -> None:
+        """调用方持有锁。"""
+        job.status = status
+        job.finished_at = time.time()
+        job.fn = None   # 释放闭包引用的数据
+        job.done_event.set()
+        JOBS_TOTAL.inc(kind=job.kind, status=status)
+        self._finished.append(job.id)
+        while len(self._finished) > JOB_HISTORY:
+            self._jobs.pop(self._finished.pop(0), None)
+
+
+SCHEDULER = JobScheduler()
+
+
+# ---- Streamlit 侧 ----
+
+def session_user() -> str:
+    """当前 Streamlit 会话的标识（每位分析人员一个会话），不在 Streamlit 中运行时为 local。"""
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        ctx = get_script_run_ctx()
+        if ctx is not None:
+            return ctx.session_id
+    except Exception:
+        pass
+    return "local"
+
+
+def _cancel_key(job_id: str) -> str:
+    return f"job_cancel_{job_id}"
+
+
+def handle_cancel_requests() -> None:
+    """处理上一轮点击的取消按钮（点击会触发重跑并中断正在等待的脚本），在页面开头调用。"""
+    import streamlit as st
+
+    for key in [k for k in st.session_state if isinstance(k, str) and k.startswith("job_cancel_")]:
+        if st.session_state.get(key):
+            if SCHEDULER.cancel(key[len("job_cancel_"):]):
+                st.toast("已取消作业")
+
+
+def run_job(kind: str, fn: Callable[[JobContext], Any], label: str, poll_s: float = 0.2) -> Any:
+    """提交作业并在页面上等待，显示状态与取消按钮；返回作业结果。
+
+    作业失败时重新抛出原异常，被取消时抛出 JobCancelled。
+    等待期间用户的任何操作都会照常触发重跑；作业会在后台继续运行，可在作业列表中查看或取消。
+    """
+    job = SCHEDULER.submit(session_user(), kind, fn, label=label)
+    return wait_job(job, poll_s=poll_s)
+
+
+def wait_job(job: Job, poll_s: float = 0.2, cancel_button: bool = True) -> Any:
+    """在页面上等待已提交的作业（状态、进度、取消按钮），语义同 run_job。
+
+    页面重跑后继续等待同一作业时，作业列表（render_jobs）里已有它的取消按钮，应传 cancel_button=False。
+    """
+    import streamlit as st
+
+    label = job.label or job.kind
+    box = st.empty()
+    with box.container():
+        status = st.empty()
+        bar = st.empty()
+        if cancel_button:
+            st.button("取消", key=_cancel_key(job.id))
+    while not job.wait(poll_s):
+        text = job.describe()
+        if job.status == QUEUED:
+            text += f"，前面还有 {SCHEDULER.position(job)} 个作业"
+        status.caption(text)
+        if job.progress is not None:
+            bar.progress(job.progress)
+    box.empty()
+    if job.status == CANCELLED:
+        raise JobCancelled(f"{label} 已取消")
+    if job.status == FAILED:
+        raise job.error
+    return job.result
+
+
+def render_jobs(limit: int = 10) -> None:
+    """列出当前会话最近的作业；未结束的作业带取消按钮。"""
+    import streamlit as st
+
+    jobs = SCHEDULER.jobs_for(session_user())[-limit:]
+    if not jobs:
+        return
+    stats = SCHEDULER.stats()
+    with st.expander(f"作业（全局排队 {stats['queued']}，运行 {stats['running']}）",
+                     expanded=any(not j.done for j in jobs)):
+        for job in reversed(jobs):
+            c1, c2 = st.columns([5, 1])
+            c1.caption(job.describe())
+            if not job.done and job.status != CANCELLING:
+                c2.button("取消", key=_cancel_key(job.id))
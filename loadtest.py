@@ -0,0 +1,559 @@
+# loadtest.py
+"""多会话压测：用本地替身驱动 N 个并发的无界面对话会话，评估单个 worker 能承载多少用户。
+
+- 模型：进程内的假 DashScope HTTP 服务（兼容 Generation 接口），延迟与抖动可配，
+  可模拟上游 QPS 限制（超过时返回 429 Throttling）；按 prompt 类型返回意图判断、SQL、
+  修复后的 SQL 或普通文字回复，并按比例返回错误列名的 SQL 以触发自动修复。
+- 数据库：SQLite 文件（orders / customers 两张表）作为 MySQL 的替身，
+  走与线上相同的 db.get_engine 连接池、查询守卫、表白名单与 schema 检索。
+- 会话：每个用户一个线程，调用 chat_turn.run_turn——streamlit_chat.py 也调用它，只是以 execute=False
+  生成 SQL 后等用户点击按钮再经 execute_sql 执行；这里 execute=True，相当于用户立即确认执行，
+  上传数据经 datastore.STORE 去重共享，模型调用与 SQL 执行提交到 jobs.SCHEDULER。
+
+并发数逐级升高（--users 1,5,10,25），每级报告吞吐、每轮延迟分位数、错误数、
+模型请求数与峰值并发、连接池峰值占用、进程内存（RSS）增长、调度队列峰值与数据集内存。
+
+用法示例：
+    python loadtest.py --users 1,5,10,25 --turns 5 --llm-latency-ms 800 --json loadtest.json
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+# 压测产生的 trace 不写进工作目录的 traces.log（须在导入 tracing 之前设置）
+os.environ.setdefault("ANALYTIBOT_TRACE_LOG", os.path.join(tempfile.gettempdir(), "analytibot_loadtest_traces.log"))
+
+logger = logging.getLogger(__name__)
+
+CITIES = ["北京", "上海", "广州", "深圳", "杭州", "成都", "武汉", "西安"]
+PRODUCTS = ["手机", "电脑", "耳机", "平板", "手表", "相机"]
+LEVELS = ["普通", "白银", "黄金", "钻石"]
+
+# 模拟用户的提问：显式 SQL 请求、需要模型判断意图的问题、以及数据分析类请求（直接文字回复）
+QUESTIONS = [
+    "查询 orders 表里金额最高的 10 笔订单",
+    "帮我写 SQL：统计每个产品的销量",
+    "各城市的销售额是多少",
+    "各等级客户数量是多少",
+    "请总结一下这份数据的分布特点",
+    "解释一下上面的结果，有什么趋势",
+    "按城市再汇总一下上面的结果",
+]
+
+# (关键词, SQL)：假模型按用户问题中的关键词返回 SQL
+CANNED_SQL = [
+    ("最高", "SELECT id, order_date, city, product, amount FROM orders ORDER BY amount DESC LIMIT 10"),
+    ("产品", "SELECT product, SUM(qty) AS qty FROM orders GROUP BY product ORDER BY qty DESC"),
+    ("城市", "SELECT city, SUM(amount) AS sales FROM orders GROUP BY city ORDER BY sales DESC"),
+    ("客户", "SELECT level, COUNT(*) AS n FROM customers GROUP BY level"),
+]
+DEFAULT_SQL = "SELECT COUNT(*) AS n FROM orders"
+BAD_COLUMN = ("amount", "amout")   # 注入的错误列名及其修正
+
+
+# ---- 假 DashScope 服务 ----
+
+class FakeLLMStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._window: List[float] = []
+
+    def enter(self, qps_limit: float) -> bool:
+        """登记一个请求；超过 qps_limit 时返回 False（应答 429）。"""
+        with self.lock:
+            now = time.time()
+            self.requests += 1
+            if qps_limit > 0:
+                self._window = [t for t in self._window if now - t < 1.0]
+                if len(self._window) >= qps_limit:
+                    self.throttled += 1
+                    return False
+                self._window.append(now)
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def snapshot_and_reset(self) -> Dict[str, int]:
+        with self.lock:
+            out = {"llm_requests": self.requests, "llm_throttled": self.throttled,
+                   "llm_peak_in_flight": self.peak_in_flight}
+            self.requests = self.throttled = 0
+            self.peak_in_flight = self.in_flight
+            return out
+
+
+def _last_match(pattern: str, text: str) -> str:
+    found = re.findall(pattern, text)
+    return found[-1].strip() if found else ""
+
+
+def fake_reply(prompt: str, bad_sql_rate: float, rng: random.Random) -> str:
+    """按 prompt 类型给出回复（与 chat_turn / sql_repair 中的指令文字对应）。"""
+    def pick_sql(question: str) -> str:
+        for kw, sql in CANNED_SQL:
+            if kw in question:
+                return sql
+        return DEFAULT_SQL
+
+    if "请在确保只读的前提下修正该 SQL" in prompt or "最终 SQL：" in prompt:
+        sql = _last_match(r"原始 SQL: (.*)", prompt)
+        return sql.replace(BAD_COLUMN[1], BAD_COLUMN[0]) if sql else DEFAULT_SQL
+    if "生成一段可执行的分析代码" in prompt:
+        # 追问分析：在缓存的上次结果 df 上计算
+        return "result = df.describe(include='all')"
+    if "请仅返回一行：" in prompt and "用户请求：" in prompt:
+        question = _last_match(r"用户请求：(.*)", prompt)
+        if "LAST_RESULT" in prompt and "汇总" in question:
+            return "LAST_RESULT"
+        return pick_sql(question) if ("多少" in question or "查询" in question) else "NO_SQL"
+    if "只返回 SQL，不要解释" in prompt:
+        sql = pick_sql(_last_match(r"User: (.*)", prompt))
+        if BAD_COLUMN[0] in sql and rng.random() < bad_sql_rate:
+            sql = sql.replace(BAD_COLUMN[0], BAD_COLUMN[1])
+        return sql
+    question = _last_match(r"User: (.*)", prompt)
+    return f"（压测回复）关于“{question[:30]}”：数据共包含若干城市与产品，销售额集中在头部城市。"
+
+
+class FakeDashScope:
+    """兼容 dashscope Generation 接口的本地 HTTP 服务。"""
+
+    def __init__(self, latency_ms: float = 500, jitter_ms: float = 200, qps_limit: float = 0,
+                 bad_sql_rate: float = 0.2, seed: int = 0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.qps_limit = qps_limit
+        self.bad_sql_rate = bad_sql_rate
+        self.stats = FakeLLMStats()
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, body: dict):
+                data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+                request_id = uuid.uuid4().hex
+                if not self.path.rstrip("/").endswith("/generation"):
+                    self._send(404, {"code": "NotFound", "message": self.path, "request_id": request_id})
+                    return
+                if not fake.stats.enter(fake.qps_limit):
+                    self._send(429, {"code": "Throttling.RateQuota", "message": "Requests rate limit exceeded",
+                                     "request_id": request_id})
+                    return
+                try:
+                    inp = payload.get("input") or {}
+                    messages = inp.get("messages") or []
+                    prompt = messages[-1].get("content", "") if messages else inp.get("prompt", "")
+                    with fake._rng_lock:
+                        delay = max(0.0, fake.latency_ms + fake._rng.uniform(-fake.jitter_ms, fake.jitter_ms))
+                        text = fake_reply(prompt, fake.bad_sql_rate, fake._rng)
+                    time.sleep(delay / 1000.0)
+                    in_tokens, out_tokens = len(prompt) // 2 + 1, len(text) // 2 + 1
+                    self._send(200, {
+                        "status_code": 200, "request_id": request_id, "code": "", "message": "",
+                        "output": {"choices": [{"finish_reason": "stop",
+                                                "message": {"role": "assistant", "content": text}}]},
+                        "usage": {"input_tokens": in_tokens, "output_tokens": out_tokens,
+                                  "total_tokens": in_tokens + out_tokens},
+                    })
+                finally:
+                    fake.stats.leave()
+
+        return Handler
+
+    def start(self) -> str:
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="fake-dashscope", daemon=True).start()
+        return f"http://127.0.0.1:{self._server.server_address[1]}/api/v1"
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+# ---- SQLite 替身数据库 ----
+
+def build_database(path: str, rows: int, seed: int = 0) -> None:
+    rng = random.Random(seed)
+    start = date(2024, 1, 1)
+    conn = sqlite3.connect(path)
+    try:
+        conn.executescript("""
+            DROP TABLE IF EXISTS orders;
+            DROP TABLE IF EXISTS customers;
+            CREATE TABLE orders (id INTEGER PRIMARY KEY, order_date TEXT, city TEXT, product TEXT,
+                                 amount REAL, qty INTEGER);
+            CREATE TABLE customers (id INTEGER PRIMARY KEY, name TEXT, city TEXT, level TEXT);
+        """)
+        conn.executemany("INSERT INTO orders VALUES (?, ?, ?, ?, ?, ?)", (
+            (i, (start + timedelta(days=rng.randrange(365))).isoformat(), rng.choice(CITIES),
+             rng.choice(PRODUCTS), round(rng.uniform(10, 5000), 2), rng.randint(1, 10))
+            for i in range(1, rows + 1)))
+        conn.executemany("INSERT INTO customers VALUES (?, ?, ?, ?)", (
+            (i, f"客户{i}", rng.choice(CITIES), rng.choice(LEVELS)) for i in range(1, max(10, rows // 10) + 1)))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def upload_bytes(db_path: str, limit: int = 2000) -> bytes:
+    """模拟所有用户上传同一份 CSV（orders 的前 limit 行），用于检验数据集去重。"""
+    conn = sqlite3.connect(db_path)
+    try:
+        cur = conn.execute("SELECT * FROM orders LIMIT ?", (limit,))
+        header = [d[0] for d in cur.description]
+        lines = [",".join(header)] + [",".join(str(v) for v in row) for row in cur]
+    finally:
+        conn.close()
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+# ---- 资源采样 ----
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        try:
+            import resource
+            # 取不到当前值时退而使用峰值（Linux 上单位为 KB）
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        except Exception:
+            return 0
+
+
+class Monitor:
+    """后台定期采样：连接池占用、调度队列、RSS、数据集内存，记录峰值。"""
+
+    def __init__(self, engine, interval_s: float = 0.05):
+        self.engine = engine
+        self.interval_s = interval_s
+        self.peaks: Dict[str, int] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _sample(self):
+        from datastore import STORE
+        from jobs import SCHEDULER
+        pool = self.engine.pool
+        jobs = SCHEDULER.stats()
+        values = {
+            "db_checked_out": pool.checkedout() if hasattr(pool, "checkedout") else 0,
+            "jobs_queued": jobs["queued"],
+            "jobs_running": jobs["running"],
+            "rss_bytes": rss_bytes(),
+            "store_bytes": STORE.memory_bytes(),
+        }
+        for k, v in values.items():
+            self.peaks[k] = max(self.peaks.get(k, 0), v)
+
+    def _loop(self):
+        while not self._stop.wait(self.interval_s):
+            try:
+                self._sample()
+            except Exception:
+                logger.exception("压测采样失败")
+
+    def start(self):
+        self.peaks = {}
+        self._stop.clear()
+        self._sample()
+        self._thread = threading.Thread(target=self._loop, name="loadtest-monitor", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> Dict[str, int]:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._sample()
+        return dict(self.peaks)
+
+
+# ---- 模拟会话 ----
+
+@dataclass
+class StageReport:
+    users: int
+    turns: int = 0
+    errors: int = 0
+    sql_executed: int = 0
+    repaired: int = 0
+    followups: int = 0
+    llm_calls: int = 0
+    wall_s: float = 0.0
+    throughput: float = 0.0
+    p50_s: float = 0.0
+    p90_s: float = 0.0
+    p99_s: float = 0.0
+    max_s: float = 0.0
+    rss_start_mb: float = 0.0
+    rss_end_mb: float = 0.0
+    rss_peak_mb: float = 0.0
+    store_peak_mb: float = 0.0
+    db_pool_peak: int = 0
+    jobs_queued_peak: int = 0
+    jobs_running_peak: int = 0
+    llm: Dict[str, int] = field(default_factory=dict)
+    error_samples: List[str] = field(default_factory=list)
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[min(98, max(0, int(q) - 1))]
+
+
+class Session:
+    def __init__(self, name: str, llm, engine, allowed, schema_context, upload: bytes, args):
+        from chat_turn import ChatState
+        from column_select import profile_columns
+        from datastore import STORE
+        from upload_loader import load_upload, stream_key
+        self.name = name
+        self.llm = llm
+        self.engine = engine
+        self.allowed = allowed
+        self.schema_context = schema_context
+        self.args = args
+        self.rng = random.Random(f"{args.seed}:{name}")
+        # 与应用相同的上传路径：按块哈希去重，流式解析
+        fh = io.BytesIO(upload)
+        key, _, _ = STORE.put(name, stream_key(fh), lambda: load_upload(fh, "loadtest.csv"), label="loadtest.csv")
+        self.state = ChatState(df=STORE.get(key, name),
+                               column_profile=STORE.derived(key, "column_profile", profile_columns))
+
+    def _submit(self, kind: str, fn, label: str):
+        if self.args.no_scheduler:
+            return fn()
+        from jobs import FAILED, SCHEDULER
+        job = SCHEDULER.submit(self.name, kind, lambda ctx: fn(), label=label)
+        job.wait()
+        if job.status == FAILED:
+            raise job.error
+        return job.result
+
+    def predict(self, prompt: str, label: str) -> str:
+        return self._submit("chat", lambda: self.llm.predict(prompt), label)
+
+    def run_sql(self, fn):
+        return self._submit("query", fn, "执行 SQL")
+
+    def turn(self, question: str):
+        from chat_turn import run_turn
+        return run_turn(self.state, question, self.predict, engine=self.engine, allowed_tables=self.allowed,
+                        schema_context=self.schema_context, table_candidates=sorted(self.allowed or []),
+                        llm=self.llm, run_sql=self.run_sql)
+
+
+def run_stage(users: int, args, engine, allowed, schema_context, upload: bytes, fake: FakeDashScope) -> StageReport:
+    from datastore import STORE
+    from qwen_llm import Qwen
+
+    report = StageReport(users=users)
+    latencies: List[float] = []
+    lock = threading.Lock()
+    monitor = Monitor(engine)
+    fake.stats.snapshot_and_reset()
+    report.rss_start_mb = rss_bytes() / 2**20
+    monitor.start()
+    barrier = threading.Barrier(users)
+
+    def user_loop(i: int):
+        name = f"loadtest-u{users}-{i}"
+        try:
+            session = Session(name, Qwen(model=args.model, api_key="loadtest", max_retries=args.llm_retries),
+                              engine, allowed, schema_context, upload, args)
+        except Exception as e:
+            with lock:
+                report.errors += args.turns
+                report.error_samples.append(f"{name} 初始化失败：{e!r}")
+            barrier.abort()
+            return
+        try:
+            barrier.wait()
+        except threading.BrokenBarrierError:
+            pass
+        for t in range(args.turns):
+            question = session.rng.choice(QUESTIONS)
+            start = time.time()
+            try:
+                res = session.turn(question)
+                failed = bool(res.error) or (res.reply or "").startswith(("[失败]", "[错误]"))
+                err = res.error or res.reply
+            except Exception as e:
+                res, failed, err = None, True, repr(e)
+            elapsed = time.time() - start
+            with lock:
+                latencies.append(elapsed)
+                report.turns += 1
+                if res is not None:
+                    report.llm_calls += res.llm_calls
+                    report.sql_executed += int(res.executed)
+                    report.repaired += int(res.repaired)
+                    report.followups += int(res.followup is not None)
+                if failed:
+                    report.errors += 1
+                    if len(report.error_samples) < 5:
+                        report.error_samples.append(f"{question} -> {str(err)[:200]}")
+            if t + 1 < args.turns and args.think_ms > 0:
+                time.sleep(session.rng.uniform(0.5, 1.5) * args.think_ms / 1000.0)
+        STORE.release(name)
+
+    started = time.time()
+    threads = [threading.Thread(target=user_loop, args=(i,), name=f"loadtest-user-{i}") for i in range(users)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    report.wall_s = time.time() - started
+    peaks = monitor.stop()
+
+    report.throughput = report.turns / report.wall_s if report.wall_s > 0 else 0.0
+    report.p50_s = percentile(latencies, 50)
+    report.p90_s = percentile(latencies, 90)
+    report.p99_s = percentile(latencies, 99)
+    report.max_s = max(latencies) if latencies else 0.0
+    report.rss_end_mb = rss_bytes() / 2**20
+    report.rss_peak_mb = peaks.get("rss_bytes", 0) / 2**20
+    report.store_peak_mb = peaks.get("store_bytes", 0) / 2**20
+    report.db_pool_peak = peaks.get("db_checked_out", 0)
+    report.jobs_queued_peak = peaks.get("jobs_queued", 0)
+    report.jobs_running_peak = peaks.get("jobs_running", 0)
+    report.llm = fake.stats.snapshot_and_reset()
+    return report
+
+
+def print_table(reports: List[StageReport]) -> None:
+    cols = [("users", "{:>5}"), ("turns", "{:>5}"), ("errors", "{:>6}"), ("sql", "{:>4}"), ("repaired", "{:>8}"),
+            ("followups", "{:>9}"), ("throughput", "{:>10.2f}"),
+            ("p50_s", "{:>6.2f}"), ("p90_s", "{:>6.2f}"), ("p99_s", "{:>6.2f}"),
+            ("llm_req", "{:>7}"), ("llm_peak", "{:>8}"), ("db_peak", "{:>7}"), ("q_peak", "{:>6}"),
+            ("rss_start", "{:>9.0f}"), ("rss_end", "{:>7.0f}"), ("rss_peak", "{:>8.0f}"), ("store_mb", "{:>8.1f}")]
+    print("  ".join(f"{name:>{len(fmt.format(0))}}" for name, fmt in cols))
+    for r in reports:
+        values = {**asdict(r), "sql": r.sql_executed, "llm_req": r.llm.get("llm_requests", 0), "llm_peak": r.llm.get("llm_peak_in_flight", 0),
+                  "db_peak": r.db_pool_peak, "q_peak": r.jobs_queued_peak, "rss_start": r.rss_start_mb,
+                  "rss_end": r.rss_end_mb, "rss_peak": r.rss_peak_mb, "store_mb": r.store_peak_mb}
+        print("  ".join(fmt.format(values[name]) for name, fmt in cols))
+    for r in reports:
+        for sample in r.error_samples:
+            print(f"[users={r.users}] 错误示例：{sample}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="多会话压测（假 DashScope + SQLite 替身）")
+    parser.add_argument("--users", default="1,5,10,25", help="逐级的并发用户数，逗号分隔")
+    parser.add_argument("--turns", type=int, default=5, help="每个用户的对话轮数")
+    parser.add_argument("--think-ms", type=float, default=500, help="两轮之间的平均思考时间")
+    parser.add_argument("--llm-latency-ms", type=float, default=800, help="假模型的平均响应延迟")
+    parser.add_argument("--llm-jitter-ms", type=float, default=300, help="假模型延迟的抖动范围（±）")
+    parser.add_argument("--fake-qps", type=float, default=0, help="假模型每秒最多接受的请求数，超出返回 429（0 不限）")
+    parser.add_argument("--bad-sql-rate", type=float, default=0.2, help="生成错误列名 SQL 的比例（触发自动修复）")
+    parser.add_argument("--llm-retries", type=int, default=3, help="模型调用重试次数")
+    parser.add_argument("--model", default="qwen-plus")
+    parser.add_argument("--db-rows", type=int, default=50_000, help="orders 表行数")
+    parser.add_argument("--db", default="", help="SQLite 文件路径（默认临时文件）")
+    parser.add_argument("--no-scheduler", action="store_true", help="不经作业调度器，直接在会话线程中调用")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", default="", help="把各级报告写入该 JSON 文件")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    # 追问分析经 analytibot.execute_code 执行，其导入时会创建默认模型客户端
+    if not os.getenv("DASHSCOPE_API_KEY"):
+        os.environ["DASHSCOPE_API_KEY"] = "loadtest"
+    levels = [int(x) for x in args.users.split(",") if x.strip()]
+
+    fake = FakeDashScope(args.llm_latency_ms, args.llm_jitter_ms, args.fake_qps, args.bad_sql_rate, args.seed)
+    base_url = fake.start()
+    os.environ["DASHSCOPE_HTTP_BASE_URL"] = base_url
+    import dashscope
+    dashscope.base_http_api_url = base_url   # SDK 在调用时读取，导入后赋值同样生效
+
+    from db import get_engine
+    from schema_index import get_schema_index
+    from sql_guard import build_allowlist
+
+    # 未指定 --db 时替身库放在临时目录，结束后连同目录删除
+    tmp_dir = None if args.db else tempfile.mkdtemp(prefix="analytibot_loadtest_")
+    db_path = args.db or os.path.join(tmp_dir, "loadtest.sqlite3")
+    engine = None
+    reports = []
+    try:
+        print(f"生成 SQLite 替身库 {db_path}（orders {args.db_rows} 行）…")
+        build_database(db_path, args.db_rows, args.seed)
+        engine = get_engine(f"sqlite:///{db_path}")
+        allowed = build_allowlist(["orders", "customers"])
+        index = get_schema_index(engine)
+
+        def schema_context(question: str) -> str:
+            return index.render(question, allowed_tables=allowed)
+
+        upload = upload_bytes(db_path)
+        for users in levels:
+            print(f"并发 {users} 个用户，每人 {args.turns} 轮…")
+            reports.append(run_stage(users, args, engine, allowed, schema_context, upload, fake))
+    finally:
+        fake.stop()
+        if engine is not None:
+            engine.dispose()   # 先关闭连接池中的连接，Windows 上才能删除数据库文件
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    print()
+    print_table(reports)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "stages": [asdict(r) for r in reports]}, f, ensure_ascii=False, indent=2)
+        print(f"报告已写入 {args.json}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
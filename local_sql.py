@@ -0,0 +1,112 @@
+# local_sql.py
+"""在上传的 DataFrame 上直接执行 SQL（嵌入式 DuckDB）。
+
+DuckDB 直接扫描内存中的 pandas/Arrow 缓冲区（不复制数据），group by / join
+为向量化多线程执行，在百万行级别的上传数据上明显快于逐行的 pandas 代码。
+上传数据在 SQL 中的表名固定为 `df`，与 pandas 分析代码中的变量名一致。
+
+LocalEngine 实现了 db.run_query 识别的 `execute_df` 接口，因此代价守卫、
+行数上限、自动修复等流程可以原样作用于本地数据。
+"""
+
+import logging
+import os
+import threading
+from typing import Optional
+
+import pandas as pd
+
+from sql_guard import check_select
+from tracing import span
+
+try:
+    import duckdb  # type: ignore
+except Exception:  # 可选依赖：未安装时本地 SQL 不可用，其余功能不受影响
+    duckdb = None
+
+logger = logging.getLogger(__name__)
+
+LOCAL_TABLE = "df"
+LOCAL_ALLOWLIST = frozenset({LOCAL_TABLE})
+DUCKDB_THREADS = int(os.getenv("ANALYTIBOT_DUCKDB_THREADS", "0"))  # 0 表示由 DuckDB 自行决定
+
+
+def available() -> bool:
+    return duckdb is not None
+
+
+class _Dialect:
+    name = "duckdb"
+
+
+class LocalEngine:
+    """把一个 DataFrame 包装成可执行只读 SQL 的“引擎”。"""
+
+    dialect = _Dialect()
+
+    def __init__(self, df: pd.DataFrame, table: str = LOCAL_TABLE, rollup=None):
+        if duckdb is None:
+            raise RuntimeError("未安装 duckdb，无法对上传数据执行 SQL（pip install duckdb）")
+        self.df = df
+        self.table = table
+        self.rollup = rollup
+        self._local = threading.local()
+
+    @property
+    def flight_key(self) -> str:
+        """并发合并（db.run_query）用的数据源标识：同一个 DataFrame 上的相同 SQL 可共享结果。"""
+        return f"duckdb:{id(self.df)}:{self.table}"
+
+    def _connection(self):
+        # DuckDB 连接不可跨线程共享：每个线程一个连接，注册同一个 DataFrame（零拷贝）
+        con = getattr(self._local, "con", None)
+        if con is None:
+            config = {"enable_external_access": False}
+            if DUCKDB_THREADS > 0:
+                config["threads"] = DUCKDB_THREADS
+            con = duckdb.connect(database=":memory:", config=config)
+            con.register(self.table, self.df)
+            self._local.con = con
+        return con
+
+    def execute_df(self, sql: str) -> pd.DataFrame:
+        # 简单的分组聚合先尝试用预聚合立方体回答（见 rollup.py），无需扫描原表
+        if self.rollup is not None:
+            res = self.rollup.answer_sql(sql, table=self.table)
+            if res is not None:
+                with span("sql_execute", source="rollup", rows_out=len(res)):
+                    return res
+        with span("sql_execute", source="local", rows_in=len(self.df)):
+            return self._connection().execute(sql).df()
+
+    def iter_batches(self, sql: str, batch_rows: int):
+        """按 Arrow RecordBatch 分批返回结果（pyarrow.RecordBatchReader），供导出等流式场景使用。"""
+        return self._connection().execute(sql).fetch_record_batch(batch_rows)
+
+
+def run_local_sql(df: pd.DataFrame, sql: str, rollup=None) -> pd.DataFrame:
+    """校验后在 DataFrame 上执行一条只读 SELECT（表名为 df）。"""
+    analysis = check_select(sql, LOCAL_ALLOWLIST)
+    if not analysis.ok:
+        raise ValueError("SQL 未通过安全校验：" + "；".join(analysis.errors))
+    return LocalEngine(df, rollup=rollup).execute_df(sql)
+
+
+def describe_local_table(df: pd.DataFrame, max_cols: int = 200) -> str:
+    """给 SQL 生成 prompt 用的表结构描述。"""
+    cols = [f"{c} {df[c].dtype}" for c in list(df.columns)[:max_cols]]
+    more = f" ...（共 {df.shape[1]} 列）" if df.shape[1] > max_cols else ""
+    return f"表 {LOCAL_TABLE}（{len(df)} 行）：" + ", ".join(cols) + more
+
+
+def build_local_sql_prompt(question: str, df: pd.DataFrame, current_time: Optional[str] = None) -> str:
+    """让模型为上传数据生成 DuckDB 方言的 SELECT。"""
+    prompt = ""
+    if current_time:
+        prompt += f"当前时间：{current_time}\n"
+    prompt += (
+        "请为下面的问题生成一条 DuckDB SQL 查询，只能使用表 df，只返回一条 SELECT，"
+        "不要解释、注释或分号。列名包含中文或特殊字符时用双引号括起来。\n"
+        f"{describe_local_table(df)}\n问题：{question}\nSQL："
+    )
+    return prompt
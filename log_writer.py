@@ -0,0 +1,181 @@
+# log_writer.py
+"""缓冲、非阻塞的日志写入器。
+
+调用方只负责把日志行放入队列（不做任何磁盘 I/O），由后台线程批量落盘，
+文件句柄在写入线程内保持打开，避免每条日志都重新打开文件；
+文件超过 max_bytes 时按 RotatingFileHandler 的方式滚动为 .1/.2/...。
+
+环境变量：
+- ANALYTIBOT_LOG_MAX_BYTES：单个日志文件上限（默认 10MB）
+- ANALYTIBOT_LOG_BACKUPS：保留的滚动文件个数（默认 3）
+- ANALYTIBOT_DEBUG：设为 1/true 时才采集 dir(response) 等详细快照
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = int(os.getenv("ANALYTIBOT_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+DEFAULT_BACKUPS = int(os.getenv("ANALYTIBOT_LOG_BACKUPS", "3"))
+
+
+def debug_enabled() -> bool:
+    """是否开启详细调试采集（开销较大的快照仅在此时生成）。"""
+    return os.getenv("ANALYTIBOT_DEBUG", "").strip().lower() in ("1", "true", "yes", "on")
+
+
+class BufferedLogWriter:
+    """基于队列的后台日志写入器（每个文件一个实例，线程安全）。"""
+
+    def __init__(self, path, flush_interval: float = 1.0, max_queue: int = 10000, batch_size: int = 500,
+                 max_bytes: int = DEFAULT_MAX_BYTES, backup_count: int = DEFAULT_BACKUPS):
+        self.path = Path(path)
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.dropped = 0
+        self._queue: "queue.Queue[Optional[str]]" = queue.Queue(maxsize=max_queue)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=f"log-writer:{self.path.name}", daemon=True)
+        self._thread.start()
+
+    def write(self, line: str) -> bool:
+        """非阻塞写入一行；队列已满时丢弃并计数，绝不阻塞请求路径。"""
+        if self._closed:
+            return False
+        try:
+            self._queue.put_nowait(line.rstrip("\n") + "\n")
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def log(self, event: str, **fields) -> bool:
+        """写入一条带事件名的结构化记录，例如 log("EXCEPTION", attempt=2, exc=...)。"""
+        fields["event"] = event
+        return self.write_json(fields)
+
+    def write_json(self, record: dict) -> bool:
+        """写入一条结构化（JSON 行）记录，自动补充 ts 字段。"""
+        record = dict(record)
+        record.setdefault("ts", datetime.utcnow().isoformat())
+        try:
+            line = json.dumps(record, ensure_ascii=False, default=str)
+        except Exception:
+            line = json.dumps({"ts": record.get("ts"), "unserializable": repr(record)}, ensure_ascii=False)
+        return self.write(line)
+
+    def flush(self, timeout: float = 5.0):
+        """等待队列中已有的日志全部落盘（主要用于退出前与调试）。"""
+        done = threading.Event()
+        try:
+            self._queue.put(done, timeout=timeout)  # type: ignore[arg-type]
+        except queue.Full:
+            return
+        done.wait(timeout)
+
+    def close(self, timeout: float = 5.0):
+        if self._closed:
+            return
+        self.flush(timeout)
+        self._closed = True
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+
+    def _run(self):
+        fh = None
+        size = 0
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            batch = []
+            events = []
+            stop = False
+            while True:
+                if item is None:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    events.append(item)
+                else:
+                    batch.append(item)
+                if stop or len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                try:
+                    if fh is None:
+                        self.path.parent.mkdir(parents=True, exist_ok=True)
+                        fh = self.path.open("a", encoding="utf-8")
+                        size = fh.tell()
+                    for line in batch:
+                        n = len(line.encode("utf-8"))
+                        if self.max_bytes > 0 and size > 0 and size + n > self.max_bytes:
+                            fh.close()
+                            self._rotate()
+                            fh = self.path.open("a", encoding="utf-8")
+                            size = 0
+                        fh.write(line)
+                        size += n
+                    fh.flush()
+                except Exception:
+                    logger.exception("无法写入日志文件 %s", self.path)
+                    fh = None
+            for ev in events:
+                ev.set()
+            if stop:
+                if fh is not None:
+                    fh.close()
+                return
+
+    def _rotate(self):
+        """log -> log.1 -> log.2 ...，超出 backup_count 的最旧文件被删除。"""
+        if self.backup_count <= 0:
+            self.path.unlink(missing_ok=True)
+            return
+        for i in range(self.backup_count - 1, 0, -1):
+            src = self.path.with_name(f"{self.path.name}.{i}")
+            if src.exists():
+                os.replace(src, self.path.with_name(f"{self.path.name}.{i + 1}"))
+        if self.path.exists():
+            os.replace(self.path, self.path.with_name(f"{self.path.name}.1"))
+
+
+_WRITERS: Dict[str, BufferedLogWriter] = {}
+_WRITERS_LOCK = threading.Lock()
+
+
+def get_writer(path) -> BufferedLogWriter:
+    """按路径返回共享的写入器实例（同一文件只会有一个后台线程）。"""
+    key = str(Path(path).resolve())
+    with _WRITERS_LOCK:
+        w = _WRITERS.get(key)
+        if w is None:
+            w = BufferedLogWriter(path)
+            _WRITERS[key] = w
+        return w
+
+
+@atexit.register
+def _close_all():
+    for w in list(_WRITERS.values()):
+        try:
+            w.close(timeout=2.0)
+        except Exception:
+            pass
@@ -0,0 +1,6 @@
+# pages/1_数据内存.py
+"""多页面应用中的“数据内存”页：共享数据集与各会话的内存占用（见 datastore.py）。"""
+
+from datastore import render_memory_page
+
+render_memory_page()
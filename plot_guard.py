@@ -0,0 +1,338 @@
+# plot_guard.py
+"""执行生成代码期间的绘图保护：数据量过大时在 matplotlib 层自动降采样/聚合。
+
+生成的代码经常直接对整列调用 plt.plot / plt.bar / plt.scatter，百万行数据会让
+matplotlib 渲染数十秒并产生巨大的图片。plot_guard() 期间拦截 Axes 上的对应方法
+（plt.* 最终都调用它们），并在 pandas 的 Series.plot / DataFrame.plot 入口先行缩减数据
+（否则 pandas 会在调用 Axes 之前逐行转换时间索引，耗时与行数成正比）：
+- 折线：LTTB（Largest-Triangle-Three-Buckets）降采样，保留峰谷形状；
+- 柱状：按类别汇总（sum）；类别仍过多时数值型按等宽分箱、其余取前 N 个；
+- 散点：按网格单元去重，每个有点的单元保留一个代表点（离群点不会丢失）。
+发生降采样时在图右下角注明原始数据量，并记录到 PlotGuardReport。
+"""
+
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+MAX_LINE_POINTS = int(os.getenv("ANALYTIBOT_PLOT_MAX_POINTS", "2000"))
+MAX_BARS = int(os.getenv("ANALYTIBOT_PLOT_MAX_BARS", "100"))
+MAX_SCATTER_POINTS = int(os.getenv("ANALYTIBOT_PLOT_MAX_SCATTER", "20000"))
+
+
+@dataclass
+class Reduction:
+    kind: str
+    original: int
+    shown: int
+    method: str
+
+    def describe(self) -> str:
+        return f"{self.kind}：{self.original:,} → {self.shown:,}（{self.method}）"
+
+
+@dataclass
+class PlotGuardReport:
+    reductions: List[Reduction] = field(default_factory=list)
+
+
+# ---------- 降采样算法 ----------
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """Largest-Triangle-Three-Buckets：返回保留点的下标（含首尾）。"""
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    every = (n - 2) / (n_out - 2)
+    idx = np.empty(n_out, dtype=np.int64)
+    idx[0], idx[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        nxt_end = min(int((i + 2) * every) + 1, n)
+        if end >= nxt_end:  # 最后一个桶：下一桶即终点
+            avg_x, avg_y = x[n - 1], y[n - 1]
+        else:
+            avg_x, avg_y = x[end:nxt_end].mean(), y[end:nxt_end].mean()
+        bx, by = x[start:end], y[start:end]
+        area = np.abs((x[a] - avg_x) * (by - y[a]) - (x[a] - bx) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        idx[i + 1] = a
+    return idx
+
+
+def _as_float(values) -> Optional[np.ndarray]:
+    arr = np.asarray(values)
+    if arr.ndim != 1:
+        return None
+    if np.issubdtype(arr.dtype, np.datetime64) or np.issubdtype(arr.dtype, np.timedelta64):
+        return arr.astype("int64").astype(float)
+    try:
+        return arr.astype(float)
+    except (TypeError, ValueError):
+        return None
+
+
+def _is_1d(v) -> bool:
+    return hasattr(v, "__len__") and not isinstance(v, str) and np.ndim(v) == 1
+
+
+def reduce_line(x, y, max_points: int = MAX_LINE_POINTS) -> Tuple[object, object, Optional[Reduction]]:
+    """x 为 None 时用 y 的索引（pandas）或位置作为横轴。"""
+    n = len(y)
+    if n <= max_points:
+        return x, y, None
+    y_num = _as_float(y)
+    if y_num is None:
+        return x, y, None
+    if x is None:
+        x_vals = np.asarray(y.index) if isinstance(y, pd.Series) else np.arange(n)
+    else:
+        x_vals = np.asarray(x)
+    x_num = _as_float(x_vals)
+    if x_num is None or len(x_num) != n:
+        x_num = np.arange(n, dtype=float)
+    finite = np.isfinite(y_num) & np.isfinite(x_num)
+    pos = np.flatnonzero(finite)
+    keep = pos[lttb_indices(x_num[pos], y_num[pos], max_points)]
+    return x_vals[keep], np.asarray(y)[keep], Reduction("折线", n, len(keep), "LTTB")
+
+
+def reduce_bars(x, height, max_bars: int = MAX_BARS) -> Tuple[object, object, Optional[Reduction]]:
+    n = len(x)
+    if n <= max_bars or not _is_1d(height) or len(height) != n:
+        return x, height, None
+    s = pd.Series(np.asarray(height), index=np.asarray(x))
+    if s.index.has_duplicates:
+        s = s.groupby(level=0, sort=True).sum()
+    method = "按类别汇总"
+    if len(s) > max_bars:
+        if _as_float(s.index.to_numpy()) is not None:
+            bins = pd.cut(s.index, bins=max_bars)
+            s = s.groupby(bins, observed=True).sum()
+            s.index = [iv.mid for iv in s.index]
+            method = f"等宽分箱 {max_bars} 组"
+        else:
+            s = s.nlargest(max_bars)
+            method = f"汇总后取前 {max_bars}"
+    return s.index.to_numpy(), s.to_numpy(), Reduction("柱状", n, len(s), method)
+
+
+def scatter_keep_indices(x, y, max_points: int = MAX_SCATTER_POINTS) -> Optional[np.ndarray]:
+    """网格单元去重：返回保留点下标；无法处理时返回 None。"""
+    xf, yf = _as_float(x), _as_float(y)
+    if xf is None or yf is None or len(xf) != len(yf):
+        return None
+    grid = max(2, int(np.sqrt(max_points)))
+    finite = np.isfinite(xf) & np.isfinite(yf)
+    pos = np.flatnonzero(finite)
+    xf, yf = xf[pos], yf[pos]
+    if not len(pos):
+        return pos
+
+    def _bin(v):
+        lo, hi = v.min(), v.max()
+        if hi <= lo:
+            return np.zeros(len(v), dtype=np.int64)
+        return np.minimum(((v - lo) / (hi - lo) * grid).astype(np.int64), grid - 1)
+
+    cells = _bin(xf) * grid + _bin(yf)
+    _, first = np.unique(cells, return_index=True)
+    return pos[np.sort(first)]
+
+
+# ---------- Axes 方法拦截 ----------
+
+_local = threading.local()
+_patch_lock = threading.Lock()
+_patch_depth = 0
+_originals: dict = {}
+
+
+def _report() -> Optional[PlotGuardReport]:
+    stack = getattr(_local, "reports", None)
+    return stack[-1] if stack else None
+
+
+def _note(ax, red: Reduction) -> None:
+    report = _report()
+    if report is not None:
+        report.reductions.append(red)
+    logger.info("绘图降采样 %s", red.describe())
+    notes = getattr(ax, "_analytibot_plot_notes", [])
+    notes.append(f"已降采样 {red.describe()}")
+    ax._analytibot_plot_notes = notes
+    old = getattr(ax, "_analytibot_plot_note_text", None)
+    if old is not None:
+        old.remove()
+    ax._analytibot_plot_note_text = ax.text(0.99, 0.01, "\n".join(notes), transform=ax.transAxes,
+                                            ha="right", va="bottom", fontsize=7, color="gray")
+
+
+def _guarded_plot(self, *args, **kwargs):
+    orig = _originals["plot"]
+    if "data" in kwargs or not args or len(args) > 3:
+        return orig(self, *args, **kwargs)
+    rest = list(args)
+    fmt = rest.pop() if isinstance(rest[-1], str) else None
+    if len(rest) == 1:
+        x, y = None, rest[0]
+    elif len(rest) == 2:
+        x, y = rest
+    else:
+        return orig(self, *args, **kwargs)
+    if not _is_1d(y) or (x is not None and (not _is_1d(x) or len(x) != len(y))):
+        return orig(self, *args, **kwargs)
+    nx, ny, red = reduce_line(x, y)
+    if red is None:
+        return orig(self, *args, **kwargs)
+    new_args = [nx, ny] + ([fmt] if fmt is not None else [])
+    artists = orig(self, *new_args, **kwargs)
+    _note(self, red)
+    return artists
+
+
+def _make_bar_guard(name: str):
+    def _guarded(self, x, height, *args, **kwargs):
+        orig = _originals[name]
+        # 与数据等长的数组参数（颜色、误差线等）无法随之汇总，此时不做处理
+        if not _is_1d(x) or any(_is_1d(v) and len(v) == len(x) for v in kwargs.values()):
+            return orig(self, x, height, *args, **kwargs)
+        nx, nh, red = reduce_bars(x, height)
+        if red is None:
+            return orig(self, x, height, *args, **kwargs)
+        container = orig(self, nx, nh, *args, **kwargs)
+        _note(self, red)
+        return container
+    return _guarded
+
+
+def _guarded_scatter(self, x, y, *args, **kwargs):
+    orig = _originals["scatter"]
+    if not _is_1d(x) or not _is_1d(y) or len(x) <= MAX_SCATTER_POINTS or "data" in kwargs:
+        return orig(self, x, y, *args, **kwargs)
+    keep = scatter_keep_indices(x, y)
+    if keep is None:
+        return orig(self, x, y, *args, **kwargs)
+    n = len(x)
+    # s / c 等与数据等长的参数按同样的下标取子集
+    args = [np.asarray(a)[keep] if _is_1d(a) and len(a) == n else a for a in args]
+    kwargs = {k: (np.asarray(v)[keep] if _is_1d(v) and len(v) == n else v) for k, v in kwargs.items()}
+    coll = orig(self, np.asarray(x)[keep], np.asarray(y)[keep], *args, **kwargs)
+    _note(self, Reduction("散点", n, len(keep), "网格去重"))
+    return coll
+
+
+def _x_values(data, x_col):
+    return data[x_col].to_numpy() if x_col is not None else np.asarray(data.index)
+
+
+def _reduce_pandas(data, kind: str, kwargs: dict):
+    """在 pandas 绘图入口缩减 Series/DataFrame；返回 (缩减后的数据, Reduction 或 None)。"""
+    n = len(data)
+    x_col = kwargs.get("x")
+    if kind == "line" and n > MAX_LINE_POINTS:
+        x_num = _as_float(_x_values(data, x_col))
+        if x_num is None:
+            x_num = np.arange(n, dtype=float)
+        if isinstance(data, pd.Series):
+            ys = [data]
+        else:
+            y_cols = kwargs.get("y") or [c for c in data.columns if c != x_col and data[c].dtype.kind in "iuf"]
+            ys = [data[c] for c in ([y_cols] if isinstance(y_cols, str) else y_cols)]
+        keep = set()
+        for y in ys:
+            y_num = _as_float(y)
+            if y_num is None:
+                return data, None
+            pos = np.flatnonzero(np.isfinite(y_num) & np.isfinite(x_num))
+            keep.update(pos[lttb_indices(x_num[pos], y_num[pos], MAX_LINE_POINTS)].tolist())
+        keep = np.array(sorted(keep), dtype=np.int64)
+        return data.iloc[keep], Reduction("折线", n, len(keep), "LTTB")
+    if kind in ("bar", "barh") and n > MAX_BARS and isinstance(data, pd.Series):
+        nx, nh, red = reduce_bars(data.index.to_numpy(), data.to_numpy())
+        if red is not None:
+            return pd.Series(nh, index=nx, name=data.name), red
+    if kind == "scatter" and n > MAX_SCATTER_POINTS and isinstance(data, pd.DataFrame):
+        x, y = kwargs.get("x"), kwargs.get("y")
+        if isinstance(x, str) and isinstance(y, str) and x in data and y in data:
+            keep = scatter_keep_indices(data[x].to_numpy(), data[y].to_numpy())
+            if keep is not None:
+                return data.iloc[keep], Reduction("散点", n, len(keep), "网格去重")
+    return data, None
+
+
+def _guarded_pandas_plot(self, *args, **kwargs):
+    orig = _originals["pandas_plot"]
+    # 只处理关键字调用（生成代码的常见写法）；位置参数的含义随 Series/DataFrame 不同，原样交给 pandas
+    if args:
+        return orig(self, *args, **kwargs)
+    data = self._parent
+    reduced, red = _reduce_pandas(data, kwargs.get("kind", "line"), kwargs)
+    if red is None:
+        return orig(self, **kwargs)
+    result = orig(type(self)(reduced), **kwargs)
+    ax = result if hasattr(result, "transAxes") else kwargs.get("ax")
+    if ax is None:
+        import matplotlib.pyplot as plt
+        ax = plt.gca()
+    _note(ax, red)
+    return result
+
+
+def _install() -> None:
+    from matplotlib.axes import Axes
+    from pandas.plotting import PlotAccessor
+    # 原方法只在首次安装时记录；卸载后仍保留（见 _uninstall），不会把拦截函数误记为原方法
+    current = dict(plot=Axes.plot, bar=Axes.bar, barh=Axes.barh, scatter=Axes.scatter,
+                   pandas_plot=PlotAccessor.__call__)
+    for name, fn in current.items():
+        _originals.setdefault(name, fn)
+    Axes.plot = _guarded_plot
+    Axes.bar = _make_bar_guard("bar")
+    Axes.barh = _make_bar_guard("barh")
+    Axes.scatter = _guarded_scatter
+    PlotAccessor.__call__ = _guarded_pandas_plot
+
+
+def _uninstall() -> None:
+    from matplotlib.axes import Axes
+    from pandas.plotting import PlotAccessor
+    # 不清空 _originals：其他线程可能仍在已拦截的方法内部（或持有拦截函数的引用），
+    # 它们之后查找原方法时不能 KeyError
+    PlotAccessor.__call__ = _originals["pandas_plot"]
+    for name, fn in _originals.items():
+        if name != "pandas_plot":
+            setattr(Axes, name, fn)
+
+
+@contextmanager
+def plot_guard():
+    """在上下文内拦截 Axes.plot/bar/barh/scatter 与 pandas 绘图入口；可嵌套，多线程共用一次安装。"""
+    global _patch_depth
+    with _patch_lock:
+        if _patch_depth == 0:
+            _install()
+        _patch_depth += 1
+    report = PlotGuardReport()
+    stack = getattr(_local, "reports", None)
+    if stack is None:
+        stack = _local.reports = []
+    stack.append(report)
+    try:
+        yield report
+    finally:
+        stack.pop()
+        with _patch_lock:
+            _patch_depth -= 1
+            if _patch_depth == 0:
+                _uninstall()
@@ -0,0 +1,312 @@
+# progressive.py
+"""大表上的渐进式分析：先在分层抽样上执行生成的代码并立即展示近似结果，全量结果在后台计算后替换。
+
+- 分层：按维度列（rollup 已识别的维度，否则用 rollup.detect_dimensions 在探测样本上识别）
+  中基数最小的至多 MAX_STRATA_DIMS 列分层；每层按相同比例伯努利抽样，并且每层至少保留一行，
+  小城市、小品类不会在近似结果里消失；
+- 缩放：代码只做求和/计数类聚合（sum、count、size、value_counts、len……）时，
+  结果中的聚合值列放大到全量量级；分组键（groupby/set_index 等引用的列）与分层列不缩放，
+  代码显式选出了聚合列（如 ['sales']、agg({...})）时，原表中的其他列也不缩放；含均值、比例等非可加运算时不缩放；
+  - 结果按分层列（或其中一部分）分组时，每组乘以该组的层权重（组内全量行数 ÷ 抽样行数），补抽的小层不会被放大过头；
+  - 结果按其他列分组且有补抽的层时，补抽行混在各组里无法单独加权，这些分组不缩放；
+  - 未分组的总计按整体抽样比例放大；
+- 图表：抽样执行时图表写到独立的临时文件，读回内存后删除，不与全量结果的图表文件冲突；
+- 只在行数超过 PROGRESSIVE_MIN_ROWS 且代码不使用 rollup（rollup 本身已是全量精确值）时启用。
+"""
+
+import ast
+import logging
+import os
+import tempfile
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from rollup import detect_dimensions
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+PROGRESSIVE_MIN_ROWS = int(os.getenv("ANALYTIBOT_PROGRESSIVE_MIN_ROWS", "1000000"))
+SAMPLE_ROWS = int(os.getenv("ANALYTIBOT_PROGRESSIVE_SAMPLE_ROWS", "100000"))
+MAX_STRATA_DIMS = 2
+PROBE_ROWS = 100_000   # 识别分层维度时使用的探测样本行数
+
+# 结果随数据量线性增长的聚合（可按抽样比例放大）与不随数据量变化的运算（均值、比例、分位数……）
+ADDITIVE_CALLS = frozenset({"sum", "count", "size", "value_counts", "cumsum", "len"})
+NON_ADDITIVE_CALLS = frozenset({"mean", "median", "std", "var", "min", "max", "quantile", "describe", "nunique",
+                                "corr", "cov", "pct_change", "rank", "div", "truediv", "apply", "transform",
+                                "pivot_table", "crosstab"})
+
+
+def should_sample(df: Optional[pd.DataFrame], code: str = "", min_rows: int = PROGRESSIVE_MIN_ROWS) -> bool:
+    """是否值得先抽样试算：行数足够多，且代码不直接使用 rollup。"""
+    return df is not None and len(df) > min_rows and "rollup" not in (code or "")
+
+
+def strata_columns(df: pd.DataFrame, rollup=None, max_dims: int = MAX_STRATA_DIMS) -> List[str]:
+    """分层维度：基数最小的至多 max_dims 个维度列（层数过多时每层样本太少）。"""
+    probe = df.sample(n=min(len(df), PROBE_ROWS), random_state=0) if len(df) > PROBE_ROWS else df
+    dims = [d for d in rollup.dims if d in df.columns] if rollup is not None else detect_dimensions(probe)
+    dims.sort(key=lambda d: probe[d].nunique(dropna=False))
+    return dims[:max_dims]
+
+
+@dataclass
+class SampleInfo:
+    rows: int
+    source_rows: int
+    strata: List[str] = field(default_factory=list)
+    n_strata: int = 1
+    topped_up: int = 0   # 伯努利抽样没抽到、补抽一行的层数
+    # 每层一行：分层列取值、全量行数 rows、抽样行数 sampled
+    counts: Optional[pd.DataFrame] = field(default=None, repr=False)
+
+    @property
+    def fraction(self) -> float:
+        return self.rows / self.source_rows if self.source_rows else 1.0
+
+    def describe(self) -> str:
+        text = f"基于 {self.rows} 行抽样（占全部 {self.source_rows} 行的 {self.fraction:.1%}"
+        if self.strata:
+            text += f"，按 {', '.join(map(str, self.strata))} 分 {self.n_strata} 层"
+        return text + "）"
+
+    def weights(self, cols: List[str]) -> pd.Series:
+        """按 cols（分层列的子集）分组的层权重：组内全量行数 ÷ 抽样行数，索引为 cols 的取值。"""
+        grouped = self.counts.groupby(cols, dropna=False)[["rows", "sampled"]].sum()
+        return grouped["rows"] / grouped["sampled"]
+
+
+def stratified_sample(df: pd.DataFrame, n: int = SAMPLE_ROWS, strata: Optional[List[str]] = None,
+                      seed: int = 0) -> Tuple[pd.DataFrame, SampleInfo]:
+    """按 strata 分层、各层同比例抽样约 n 行，每层至少一行；保持原有行顺序。"""
+    if len(df) <= n:
+        return df, SampleInfo(rows=len(df), source_rows=len(df))
+    rng = np.random.default_rng(seed)
+    u = rng.random(len(df))
+    keep = u < n / len(df)
+    n_strata, topped_up, counts = 1, 0, None
+    if strata:
+        # 各分层列 factorize 后合成层编号（比对象列 groupby 快得多）
+        groups = np.zeros(len(df), dtype=np.int64)
+        size = 1
+        levels = []
+        for col in strata:
+            codes, uniques = pd.factorize(df[col], use_na_sentinel=False)
+            groups = groups * len(uniques) + codes
+            size *= len(uniques)
+            levels.append(uniques)
+        rows = np.bincount(groups, minlength=size)
+        present = rows > 0
+        n_strata = int(present.sum())
+        # 伯努利抽样没抽到的层：各补上随机数最小的一行，保证每层至少被抽到一次
+        missing = present & (np.bincount(groups[keep], minlength=size) == 0)
+        topped_up = int(missing.sum())
+        if topped_up:
+            idx = np.flatnonzero(missing[groups])
+            idx = idx[np.lexsort((u[idx], groups[idx]))]
+            keep[idx[np.r_[True, groups[idx][1:] != groups[idx][:-1]]]] = True
+        # 由层编号还原各分层列的取值，记录每层的全量/抽样行数，供按层加权
+        ids = np.flatnonzero(present)
+        counts = {"rows": rows[ids], "sampled": np.bincount(groups[keep], minlength=size)[ids]}
+        for col, uniques in zip(reversed(strata), reversed(levels)):
+            ids, codes = np.divmod(ids, len(uniques))
+            counts[col] = np.asarray(uniques)[codes]
+        counts = pd.DataFrame(counts)[list(strata) + ["rows", "sampled"]]
+    sample = df.iloc[np.flatnonzero(keep)]
+    return sample, SampleInfo(rows=len(sample), source_rows=len(df), strata=list(strata or []), n_strata=n_strata,
+                              topped_up=topped_up, counts=counts)
+
+
+def _called_names(code: str) -> set:
+    """代码中调用的函数/方法名与字符串常量（agg('sum') 这类以字符串给出的聚合）；出现除法时加入 "div"。"""
+    names = set()
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return names
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            if isinstance(node.func, ast.Attribute):
+                names.add(node.func.attr)
+            elif isinstance(node.func, ast.Name):
+                names.add(node.func.id)
+        elif isinstance(node, ast.Constant) and isinstance(node.value, str):
+            names.add(node.value)
+        elif isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Div, ast.FloorDiv)):
+            names.add("div")
+    return names
+
+
+# 参数为分组键的方法及关键字
+KEY_METHODS = frozenset({"groupby", "set_index", "pivot", "pivot_table", "resample", "Grouper"})
+KEY_KEYWORDS = frozenset({"by", "level", "index", "columns", "key", "on"})
+GROUPED_METHODS = frozenset({"groupby", "resample"})
+
+
+def _strings(node) -> List[str]:
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return [node.value]
+    if isinstance(node, (ast.List, ast.Tuple)):
+        return [e.value for e in node.elts if isinstance(e, ast.Constant) and isinstance(e.value, str)]
+    return []
+
+
+def column_roles(code: str) -> Tuple[set, set]:
+    """从代码中解析 (分组键列, 显式聚合列)。
+
+    分组键：groupby('月份')、groupby(by=[...])、set_index、pd.Grouper(key=...) 等的字符串参数；
+    聚合列：分组对象上选出的列（groupby(...)['销售额']）、agg({'销售额': 'sum'}) 的键与 agg(总额=...) 的新列名。
+    """
+    keys, targets = set(), set()
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return keys, targets
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            name = node.func.attr if isinstance(node.func, ast.Attribute) else getattr(node.func, "id", "")
+            if name in KEY_METHODS:
+                for arg in node.args[:1]:
+                    keys.update(_strings(arg))
+                for kw in node.keywords:
+                    if kw.arg in KEY_KEYWORDS:
+                        keys.update(_strings(kw.value))
+            elif name in ("agg", "aggregate"):
+                for arg in node.args[:1]:
+                    if isinstance(arg, ast.Dict):
+                        targets.update(k.value for k in arg.keys if isinstance(k, ast.Constant))
+                targets.update(kw.arg for kw in node.keywords if kw.arg)
+        elif isinstance(node, ast.Subscript):
+            base = node.value
+            if (isinstance(base, ast.Call) and isinstance(base.func, ast.Attribute)
+                    and base.func.attr in GROUPED_METHODS):
+                targets.update(_strings(node.slice))
+    return {str(k) for k in keys}, {str(t) for t in targets}
+
+
+def is_additive(code: str) -> bool:
+    """代码中的聚合是否全部可按抽样比例放大：有求和/计数类调用，且没有均值、比例、分位数等。"""
+    names = _called_names(code)
+    return bool(names & ADDITIVE_CALLS) and not (names & NON_ADDITIVE_CALLS)
+
+
+def scale_result(result: Any, factor: Any, keep: Optional[List[str]] = None) -> Any:
+    """数值结果乘以 factor；keep 中的列（分组键、分层维度等）不缩放。
+
+    factor 也可以是与 DataFrame/Series 等长的数组，逐行乘以各自的权重。
+    """
+    keep = set(map(str, keep or []))
+    if isinstance(result, pd.DataFrame):
+        out = result.copy()
+        for col in out.columns:
+            if str(col) not in keep and out[col].dtype.kind in "iuf":
+                out[col] = out[col] * factor
+        return out
+    if isinstance(result, pd.Series):
+        return result * factor if result.dtype.kind in "iuf" else result
+    if isinstance(result, (int, float, np.integer, np.floating)) and not isinstance(result, bool):
+        return result * factor
+    if isinstance(result, dict):
+        return {k: scale_result(v, factor, list(keep)) for k, v in result.items()}
+    return result
+
+
+def _key_columns(result: Any, keys: set) -> List[str]:
+    """结果中的分组键：有名字的索引层，以及 DataFrame 中代码引用的分组键列和非数值列。"""
+    names = [str(n) for n in result.index.names if n is not None]
+    if isinstance(result, pd.DataFrame):
+        names += [str(c) for c in result.columns if str(c) in keys or result[c].dtype.kind not in "iufb"]
+    return names
+
+
+def _key_values(result: Any, col: str) -> np.ndarray:
+    if isinstance(result, pd.DataFrame) and col in map(str, result.columns):
+        return result[[c for c in result.columns if str(c) == col][0]].to_numpy()
+    return result.index.get_level_values([str(n) for n in result.index.names].index(col)).to_numpy()
+
+
+def weigh_result(result: Any, info: SampleInfo, keep: set, keys: set) -> Tuple[Any, str]:
+    """把抽样上的可加聚合结果放大到全量量级，返回 (结果, 方式)。
+
+    方式为 "strata"（按层权重逐组放大）、"global"（按整体抽样比例放大）或 ""（未放大）。
+    """
+    if isinstance(result, dict):
+        items = {k: weigh_result(v, info, keep, keys) for k, v in result.items()}
+        modes = {m for _, m in items.values() if m}
+        return {k: v for k, (v, _) in items.items()}, ("strata" if "strata" in modes else "global" if modes else "")
+    if isinstance(result, (pd.DataFrame, pd.Series)) and info.counts is not None:
+        present = _key_columns(result, keys)
+        cols = [c for c in info.strata if str(c) in present]
+        if cols:
+            # 按分层列分组：每组乘以该组的层权重；对不上的组（如代码新造的取值）不缩放
+            weights = info.weights(cols)
+            if len(cols) == 1:
+                index = pd.Index(_key_values(result, str(cols[0])))
+            else:
+                index = pd.MultiIndex.from_arrays([_key_values(result, str(c)) for c in cols])
+            factor = weights.reindex(index).fillna(1.0).to_numpy()
+            return scale_result(result, factor, keep=sorted(keep)), "strata"
+        if info.topped_up and (present or keys):
+            # 按其他列分组：补抽的行混在各组中，整体比例会把它们放大过头，这些分组不缩放
+            return result, ""
+    return scale_result(result, 1 / info.fraction, keep=sorted(keep)), "global"
+
+
+@dataclass
+class ApproxResult:
+    result: Any = None
+    plot: Optional[bytes] = None
+    info: Optional[SampleInfo] = None
+    scaled: bool = False
+    weighting: str = ""   # "strata"：按层权重放大；"global"：按整体抽样比例放大
+    error: str = ""
+
+    def describe(self) -> str:
+        """近似结果的标注文字。"""
+        text = f"近似结果：{self.info.describe()}" if self.info is not None else "近似结果"
+        if self.weighting == "strata":
+            text += "，求和/计数已按各层抽样比例分别放大"
+        elif self.scaled:
+            text += f"，求和/计数已按抽样比例放大约 {1 / self.info.fraction:.0f} 倍"
+        return text + "；精确结果正在后台计算，完成后自动替换。"
+
+
+def run_on_sample(code: str, df: pd.DataFrame, plot_file: str = "output_plot.png", rollup=None,
+                  sample_rows: int = SAMPLE_ROWS) -> ApproxResult:
+    """在分层抽样上执行分析代码，返回近似结果（图表读入内存）。"""
+    # 延迟导入：analytibot 在导入时创建默认的模型客户端
+    from analytibot import execute_code
+    out = ApproxResult()
+    with span("progressive_sample", rows=len(df)) as sp:
+        strata = strata_columns(df, rollup)
+        sample, out.info = stratified_sample(df, sample_rows, strata)
+        tmp_plot = os.path.join(tempfile.gettempdir(), f"analytibot_sample_{uuid.uuid4().hex}.png").replace("\\", "/")
+        # 生成的代码里图表路径是字面量：抽样执行时换成临时文件，不覆盖全量结果的图表
+        sample_code = code.replace(plot_file, tmp_plot) if plot_file else code
+        try:
+            result, _ = execute_code(sample_code, sample)
+        finally:
+            if os.path.exists(tmp_plot):
+                with open(tmp_plot, "rb") as f:
+                    out.plot = f.read()
+                os.remove(tmp_plot)
+        if isinstance(result, str) and result.startswith("⚠️"):
+            out.error = result
+            sp["status"] = "failed"
+            return out
+        if out.info.fraction < 1 and is_additive(code):
+            keys, targets = column_roles(code)
+            keep = set(map(str, strata)) | keys
+            if targets:
+                # 已知聚合列时，原表中的其他列（如 groupby(df['日期'].dt.month) 产生的键）一律不缩放
+                keep |= {str(c) for c in df.columns} - targets
+            result, out.weighting = weigh_result(result, out.info, keep, keys)
+            out.scaled = bool(out.weighting)
+        out.result = result
+        sp.update(sample_rows=out.info.rows, strata=strata, n_strata=out.info.n_strata, scaled=out.scaled)
+    return out
@@ -0,0 +1,178 @@
+# prompt_budget.py
+"""按 token 预算组装 prompt。
+
+各个 prompt（分析代码、意图判断、SQL 生成、SQL 修复、对话回复）都由若干段组成：
+指令、问题、表结构、数据摘要、执行结果、对话历史……每段带一个优先级。
+fit() 先按各段自身上限截断，总量仍超过预算时从优先级最低的段开始裁剪
+（对话历史保留最近的部分，其余保留开头），必需段（REQUIRED）不裁剪。
+每次组装记录一个 prompt_budget span（各段 token 数与被裁剪的段），
+请求大小与延迟因此可预期，不会因超长被上游拒绝。
+
+token 数为本地近似：中文及全角字符按 1 个 token，英文单词约 4 个字母 1 个 token，
+数字约 3 位 1 个 token，其余符号各 1 个；对通义千问的分词略偏保守。
+"""
+
+import logging
+import math
+import os
+import re
+from dataclasses import dataclass, field, replace
+from typing import Dict, List, Optional
+
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+PROMPT_BUDGET_TOKENS = int(os.getenv("ANALYTIBOT_PROMPT_BUDGET_TOKENS", "6000"))
+
+# 优先级：数值越大越晚被裁剪
+REQUIRED = 100      # 指令、用户问题、待修复的 SQL：从不裁剪
+SCHEMA = 70         # 列名 / 表结构
+DATA_SUMMARY = 50   # 数据摘要、样例行
+RESULT = 40         # 上次执行结果、探测结果
+HISTORY = 30        # 对话历史
+
+MIN_SECTION_TOKENS = 20   # 裁剪后不足该值的段直接省略
+TRUNCATED = "…（已截断）"
+
+_TOKEN_RE = re.compile(r"[\u2e80-\u9fff\u3000-\u303f\uff00-\uffef]|[A-Za-z]+|\d+|\S")
+
+
+def count_tokens(text: str) -> int:
+    """近似 token 数（见模块说明）。"""
+    n = 0
+    for m in _TOKEN_RE.finditer(text or ""):
+        tok = m.group()
+        if len(tok) == 1:
+            n += 1
+        elif tok[0].isdigit():
+            n += math.ceil(len(tok) / 3)
+        else:
+            n += math.ceil(len(tok) / 4)
+    return n
+
+
+def _cut_chars(line: str, max_tokens: int, keep: str) -> str:
+    """在单行内二分查找能放下的最长前缀（keep=head）或后缀（keep=tail）。"""
+    lo, hi = 0, len(line)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        part = line[:mid] if keep == "head" else line[len(line) - mid:]
+        if count_tokens(part) <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    return line[:lo] if keep == "head" else line[len(line) - lo:]
+
+
+def truncate_tokens(text: str, max_tokens: int, keep: str = "head") -> str:
+    """截断到 max_tokens 以内，尽量在行边界截断并加上截断标记。
+
+    keep="head" 保留开头（说明、表结构），keep="tail" 保留结尾（对话历史保留最近的消息）。
+    """
+    if count_tokens(text) <= max_tokens:
+        return text
+    room = max_tokens - count_tokens(TRUNCATED)
+    if room <= 0:
+        return ""
+    lines = text.splitlines(keepends=True)
+    if keep == "tail":
+        lines.reverse()
+    kept: List[str] = []
+    used = 0
+    for line in lines:
+        cost = count_tokens(line)
+        if used + cost > room:
+            if not kept:
+                kept.append(_cut_chars(line, room, keep))
+            break
+        kept.append(line)
+        used += cost
+    if keep == "tail":
+        kept.reverse()
+        return TRUNCATED + "\n" + "".join(kept)
+    body = "".join(kept)
+    return body + ("" if body.endswith("\n") else "\n") + TRUNCATED + "\n"
+
+
+@dataclass
+class Section:
+    name: str
+    text: str
+    priority: int = REQUIRED
+    max_tokens: Optional[int] = None   # 本段自身上限（不论总量是否超预算）
+    keep: str = "head"                 # 裁剪时保留开头或结尾
+    tokens: int = 0
+
+
+@dataclass
+class FittedPrompt:
+    name: str
+    sections: List[Section]
+    budget: int
+    overhead_tokens: int = 0
+    trimmed: List[str] = field(default_factory=list)
+
+    @property
+    def tokens(self) -> int:
+        return self.overhead_tokens + sum(s.tokens for s in self.sections)
+
+    @property
+    def text(self) -> str:
+        """按原顺序拼接各段。"""
+        return "".join(s.text for s in self.sections)
+
+    @property
+    def values(self) -> Dict[str, str]:
+        """各段裁剪后的文本（用于填充模板变量）。"""
+        return {s.name: s.text for s in self.sections}
+
+
+def fit(sections: List[Section], budget: int = PROMPT_BUDGET_TOKENS, name: str = "prompt",
+        overhead: str = "") -> FittedPrompt:
+    """按预算裁剪各段。overhead 为模板中固定文本（只计数，不裁剪）。"""
+    secs = [replace(s, text=s.text or "") for s in sections]
+    result = FittedPrompt(name=name, sections=secs, budget=budget, overhead_tokens=count_tokens(overhead))
+    for s in secs:
+        s.tokens = count_tokens(s.text)
+        if s.priority < REQUIRED and s.max_tokens is not None and s.tokens > s.max_tokens:
+            s.text = truncate_tokens(s.text, s.max_tokens, s.keep)
+            s.tokens = count_tokens(s.text)
+            result.trimmed.append(s.name)
+    # 从优先级最低的段开始裁剪；同优先级时后面的段先裁剪
+    order = sorted((i for i, s in enumerate(secs) if s.priority < REQUIRED), key=lambda i: (secs[i].priority, -i))
+    for i in order:
+        excess = result.tokens - budget
+        if excess <= 0:
+            break
+        s = secs[i]
+        target = s.tokens - excess
+        s.text = truncate_tokens(s.text, target, s.keep) if target >= MIN_SECTION_TOKENS else ""
+        s.tokens = count_tokens(s.text)
+        if s.name not in result.trimmed:
+            result.trimmed.append(s.name)
+    with span("prompt_budget", prompt=name, budget=budget, tokens=result.tokens,
+              sections={s.name: s.tokens for s in secs}, trimmed=result.trimmed) as sp:
+        if result.tokens > budget:
+            # 必需段本身已超预算：照常发送，但记录下来便于调整预算或指令
+            sp["status"] = "over_budget"
+            logger.warning("prompt %s 的必需部分约 %d tokens，超过预算 %d", name, result.tokens, budget)
+    return result
+
+
+_PLACEHOLDER = re.compile(r"\{(\w+)\}")
+
+
+def fit_template(template: str, sections: List[Section], budget: int = PROMPT_BUDGET_TOKENS,
+                 name: str = "prompt") -> FittedPrompt:
+    """模板（str.format / PromptTemplate 风格）的变量按预算裁剪，固定文本计入开销。
+
+    模板中出现多次的变量按出现次数计入开销。
+    """
+    counts: Dict[str, int] = {}
+    for m in _PLACEHOLDER.finditer(template):
+        counts[m.group(1)] = counts.get(m.group(1), 0) + 1
+    overhead = _PLACEHOLDER.sub("", template)
+    # 多次出现的变量：多出的次数按原文计入固定开销
+    extra = "".join(s.text * (counts.get(s.name, 1) - 1) for s in sections)
+    return fit(sections, budget=budget, name=name, overhead=overhead + extra)
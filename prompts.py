@@ -14,7 +14,7 @@ DATA_ANALYSIS_PROMPT = """
 6. 避免使用未导入的库。
 
 📊 数据列名：{columns}
-
+{hints}
 🕒 当前时间：{current_time}
 
 ❓ 用户问题：{question}
@@ -39,15 +39,34 @@ plt.savefig('{plot_file}')
 """.strip()
 
 
-def build_analysis_prompt(columns: str, question: str, plot_file: str) -> str:
+def fit_analysis_inputs(columns: str, question: str, plot_file: str, current_time: str, hints: str = ""):
+   """按 token 预算裁剪分析 prompt 的各个变量（见 prompt_budget.py），返回 FittedPrompt。
+
+   问题、图片路径、时间不裁剪；超预算时先裁剪补充说明 hints，再裁剪列名。
+   """
+   from prompt_budget import DATA_SUMMARY, SCHEMA, Section, fit_template
+   sections = [
+      Section("columns", columns, SCHEMA),
+      Section("hints", hints, DATA_SUMMARY),
+      Section("current_time", current_time),
+      Section("question", question),
+      Section("plot_file", plot_file),
+   ]
+   return fit_template(DATA_ANALYSIS_PROMPT, sections, name="analysis")
+
+
+def build_analysis_prompt(columns: str, question: str, plot_file: str, hints: str = "") -> str:
    """返回填充了当前时间的分析 prompt 字符串。
 
+   hints 为可选的补充说明（如可用的预聚合 rollup），为空时不占用额外内容。
+
    使用示例：
       prompt = build_analysis_prompt(columns, question, plot_file)
    """
    from datetime import datetime
    current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-   return DATA_ANALYSIS_PROMPT.format(columns=columns, question=question, plot_file=plot_file, current_time=current_time)
+   fitted = fit_analysis_inputs(columns, question, plot_file, current_time, hints)
+   return DATA_ANALYSIS_PROMPT.format(**fitted.values)
 
 # 兼容旧命名：
 ANALYSIS_PROMPT = DATA_ANALYSIS_PROMPT
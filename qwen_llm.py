@@ -8,8 +8,14 @@ from dashscope import Generation as DashGen
 import os
 import logging
 import asyncio
+import time
 from pathlib import Path
-from datetime import datetime
+
+from log_writer import debug_enabled, get_writer
+from prompt_budget import count_tokens
+from rate_limit import INTERACTIVE, OUTPUT_TOKENS_ESTIMATE, RateLimited, get_limiter, scope_for
+from singleflight import LLM_FLIGHT, flight_key, normalize_prompt
+from tracing import span
 
 # 尝试从本地 config.py 读取 API Key（若存在），优先使用本地配置
 try:
@@ -22,14 +28,50 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 _DEBUG_LOG = Path("qwen_debug.log")
 
-def _write_debug_log(entry: str):
+
+def _write_debug_log(event: str, **fields):
+    """写入结构化调试记录（仅入队，由后台线程批量落盘并按大小滚动）。"""
     try:
-        _DEBUG_LOG.parent.mkdir(parents=True, exist_ok=True)
-        with _DEBUG_LOG.open("a", encoding="utf-8") as f:
-            f.write(f"[{datetime.utcnow().isoformat()}] {entry}\n")
+        get_writer(_DEBUG_LOG).log(event, **fields)
     except Exception:
         logger.exception("无法写入 debug 日志")
 
+
+def _usage_tokens(response) -> Optional[int]:
+    """响应中的实际 token 用量（input + output），取不到时返回 None。"""
+    usage = getattr(response, "usage", None)
+    if usage is None and isinstance(response, dict):
+        usage = response.get("usage")
+    if usage is None:
+        return None
+    def _get(k):
+        v = getattr(usage, k, None)
+        if v is None and isinstance(usage, dict):
+            v = usage.get(k)
+        return v
+    total = _get("total_tokens")
+    if total is None and _get("input_tokens") is not None:
+        total = (_get("input_tokens") or 0) + (_get("output_tokens") or 0)
+    try:
+        return int(total) if total is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _is_throttled(response) -> bool:
+    code = str(getattr(response, "code", "") or "")
+    return getattr(response, "status_code", None) == 429 or code.startswith("Throttling")
+
+
+def _response_attrs(response) -> Optional[list]:
+    """dir(response) 开销不小，仅在 ANALYTIBOT_DEBUG 开启时采集。"""
+    if not debug_enabled():
+        return None
+    try:
+        return list(dir(response))
+    except Exception:
+        return None
+
 class Qwen(BaseLanguageModel):
     """
     通义千问模型封装，兼容 LangChain 接口
@@ -39,6 +81,8 @@ class Qwen(BaseLanguageModel):
     temperature: float = 0.2
     max_retries: int = 3
     api_key: Optional[str] = None
+    # 限流优先级（见 rate_limit.py）：对话为 interactive，批处理脚本可设为 batch
+    priority: str = os.getenv("ANALYTIBOT_LLM_PRIORITY", INTERACTIVE)
 
     def __init__(
         self,
@@ -46,12 +90,15 @@ class Qwen(BaseLanguageModel):
         temperature: float = 0.2,
         max_retries: int = 3,
         api_key: str = None,
+        priority: Optional[str] = None,
         **kwargs
     ):
         super().__init__(**kwargs)
         self.model_name = model
         self.temperature = temperature
         self.max_retries = max_retries
+        if priority:
+            self.priority = priority
         # 优先级：api 参数 > config.py 中的 CONFIG_API_KEY > 环境变量
         self.api_key = api_key or CONFIG_API_KEY or os.getenv("DASHSCOPE_API_KEY")
 
@@ -64,7 +111,22 @@ class Qwen(BaseLanguageModel):
         dashscope.api_key = self.api_key
 
     def _call(self, prompt: str, **kwargs) -> str:
-        """调用 Qwen 模型生成响应"""
+        """调用 Qwen 模型生成响应（整体耗时记为 llm_call 阶段）
+
+        相同模型参数（含 API Key 与 stop 等调用参数）与 prompt 的并发调用会被合并：
+        只有一个真正请求接口，其余等待并共享结果。
+        """
+        with span("llm_call", model=self.model_name, prompt_chars=len(prompt or ""),
+                  prompt_tokens=count_tokens(prompt)) as sp:
+            key = flight_key(self.model_name, self.temperature, self.api_key, repr(sorted(kwargs.items())),
+                             normalize_prompt(prompt))
+            text, shared = LLM_FLIGHT.do(key, lambda: self._call_with_retries(prompt, **kwargs))
+            sp["coalesced"] = shared
+            if text.startswith(("[失败]", "[错误]")):
+                sp["status"] = "failed"
+            return text
+
+    def _call_with_retries(self, prompt: str, **kwargs) -> str:
         # 校验 prompt，避免将空内容发给远端接口导致不明确的错误
         if not prompt or (isinstance(prompt, str) and prompt.strip() == ""):
             logger.error("调用异常: prompt 为空")
@@ -77,98 +139,125 @@ class Qwen(BaseLanguageModel):
         ]
 
         last_exc = None
+        limiter = get_limiter()
+        scope = scope_for(self.api_key)
+        estimate = count_tokens(prompt) + OUTPUT_TOKENS_ESTIMATE
         for attempt in range(self.max_retries):
             for variant in call_variants:
-                try:
-                    # 仅传入明确支持的简单参数，避免透传 LangChain 的复杂对象（如 CallbackManager）
-                    call_kwargs = {
-                        "model": self.model_name,
-                        "temperature": self.temperature,
-                    }
-                    call_kwargs.update(variant)
-
-                    # 清洗 call_kwargs：移除不可序列化或明显为运行时回调管理器的字段
-                    def _is_simple(v):
-                        if v is None:
-                            return True
-                        if isinstance(v, (str, int, float, bool)):
-                            return True
-                        if isinstance(v, (list, tuple)):
-                            return all(_is_simple(x) for x in v)
-                        if isinstance(v, dict):
-                            return all(isinstance(k, (str, int)) and _is_simple(val) for k, val in v.items())
-                        return False
-
-                    safe_kwargs = {}
-                    for k, v in call_kwargs.items():
-                        if _is_simple(v):
-                            safe_kwargs[k] = v
-                        else:
-                            _write_debug_log(f"DROP_UNSERIALIZABLE key={k} type={type(v)}")
-
-                    # 如果 API Key 含非 ASCII，记录并告警（可能导致 header 编码错误）
+                with span("llm_attempt", model=self.model_name, attempt=attempt + 1,
+                          variant="+".join(variant.keys())) as sp:
                     try:
-                        if isinstance(self.api_key, str) and not all(ord(c) < 128 for c in self.api_key):
-                            _write_debug_log("WARNING non-ascii API key detected; header encoding may fail")
-                    except Exception:
-                        pass
+                        # 仅传入明确支持的简单参数，避免透传 LangChain 的复杂对象（如 CallbackManager）
+                        call_kwargs = {
+                            "model": self.model_name,
+                            "temperature": self.temperature,
+                        }
+                        call_kwargs.update(variant)
+
+                        # 清洗 call_kwargs：移除不可序列化或明显为运行时回调管理器的字段
+                        def _is_simple(v):
+                            if v is None:
+                                return True
+                            if isinstance(v, (str, int, float, bool)):
+                                return True
+                            if isinstance(v, (list, tuple)):
+                                return all(_is_simple(x) for x in v)
+                            if isinstance(v, dict):
+                                return all(isinstance(k, (str, int)) and _is_simple(val) for k, val in v.items())
+                            return False
 
-                    response = DashGen.call(**safe_kwargs)
+                        safe_kwargs = {}
+                        for k, v in call_kwargs.items():
+                            if _is_simple(v):
+                                safe_kwargs[k] = v
+                            else:
+                                _write_debug_log("DROP_UNSERIALIZABLE", key=k, type=str(type(v)))
 
-                    # 解析返回：优先依据 docs 中的 output.choices[].message.content
-                    content = None
-                    output = getattr(response, "output", None)
-                    if output is not None:
+                        # 如果 API Key 含非 ASCII，记录并告警（可能导致 header 编码错误）
                         try:
-                            choices = getattr(output, "choices", None)
-                            if choices and len(choices) > 0:
-                                first = choices[0]
-                                # 支持属性和 dict 两种访问方式
-                                msg = getattr(first, "message", None) or (first.get("message") if isinstance(first, dict) else None)
-                                if msg is not None:
-                                    content = getattr(msg, "content", None) or (msg.get("content") if isinstance(msg, dict) else None)
+                            if isinstance(self.api_key, str) and not all(ord(c) < 128 for c in self.api_key):
+                                _write_debug_log("WARNING", message="non-ascii API key detected; header encoding may fail")
                         except Exception:
-                            content = None
+                            pass
 
-                        if not content:
-                            # fallback to output.text
+                        # 每次真正发出请求前取令牌（跨进程共享配额）
+                        lease = limiter.acquire(scope, estimate, self.priority) if limiter else None
+                        response = DashGen.call(**safe_kwargs)
+                        if lease is not None:
+                            limiter.settle(lease, _usage_tokens(response))
+
+                        # 解析返回：优先依据 docs 中的 output.choices[].message.content
+                        content = None
+                        output = getattr(response, "output", None)
+                        if output is not None:
                             try:
-                                content = getattr(output, "text", None) or (output.get("text") if isinstance(output, dict) else None)
+                                choices = getattr(output, "choices", None)
+                                if choices and len(choices) > 0:
+                                    first = choices[0]
+                                    # 支持属性和 dict 两种访问方式
+                                    msg = getattr(first, "message", None) or (first.get("message") if isinstance(first, dict) else None)
+                                    if msg is not None:
+                                        content = getattr(msg, "content", None) or (msg.get("content") if isinstance(msg, dict) else None)
                             except Exception:
                                 content = None
 
-                    # 其它可能的字段
-                    if not content:
-                        content = getattr(response, "text", None) or (response.get("text") if isinstance(response, dict) else None)
+                            if not content:
+                                # fallback to output.text
+                                try:
+                                    content = getattr(output, "text", None) or (output.get("text") if isinstance(output, dict) else None)
+                                except Exception:
+                                    content = None
+
+                        # 其它可能的字段
+                        if not content:
+                            # SDK 的响应对象是 dict，缺少的属性抛 KeyError 而不是 AttributeError
+                            # （例如 429 限流响应没有 text），不能让它跳过下面的限流处理
+                            try:
+                                content = getattr(response, "text", None)
+                            except KeyError:
+                                content = None
+                            content = content or (response.get("text") if isinstance(response, dict) else None)
 
-                    if content:
-                        content = content.strip()
                         if content:
-                            return content
+                            content = content.strip()
+                            if content:
+                                return content
+                            else:
+                                logger.warning("模型返回空内容（空字符串）")
+                                sp["status"] = "empty"
+                                return "[错误] 模型返回空内容"
                         else:
-                            logger.warning("模型返回空内容（空字符串）")
-                            return "[错误] 模型返回空内容"
-                    else:
-                        # 记录响应属性快照以便调试
-                        try:
-                            attrs = list(dir(response))
-                        except Exception:
-                            attrs = []
-                        logger.warning(f"第 {attempt + 1} 次调用，variant={list(variant.keys())} 未解析到 content；response attrs: {attrs}")
-                        _write_debug_log(f"NON200 variant={list(variant.keys())} attempt={attempt+1} resp_attrs={attrs}")
-                        last_exc = f"no_content variant={list(variant.keys())}"
-                except Exception as e:
-                    logger.error(f"调用异常 (variant={list(variant.keys())}): {e}")
-                    last_exc = e
-                    try:
-                        resp_attrs = list(dir(response)) if 'response' in locals() else 'N/A'
-                    except Exception:
-                        resp_attrs = 'N/A'
-                    _write_debug_log(f"EXCEPTION variant={list(variant.keys())} attempt={attempt+1} exc={repr(e)} resp_attrs={resp_attrs}")
+                            # 记录响应状态；属性快照仅在调试模式下采集
+                            attrs = _response_attrs(response)
+                            status_code = getattr(response, "status_code", None)
+                            logger.warning(f"第 {attempt + 1} 次调用，variant={list(variant.keys())} 未解析到 content；status_code={status_code}")
+                            _write_debug_log("NON200", variant=list(variant.keys()), attempt=attempt + 1,
+                                             status_code=status_code, code=getattr(response, "code", None),
+                                             message=getattr(response, "message", None), resp_attrs=attrs)
+                            last_exc = f"no_content variant={list(variant.keys())}"
+                            sp["status"] = "no_content"
+                            if _is_throttled(response):
+                                # 被上游限流：通知所有进程退避，本进程再指数退避后重试
+                                sp["status"] = "throttled"
+                                if limiter:
+                                    limiter.throttled(scope)
+                                time.sleep(min(2 ** attempt, 8))
+                    except RateLimited as e:
+                        logger.warning(f"LLM 限流等待超时：{e}")
+                        sp["status"] = "rate_limited"
+                        return f"[失败] {e}"
+                    except Exception as e:
+                        logger.error(f"调用异常 (variant={list(variant.keys())}): {e}")
+                        last_exc = e
+                        sp["status"] = "error"
+                        sp["error"] = repr(e)
+                        resp_attrs = _response_attrs(response) if 'response' in locals() else None
+                        _write_debug_log("EXCEPTION", variant=list(variant.keys()), attempt=attempt + 1,
+                                         exc=repr(e), resp_attrs=resp_attrs)
 
         # 所有尝试失败，记录并返回
         try:
-            _write_debug_log(f"FAIL_ALL attempts={self.max_retries} last={repr(last_exc)}")
+            _write_debug_log("FAIL_ALL", attempts=self.max_retries, last=repr(last_exc))
         except Exception:
             pass
         return f"[失败] 经过 {self.max_retries} 次重试仍无法调用成功：{last_exc} (详细日志见 qwen_debug.log)"
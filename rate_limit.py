@@ -0,0 +1,217 @@
+# rate_limit.py
+"""DashScope 配额的跨进程限流（令牌桶，状态保存在本机 SQLite 文件中）。
+
+多个 Streamlit worker 与批处理脚本共用一个 DASHSCOPE_API_KEY 时，各自重试会在
+配额边缘形成重试风暴。这里在发请求前统一取令牌：
+- 请求桶：每秒 LLM_RPS 个请求（容量即一秒的突发量）；
+- token 桶：每分钟 LLM_TPM 个 token，按 prompt 估算值加预计输出预扣，
+  返回后按实际用量（usage）多退少补。
+
+桶状态按 API Key 的哈希分组，存放在 RATE_DB 中，所有进程在同一个
+BEGIN IMMEDIATE 事务内读-补充-扣减，因此跨进程一致。
+
+优先级：interactive（对话）等待时会登记在 waiters 表中，batch（批处理）在有
+interactive 等待者时让行；此外 batch 只能用到桶容量的 (1 - BATCH_RESERVE)，
+剩余部分留给交互请求。收到 429 限流响应时清空请求桶，所有进程一起退避。
+
+LLM_RPS / LLM_TPM 为 0（默认）时不限流。
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Optional
+
+from tracing import REGISTRY, span
+
+logger = logging.getLogger(__name__)
+
+LLM_RPS = float(os.getenv("ANALYTIBOT_LLM_RPS", "0"))
+LLM_TPM = float(os.getenv("ANALYTIBOT_LLM_TPM", "0"))
+OUTPUT_TOKENS_ESTIMATE = int(os.getenv("ANALYTIBOT_LLM_OUTPUT_TOKENS", "500"))   # 预扣的输出 token 数
+BATCH_RESERVE = float(os.getenv("ANALYTIBOT_LLM_BATCH_RESERVE", "0.2"))          # 留给交互请求的容量比例
+ACQUIRE_TIMEOUT_S = float(os.getenv("ANALYTIBOT_LLM_ACQUIRE_TIMEOUT_S", "60"))
+RATE_DB = os.getenv("ANALYTIBOT_RATE_DB", os.path.join(tempfile.gettempdir(), "analytibot_ratelimit.sqlite3"))
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+
+POLL_S = 0.25        # 等待时的最长单次睡眠（期间其他进程可能退还令牌）
+WAITER_TTL_S = 5.0   # 等待登记的有效期，进程崩溃后自动失效
+
+WAIT_SECONDS = REGISTRY.histogram("analytibot_ratelimit_wait_seconds", "LLM 请求在限流器上的等待时间")
+ACQUIRE_TOTAL = REGISTRY.counter("analytibot_ratelimit_total",
+                                 "限流器取令牌次数（outcome=immediate/waited/timeout/throttled）")
+
+
+class RateLimited(Exception):
+    """在超时时间内未能取得令牌。"""
+
+
+@dataclass
+class Lease:
+    scope: str
+    tokens: float
+    waited_s: float = 0.0
+
+
+class TokenBucketLimiter:
+    def __init__(self, path: str = RATE_DB, rps: float = LLM_RPS, tpm: float = LLM_TPM,
+                 batch_reserve: float = BATCH_RESERVE):
+        self.path = path
+        self.rps = rps
+        self.tpm = tpm
+        self.batch_reserve = batch_reserve
+        self._local = threading.local()
+        with self._txn() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, level REAL, updated REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS waiters (id TEXT PRIMARY KEY, scope TEXT, expires REAL)")
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _txn(self):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _buckets(self, scope: str):
+        """(桶名, 容量, 每秒补充量)；未配置的维度不参与。"""
+        out = []
+        if self.rps > 0:
+            out.append((f"{scope}:req", max(1.0, self.rps), self.rps))
+        if self.tpm > 0:
+            out.append((f"{scope}:tok", self.tpm, self.tpm / 60.0))
+        return out
+
+    @staticmethod
+    def _level(conn, name: str, capacity: float, rate: float, now: float) -> float:
+        row = conn.execute("SELECT level, updated FROM buckets WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return capacity
+        level, updated = row
+        return min(capacity, level + max(0.0, now - updated) * rate)
+
+    def _try_take(self, conn, scope: str, tokens: float, priority: str, now: float) -> float:
+        """能取则扣减并返回 0，否则返回还需等待的秒数（不扣减）。"""
+        if priority == BATCH and conn.execute(
+                "SELECT 1 FROM waiters WHERE scope = ? AND expires > ? LIMIT 1", (scope, now)).fetchone():
+            return POLL_S
+        wait = 0.0
+        levels = []
+        for name, capacity, rate in self._buckets(scope):
+            cost = 1.0 if name.endswith(":req") else min(tokens, capacity)
+            reserve = capacity * self.batch_reserve if priority == BATCH else 0.0
+            need = min(capacity, cost + reserve)
+            level = self._level(conn, name, capacity, rate, now)
+            if level < need:
+                wait = max(wait, (need - level) / rate)
+            levels.append((name, level - cost))
+        if wait > 0:
+            return wait
+        conn.executemany("INSERT OR REPLACE INTO buckets (name, level, updated) VALUES (?, ?, ?)",
+                         [(name, level, now) for name, level in levels])
+        return 0.0
+
+    def acquire(self, scope: str, tokens: float, priority: str = INTERACTIVE,
+                timeout_s: float = ACQUIRE_TIMEOUT_S) -> Lease:
+        """取一个请求令牌与 tokens 个 token 令牌，必要时等待；超时抛出 RateLimited。"""
+        start = time.time()
+        waiter = None
+        with span("ratelimit_acquire", priority=priority, tokens=int(tokens)) as sp:
+            try:
+                while True:
+                    with self._txn() as conn:
+                        now = time.time()
+                        wait = self._try_take(conn, scope, tokens, priority, now)
+                        if wait == 0:
+                            if waiter is not None:
+                                conn.execute("DELETE FROM waiters WHERE id = ?", (waiter,))
+                                waiter = None
+                            break
+                        if priority == INTERACTIVE:
+                            waiter = waiter or uuid.uuid4().hex
+                            conn.execute("INSERT OR REPLACE INTO waiters (id, scope, expires) VALUES (?, ?, ?)",
+                                         (waiter, scope, now + WAITER_TTL_S))
+                    if now + wait - start > timeout_s:
+                        ACQUIRE_TOTAL.inc(priority=priority, outcome="timeout")
+                        sp["status"] = "timeout"
+                        raise RateLimited(f"等待 LLM 配额超过 {timeout_s:.0f}s（RPS={self.rps:g}, TPM={self.tpm:g}）")
+                    time.sleep(min(max(wait, 0.01), POLL_S))
+            finally:
+                if waiter is not None:
+                    with self._txn() as conn:
+                        conn.execute("DELETE FROM waiters WHERE id = ?", (waiter,))
+            waited = time.time() - start
+            sp["waited_s"] = round(waited, 3)
+        WAIT_SECONDS.observe(waited, priority=priority)
+        ACQUIRE_TOTAL.inc(priority=priority, outcome="waited" if waited > 0.01 else "immediate")
+        return Lease(scope=scope, tokens=tokens, waited_s=waited)
+
+    def settle(self, lease: Lease, actual_tokens: Optional[float]):
+        """按实际用量修正预扣的 token（多退少补，可使桶暂时为负）。"""
+        if actual_tokens is None or self.tpm <= 0:
+            return
+        delta = lease.tokens - actual_tokens
+        if abs(delta) < 1:
+            return
+        name = f"{lease.scope}:tok"
+        with self._txn() as conn:
+            now = time.time()
+            level = self._level(conn, name, self.tpm, self.tpm / 60.0, now)
+            conn.execute("INSERT OR REPLACE INTO buckets (name, level, updated) VALUES (?, ?, ?)",
+                         (name, min(self.tpm, level + delta), now))
+
+    def throttled(self, scope: str):
+        """上游返回限流：清空请求桶，让所有进程一起退避一个补充周期。"""
+        ACQUIRE_TOTAL.inc(priority="-", outcome="throttled")
+        if self.rps <= 0:
+            return
+        with self._txn() as conn:
+            conn.execute("INSERT OR REPLACE INTO buckets (name, level, updated) VALUES (?, ?, ?)",
+                         (f"{scope}:req", 0.0, time.time()))
+
+
+def scope_for(api_key: Optional[str]) -> str:
+    """按 API Key 分组（只保存哈希，不落盘明文）。"""
+    return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+
+
+_LIMITER: Optional[TokenBucketLimiter] = None
+_LIMITER_FAILED = False
+_LIMITER_LOCK = threading.Lock()
+
+
+def get_limiter() -> Optional[TokenBucketLimiter]:
+    """进程内共享的限流器；未配置 LLM_RPS / LLM_TPM 时返回 None。"""
+    global _LIMITER, _LIMITER_FAILED
+    if (LLM_RPS <= 0 and LLM_TPM <= 0) or _LIMITER_FAILED:
+        return None
+    with _LIMITER_LOCK:
+        if _LIMITER is None:
+            try:
+                _LIMITER = TokenBucketLimiter()
+            except sqlite3.Error:
+                logger.exception("无法打开限流状态文件 %s，本进程不做限流", RATE_DB)
+                _LIMITER_FAILED = True
+                return None
+        return _LIMITER
@@ -0,0 +1,140 @@
+# result_view.py
+"""结果展示层：分页读取，只格式化可见部分。
+
+- ResultPager：执行结果保存为 Arrow 表（不可变、切片零拷贝），按页切片后才转成
+  pandas；数据集预览直接按 iloc 切片，不做整体转换；
+- render_page()：Streamlit 中带页码选择的表格，每次重跑只把当前页发送到浏览器；
+- print_result()：命令行流式分页输出，有总行数上限，大结果不会整体 to_string。
+"""
+
+import os
+import sys
+from typing import Any, Optional, TextIO
+
+import pandas as pd
+
+try:
+    import pyarrow as pa  # type: ignore
+except Exception:  # 可选依赖：未安装时退回按 DataFrame 切片
+    pa = None
+
+PAGE_SIZE = int(os.getenv("ANALYTIBOT_PAGE_SIZE", "50"))
+CLI_MAX_ROWS = int(os.getenv("ANALYTIBOT_CLI_MAX_ROWS", "200"))
+# 结果行数达到自动上限（可能被截断）时，db.execute_guarded 在 DataFrame.attrs 中记录该上限
+TRUNCATED_ATTR = "row_cap_truncated"
+
+
+def _to_arrow(df: pd.DataFrame):
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        # 混合类型的 object 列无法直接转换，按字符串保存
+        fixed = df.copy()
+        for col in fixed.columns:
+            if fixed[col].dtype == object:
+                fixed[col] = fixed[col].astype(str)
+        return pa.Table.from_pandas(fixed, preserve_index=False)
+
+
+class ResultPager:
+    """对 Arrow 表或 DataFrame 做固定大小的分页访问。"""
+
+    def __init__(self, source: Any, page_size: int = PAGE_SIZE, truncated_at: int = 0):
+        self.source = source
+        self.page_size = max(1, int(page_size))
+        self.truncated_at = truncated_at   # 结果被自动行数上限截断时为该上限，否则为 0
+
+    @classmethod
+    def from_df(cls, df: pd.DataFrame, page_size: int = PAGE_SIZE) -> "ResultPager":
+        """保存执行结果：可用 pyarrow 时转成 Arrow 表，否则直接保存 DataFrame。"""
+        return cls(_to_arrow(df) if pa is not None else df, page_size,
+                   truncated_at=int(df.attrs.get(TRUNCATED_ATTR, 0)))
+
+    @property
+    def is_arrow(self) -> bool:
+        return pa is not None and isinstance(self.source, pa.Table)
+
+    @property
+    def num_rows(self) -> int:
+        return self.source.num_rows if self.is_arrow else len(self.source)
+
+    @property
+    def columns(self) -> list:
+        return list(self.source.column_names if self.is_arrow else self.source.columns)
+
+    @property
+    def nbytes(self) -> int:
+        if self.is_arrow:
+            return self.source.nbytes
+        return int(self.source.memory_usage(index=True, deep=False).sum())
+
+    @property
+    def num_pages(self) -> int:
+        return max(1, -(-self.num_rows // self.page_size))
+
+    def rows(self, offset: int, length: int) -> pd.DataFrame:
+        offset = max(0, offset)
+        if self.is_arrow:
+            return self.source.slice(offset, length).to_pandas()
+        return self.source.iloc[offset:offset + length]
+
+    def page(self, index: int) -> pd.DataFrame:
+        """第 index 页（从 0 开始，越界时取最后一页）。"""
+        index = min(max(0, index), self.num_pages - 1)
+        return self.rows(index * self.page_size, self.page_size)
+
+    def head(self, n: int = 5) -> pd.DataFrame:
+        return self.rows(0, n)
+
+    def to_pandas(self) -> pd.DataFrame:
+        """完整转换（仅在确实需要整个结果时使用）。"""
+        return self.source.to_pandas() if self.is_arrow else self.source
+
+
+def render_page(pager: ResultPager, key: str, caption: Optional[str] = None) -> None:
+    """在 Streamlit 中展示一页结果；页码控件的状态保存在 session_state[key + '_page']。"""
+    import streamlit as st
+
+    total = pager.num_rows
+    if pager.num_pages > 1:
+        page_no = st.number_input(f"页码（每页 {pager.page_size} 行，共 {pager.num_pages} 页）",
+                                  min_value=1, max_value=pager.num_pages, value=1, step=1, key=f"{key}_page")
+    else:
+        page_no = 1
+    st.dataframe(pager.page(int(page_no) - 1))
+    start = (int(page_no) - 1) * pager.page_size
+    st.caption(caption or f"第 {start + 1 if total else 0}-{min(start + pager.page_size, total)} 行，共 {total} 行")
+
+
+def print_result(result: Any, out: TextIO = None, page_size: int = PAGE_SIZE, max_rows: int = CLI_MAX_ROWS,
+                 interactive: Optional[bool] = None) -> None:
+    """命令行输出：DataFrame 按页流式打印，最多 max_rows 行；交互终端下每页之间等待回车。"""
+    out = out or sys.stdout
+    if isinstance(result, ResultPager):
+        pager = result
+    elif isinstance(result, pd.DataFrame):
+        # 命令行只读取需要打印的前 max_rows 行，不转换整个结果
+        pager = ResultPager(result, page_size)
+    else:
+        print(result, file=out)
+        return
+    if interactive is None:
+        interactive = sys.stdin.isatty() and out is sys.stdout
+    total = pager.num_rows
+    limit = min(total, max_rows) if max_rows > 0 else total
+    shown = 0
+    while shown < limit:
+        chunk = pager.rows(shown, min(page_size, limit - shown))
+        text = chunk.to_string(index=False, header=shown == 0)
+        print(text, file=out)
+        shown += len(chunk)
+        if not len(chunk):
+            break
+        if interactive and shown < limit:
+            try:
+                if input(f"-- 已显示 {shown}/{total} 行，回车继续，q 退出 -- ").strip().lower() == "q":
+                    break
+            except EOFError:
+                break
+    if shown < total:
+        print(f"... 共 {total} 行，已显示 {shown} 行", file=out)
@@ -0,0 +1,315 @@
+# rollup.py
+"""加载数据时预计算的聚合立方体（rollup cube）。
+
+大部分问题都是在同几个维度（日期、城市、产品……）上对数值列求和/计数，
+在原始大表上每次 groupby 需要数秒。这里在加载时：
+1. 识别低基数的维度列与数值度量列；
+2. 一次向量化 groupby 得到最细粒度的 sum/count 立方体（行数远小于原表）；
+3. 之后的聚合问题在立方体上重新聚合，并按查询缓存结果，重复查询为一次字典查找。
+
+生成的分析代码可以直接使用变量 `rollup`（见 describe()），
+本地 SQL（local_sql.LocalEngine）也会先尝试用立方体回答简单的 GROUP BY 查询。
+"""
+
+import logging
+import math
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import pandas as pd
+
+from sql_guard import tokenize
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+MAX_DIM_CARDINALITY = 1000     # 单个维度的最大取值个数
+MAX_CUBE_CELLS = 2_000_000     # 各维度基数乘积的上限（超过则丢弃基数最高的维度）
+MIN_ROWS_FOR_CUBE = 10_000     # 小表直接 groupby 即可，无需预聚合
+ROW_COUNT = "__rows"
+
+
+def detect_dimensions(df: pd.DataFrame, max_cardinality: int = MAX_DIM_CARDINALITY) -> List[str]:
+    """识别适合作为维度的列：字符串/类别/布尔/日期列，以及取值很少的整数列。"""
+    dims = []
+    n = len(df)
+    for col in df.columns:
+        s = df[col]
+        kind = s.dtype.kind
+        if kind in ("O", "b", "M") or isinstance(s.dtype, pd.CategoricalDtype) or pd.api.types.is_string_dtype(s.dtype):
+            pass
+        elif kind in ("i", "u"):
+            # 整数列只有在取值很少时才视为维度（如年份、等级），避免把金额当维度
+            if n == 0 or s.nunique(dropna=False) > min(50, max(1, n // 100)):
+                continue
+        else:
+            continue
+        card = s.nunique(dropna=False)
+        if 1 < card <= max_cardinality and card < max(2, n):
+            dims.append(col)
+    return dims
+
+
+def detect_measures(df: pd.DataFrame, dims: Sequence[str]) -> List[str]:
+    """数值列中除维度与 id 类列以外的都作为度量。"""
+    measures = []
+    for col in df.columns:
+        if col in dims or df[col].dtype.kind not in ("i", "u", "f"):
+            continue
+        name = str(col).lower()
+        if name == "id" or name.endswith("_id") or (name.endswith("id") and df[col].is_unique):
+            continue
+        measures.append(col)
+    return measures
+
+
+class RollupCube:
+    """最细粒度的预聚合结果：每个度量保存 sum 与非空计数，另有总行数。"""
+
+    def __init__(self, cube: pd.DataFrame, dims: List[str], measures: List[str], source_rows: int):
+        self.cube = cube
+        self.dims = dims
+        self.measures = measures
+        self.source_rows = source_rows
+        self._cache: Dict[Tuple, pd.DataFrame] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def build(cls, df: pd.DataFrame, dims: Optional[List[str]] = None, measures: Optional[List[str]] = None,
+              max_cells: int = MAX_CUBE_CELLS) -> Optional["RollupCube"]:
+        """一次 groupby 构建立方体；找不到合适的维度/度量时返回 None。"""
+        with span("rollup_build", rows=len(df)) as sp:
+            dims = list(dims) if dims is not None else detect_dimensions(df)
+            measures = list(measures) if measures is not None else detect_measures(df, dims)
+            if not dims or not measures:
+                sp["status"] = "skipped"
+                return None
+            # 基数乘积是立方体大小的上界；过大时从基数最高的维度开始丢弃
+            cards = {d: int(df[d].nunique(dropna=False)) for d in dims}
+            while dims and math.prod(cards[d] for d in dims) > max_cells:
+                dims.remove(max(dims, key=lambda d: cards[d]))
+            if not dims:
+                sp["status"] = "skipped"
+                return None
+            agg = {}
+            for m in measures:
+                agg[f"{m}__sum"] = (m, "sum")
+                agg[f"{m}__count"] = (m, "count")
+            grouped = df.groupby(dims, observed=True, dropna=False, sort=False)
+            cube = grouped.agg(**agg)
+            cube[ROW_COUNT] = grouped.size()
+            cube = cube.reset_index()
+            sp.update(dims=dims, measures=measures, cube_rows=len(cube))
+            return cls(cube, dims, measures, len(df))
+
+    def can_answer(self, by: Sequence[str], measure: Optional[str] = None, filters: Optional[dict] = None) -> bool:
+        cols = list(by) + list((filters or {}).keys())
+        if any(c not in self.dims for c in cols):
+            return False
+        return measure is None or measure in self.measures
+
+    def query(self, by: Sequence[str], measure: Optional[str] = None, agg: str = "sum",
+              filters: Optional[dict] = None) -> pd.DataFrame:
+        """在立方体上重新聚合。
+
+        by：分组维度列表；measure：度量列（agg='size' 时可省略）；
+        agg：sum / count / mean / size；filters：{维度: 取值或取值列表}。
+        返回以 by 为列、结果列名为 measure（或 'count'）的 DataFrame。
+        """
+        by = list(by)
+        if not self.can_answer(by, measure if agg != "size" else None, filters):
+            raise KeyError(f"rollup 无法回答：by={by}, measure={measure}；可用维度 {self.dims}，度量 {self.measures}")
+        key = (tuple(by), measure, agg, tuple(sorted((k, str(v)) for k, v in (filters or {}).items())))
+        cached = self._cache.get(key)
+        if cached is not None:
+            return cached.copy()
+
+        cube = self.cube
+        for col, val in (filters or {}).items():
+            vals = val if isinstance(val, (list, tuple, set)) else [val]
+            cube = cube[cube[col].isin(vals)]
+        if agg == "size":
+            cols, out_name = [ROW_COUNT], "count"
+        elif agg == "count":
+            cols, out_name = [f"{measure}__count"], measure
+        elif agg in ("sum", "mean"):
+            cols, out_name = [f"{measure}__sum", f"{measure}__count"], measure
+        else:
+            raise ValueError(f"不支持的聚合：{agg}")
+
+        if by:
+            res = cube.groupby(by, observed=True, dropna=False, sort=True)[cols].sum().reset_index()
+        else:
+            res = cube[cols].sum().to_frame().T
+        if agg == "mean":
+            res[out_name] = res[cols[0]] / res[cols[1]].where(res[cols[1]] != 0)
+        elif agg == "sum":
+            # 与 SQL / DuckDB 一致（相当于 sum(min_count=1)）：全为 NULL 的分组求和为 NULL 而不是 0
+            res[out_name] = res[cols[0]].where(res[cols[1]] > 0)
+        else:
+            res[out_name] = res[cols[0]]
+        res = res[by + [out_name]]
+        with self._lock:
+            self._cache[key] = res
+        return res.copy()
+
+    def describe(self) -> str:
+        """给分析 prompt 使用的说明文字。"""
+        return (
+            f"已预计算聚合变量 `rollup`（维度：{self.dims}；度量：{self.measures}）。"
+            "按这些维度对度量求和/计数/均值时，优先使用 "
+            "`rollup.query(by=['维度'], measure='度量', agg='sum'|'count'|'mean'|'size', filters={'维度': 值})`，"
+            "它返回 DataFrame，比在 df 上 groupby 快得多。"
+        )
+
+    # ---------- 简单 GROUP BY SQL 的直接回答 ----------
+
+    _SQL_AGGS = {"sum": "sum", "count": "count", "avg": "mean"}
+
+    def answer_sql(self, sql: str, table: str = "df") -> Optional[pd.DataFrame]:
+        """若 SQL 形如 `SELECT d1, SUM(m) [AS a] FROM df [GROUP BY d1] [ORDER BY x [DESC]] [LIMIT n]`，
+        直接用立方体回答；否则返回 None，由调用方正常执行。
+
+        结果与 DuckDB 一致：别名保持原样，未命名的聚合列名为 `sum(m)`（函数名小写、参数按原文）、
+        `count_star()`；DuckDB 会拒绝的 SQL（如 ORDER BY 未分组的列、输出列重名）同样返回 None。
+        """
+        try:
+            toks = tokenize(sql)
+        except ValueError:
+            return None
+        while toks and toks[-1].value == ";":
+            toks.pop()
+        vals = [t.value for t in toks]
+        if not vals or vals[0] != "select" or "from" not in vals:
+            return None
+        from_idx = vals.index("from")
+        select_items = _split_commas(toks[1:from_idx])
+        rest_toks = toks[from_idx + 1:]
+        if not rest_toks or rest_toks[0].value != table.lower():
+            return None
+        rest_toks = rest_toks[1:]
+        rest = [t.value for t in rest_toks]
+
+        col_lookup = {str(c).lower(): c for c in self.dims + self.measures}
+
+        def ident(tok) -> Optional[str]:
+            """标识符原文：普通标识符保持书写大小写，双引号标识符去掉引号；其他 token 返回 None。"""
+            if tok.kind == "ident":
+                return sql[tok.start:tok.end]
+            if tok.kind == "string" and tok.value.startswith('"'):
+                return tok.value[1:-1].replace('""', '"')
+            return None
+
+        def column(tok):
+            name = ident(tok)
+            return col_lookup.get(name.lower()) if name is not None else None
+
+        # 解析 SELECT 列表
+        dim_cols, aggs = [], []
+        for item in select_items:
+            alias = None
+            if len(item) >= 2 and item[-2].is_word("as"):
+                alias = ident(item[-1])
+                if alias is None:
+                    return None
+                item = item[:-2]
+            v = [t.value for t in item]
+            if len(item) == 1 and column(item[0]) in self.dims:
+                dim_cols.append(column(item[0]))
+                if alias is not None and alias.lower() != str(dim_cols[-1]).lower():
+                    return None
+            elif len(v) == 4 and v[0] in ("sum", "count", "avg") and v[1] == "(" and v[3] == ")":
+                fn = v[0]
+                if v[2] == "*" and fn == "count":
+                    aggs.append((None, "size", alias or "count_star()"))
+                elif column(item[2]) in self.measures:
+                    aggs.append((column(item[2]), self._SQL_AGGS[fn], alias or f"{fn}({ident(item[2])})"))
+                else:
+                    return None
+            else:
+                return None
+        if len(aggs) != 1:
+            return None
+        measure, agg, out_name = aggs[0]
+        out_names = [str(c).lower() for c in dim_cols] + [out_name.lower()]
+        if len(set(out_names)) != len(out_names):
+            # DuckDB 会把重名列改名为 x_1，这里不模拟
+            return None
+
+        # 解析 GROUP BY / ORDER BY / LIMIT
+        order_target, descending, limit = None, False, None
+        i = 0
+        if rest[i:i + 2] == ["group", "by"]:
+            i += 2
+            group_cols = []
+            while i < len(rest) and rest[i] not in ("order", "limit"):
+                if rest[i] != ",":
+                    col = column(rest_toks[i])
+                    if col is None:
+                        return None
+                    group_cols.append(col)
+                i += 1
+            if sorted(map(str, group_cols)) != sorted(map(str, dim_cols)):
+                return None
+        elif dim_cols:
+            return None
+        if rest[i:i + 2] == ["order", "by"] and i + 2 < len(rest):
+            # 只接受输出列名/别名；未分组的原始列（如只出现在 SUM() 里的度量）DuckDB 会报错
+            name = ident(rest_toks[i + 2])
+            if name is None:
+                return None
+            if name.lower() == out_name.lower():
+                order_target = out_name
+            elif col_lookup.get(name.lower()) in dim_cols:
+                order_target = col_lookup[name.lower()]
+            else:
+                return None
+            i += 3
+            if i < len(rest) and rest[i] in ("asc", "desc"):
+                descending = rest[i] == "desc"
+                i += 1
+        if i < len(rest) and rest[i] == "limit" and i + 1 < len(rest) and rest[i + 1].isdigit():
+            limit = int(rest[i + 1])
+            i += 2
+        if i != len(rest):
+            return None
+
+        try:
+            res = self.query(dim_cols, measure, agg)
+        except (KeyError, ValueError):
+            return None
+        res = res.rename(columns={(measure or "count"): out_name})
+        if order_target is not None:
+            res = res.sort_values(order_target, ascending=not descending, kind="stable")
+        if limit is not None:
+            res = res.head(limit)
+        return res.reset_index(drop=True)
+
+
+def _split_commas(tokens) -> List[list]:
+    """按最外层逗号切分 SELECT 列表。"""
+    items, cur, depth = [], [], 0
+    for t in tokens:
+        if t.value == "(":
+            depth += 1
+        elif t.value == ")":
+            depth -= 1
+        if t.value == "," and depth == 0:
+            items.append(cur)
+            cur = []
+        else:
+            cur.append(t)
+    if cur:
+        items.append(cur)
+    return items
+
+
+def build_rollup(df: Optional[pd.DataFrame], min_rows: int = MIN_ROWS_FOR_CUBE) -> Optional[RollupCube]:
+    """数据加载后调用：行数足够多时构建立方体，失败只记录日志不影响主流程。"""
+    if df is None or len(df) < min_rows:
+        return None
+    try:
+        return RollupCube.build(df)
+    except Exception:
+        logger.exception("构建 rollup 立方体失败")
+        return None
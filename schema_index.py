@@ -0,0 +1,212 @@
+# schema_index.py
+"""数据库表结构的本地词法检索（BM25），用于缩小 SQL 生成 prompt。
+
+宽库（上千张表、数万列）无法把全部表结构放进 prompt，只列表名又让模型去猜列名。
+这里把每张表的表名、表注释、列名、列注释建成一个 BM25 文档：
+- 标识符按下划线 / 驼峰 / 数字边界拆词（t_order_detail -> order, detail），
+  英文词额外去掉复数 s；完整标识符也作为一个词，便于精确命中表名；
+- 中文（问题与注释）按字符二元组（bigram）切分，无需分词词典；
+- 表名权重最高，其次表注释，列名与列注释各计一次。
+
+对每个问题只取 top-k 张相关表及其列拼进 prompt。MySQL 下表结构通过两条
+information_schema 查询一次取回，其他方言走 SQLAlchemy inspect；
+索引按数据源缓存 SCHEMA_INDEX_TTL_S 秒。
+"""
+
+import heapq
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+from sqlalchemy import inspect, text
+
+from db import engine_key
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_TOP_K = int(os.getenv("ANALYTIBOT_SCHEMA_TOP_K", "5"))
+SCHEMA_MAX_COLUMNS = int(os.getenv("ANALYTIBOT_SCHEMA_MAX_COLUMNS", "80"))   # 每张表最多列出的列数
+SCHEMA_INDEX_TTL_S = int(os.getenv("ANALYTIBOT_SCHEMA_TTL_S", "600"))
+
+# 字段权重：通过重复词项近似 BM25F
+TABLE_NAME_WEIGHT = 3
+TABLE_COMMENT_WEIGHT = 2
+
+_CJK_RUN = re.compile(r"[一-鿿]+")
+_IDENT = re.compile(r"[A-Za-z0-9_]+")
+_IDENT_SPLIT = re.compile(r"_+|(?<=[a-z])(?=[A-Z])|(?<=[A-Za-z])(?=\d)|(?<=\d)(?=[A-Za-z])")
+
+
+def tokenize(value: str) -> List[str]:
+    """中文按 bigram，标识符按下划线/驼峰拆词；单个字母与纯数字不作为词项。"""
+    tokens: List[str] = []
+    for run in _CJK_RUN.findall(value or ""):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    for ident in _IDENT.findall(value or ""):
+        parts = [p.lower() for p in _IDENT_SPLIT.split(ident) if p]
+        if len(parts) > 1:
+            tokens.append(ident.lower())
+        for p in parts:
+            if len(p) < 2 or p.isdigit():
+                continue
+            tokens.append(p)
+            if len(p) > 3 and p.endswith("s"):
+                tokens.append(p[:-1])
+    return tokens
+
+
+@dataclass
+class ColumnInfo:
+    name: str
+    type: str = ""
+    comment: str = ""
+
+
+@dataclass
+class TableSchema:
+    name: str
+    comment: str = ""
+    columns: List[ColumnInfo] = field(default_factory=list)
+
+    def terms(self) -> List[str]:
+        terms = tokenize(self.name) * TABLE_NAME_WEIGHT + [self.name.lower()] * TABLE_NAME_WEIGHT
+        terms += tokenize(self.comment) * TABLE_COMMENT_WEIGHT
+        for col in self.columns:
+            terms += tokenize(col.name) + tokenize(col.comment)
+        return terms
+
+    def render(self, max_columns: int = SCHEMA_MAX_COLUMNS) -> str:
+        cols = []
+        for col in self.columns[:max_columns]:
+            desc = f"{col.name} {col.type}".strip()
+            cols.append(f"{desc}（{col.comment}）" if col.comment else desc)
+        more = f" ...（共 {len(self.columns)} 列）" if len(self.columns) > max_columns else ""
+        head = f"表 {self.name}" + (f"（{self.comment}）" if self.comment else "")
+        return f"{head}：" + ", ".join(cols) + more
+
+
+class Bm25:
+    """倒排表上的 BM25 打分。"""
+
+    def __init__(self, docs: List[List[str]], k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.doc_len = [len(d) for d in docs]
+        self.avgdl = (sum(self.doc_len) / len(docs)) if docs else 0.0
+        self.postings: Dict[str, List[Tuple[int, int]]] = {}
+        for idx, doc in enumerate(docs):
+            for term, tf in Counter(doc).items():
+                self.postings.setdefault(term, []).append((idx, tf))
+        n = len(docs)
+        self.idf = {t: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for t, p in self.postings.items()}
+
+    def search(self, terms: List[str], k: int) -> List[Tuple[int, float]]:
+        scores: Dict[int, float] = {}
+        for term in set(terms):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = self.idf[term]
+            for idx, tf in postings:
+                norm = self.k1 * (1 - self.b + self.b * self.doc_len[idx] / (self.avgdl or 1.0))
+                scores[idx] = scores.get(idx, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        return heapq.nlargest(k, scores.items(), key=lambda kv: kv[1])
+
+
+class SchemaIndex:
+    def __init__(self, tables: List[TableSchema]):
+        self.tables = tables
+        self.bm25 = Bm25([t.terms() for t in tables])
+        self.built_at = time.time()
+
+    def search(self, question: str, k: int = SCHEMA_TOP_K, allowed_tables=None) -> List[Tuple[TableSchema, float]]:
+        """返回与问题最相关的 k 张表（按得分降序）；allowed_tables 不为 None 时只在其中检索。"""
+        terms = tokenize(question)
+        if not terms:
+            return []
+        # 多取一些候选，再按白名单过滤
+        pool = self.bm25.search(terms, k if allowed_tables is None else k * 4)
+        hits = []
+        for idx, score in pool:
+            table = self.tables[idx]
+            if allowed_tables is not None and table.name.lower() not in allowed_tables:
+                continue
+            hits.append((table, score))
+            if len(hits) >= k:
+                break
+        return hits
+
+    def render(self, question: str, k: int = SCHEMA_TOP_K, allowed_tables=None,
+               max_columns: int = SCHEMA_MAX_COLUMNS) -> str:
+        """检索并格式化为 prompt 片段（每张表一行）；没有命中时返回空串。"""
+        with span("schema_retrieve", tables_total=len(self.tables)) as sp:
+            hits = self.search(question, k, allowed_tables)
+            out = "\n".join(t.render(max_columns) for t, _ in hits)
+            sp.update(tables=[t.name for t, _ in hits], chars=len(out))
+        return out
+
+
+def _load_mysql(engine) -> List[TableSchema]:
+    tables: Dict[str, TableSchema] = {}
+    with engine.connect() as conn:
+        rows = conn.execute(text(
+            "SELECT TABLE_NAME, TABLE_COMMENT FROM information_schema.TABLES "
+            "WHERE TABLE_SCHEMA = DATABASE()"))
+        for name, comment in rows:
+            tables[name] = TableSchema(name=name, comment=comment or "")
+        rows = conn.execute(text(
+            "SELECT TABLE_NAME, COLUMN_NAME, COLUMN_TYPE, COLUMN_COMMENT FROM information_schema.COLUMNS "
+            "WHERE TABLE_SCHEMA = DATABASE() ORDER BY TABLE_NAME, ORDINAL_POSITION"))
+        for table, name, col_type, comment in rows:
+            t = tables.setdefault(table, TableSchema(name=table))
+            t.columns.append(ColumnInfo(name=name, type=str(col_type or ""), comment=comment or ""))
+    return list(tables.values())
+
+
+def _load_inspect(engine) -> List[TableSchema]:
+    insp = inspect(engine)
+    tables = []
+    for name in insp.get_table_names():
+        try:
+            comment = (insp.get_table_comment(name) or {}).get("text") or ""
+        except NotImplementedError:
+            comment = ""
+        cols = [ColumnInfo(name=c["name"], type=str(c.get("type", "")), comment=c.get("comment") or "")
+                for c in insp.get_columns(name)]
+        tables.append(TableSchema(name=name, comment=comment, columns=cols))
+    return tables
+
+
+def load_schema(engine) -> List[TableSchema]:
+    """读取库中全部表及列（含注释）。"""
+    if getattr(engine.dialect, "name", "") == "mysql":
+        return _load_mysql(engine)
+    return _load_inspect(engine)
+
+
+_INDEXES: Dict[str, SchemaIndex] = {}
+_INDEXES_LOCK = threading.Lock()
+
+
+def get_schema_index(engine, ttl_s: int = SCHEMA_INDEX_TTL_S) -> SchemaIndex:
+    """按数据源缓存的索引，过期后重建；构建在锁内进行，并发会话不会重复读取 information_schema。"""
+    key = engine_key(engine)
+    with _INDEXES_LOCK:
+        idx = _INDEXES.get(key)
+        if idx is not None and time.time() - idx.built_at < ttl_s:
+            return idx
+        with span("schema_index_build") as sp:
+            idx = SchemaIndex(load_schema(engine))
+            sp.update(tables=len(idx.tables), terms=len(idx.bm25.postings))
+        _INDEXES[key] = idx
+        return idx
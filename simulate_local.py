@@ -4,7 +4,7 @@
 - 打印结果并保存图表为 output_plot.png
 """
 from analytibot import load_data, execute_code
-import pandas as pd
+from result_view import print_result
 
 def mock_get_analysis_code(question, columns):
     # 简单示例：按城市汇总销售额并绘图，使用变量 df
@@ -24,15 +24,9 @@ def mock_get_analysis_code(question, columns):
     return code
 
 def run():
+    # data.csv 为 GBK 编码且整行带引号，load_data 会自动识别并修复，列类型保持不变
     df = load_data('data.csv')
 
-    # 若 sales 列为字符串（因文件格式问题），尝试拆分第一列
-    if df.shape[1] == 1 and df.columns[0].count(',')>0:
-        df = df[df.columns[0]].str.strip('"').str.split(',', expand=True)
-        df.columns = ['date','city','product','sales','customers']
-    # 转换数值列
-    df['sales'] = pd.to_numeric(df['sales'], errors='coerce')
-
     question = '各城市的销售额总和，请画柱状图'
     code = mock_get_analysis_code(question, df.columns.tolist())
     print('--- Generated Code ---')
@@ -41,10 +35,7 @@ def run():
     result, has_plot = execute_code(code, df)
 
     print('\n--- Result ---')
-    if isinstance(result, pd.DataFrame):
-        print(result.to_string(index=False))
-    else:
-        print(result)
+    print_result(result)
 
     if has_plot:
         print('\nPlot generated: output_plot.png')
@@ -0,0 +1,107 @@
+# singleflight.py
+"""相同请求的并发合并（single-flight）。
+
+多位用户同时打开同一个问题、或 Streamlit 重跑导致重复提交时，相同的 prompt / SQL
+会同时到达模型接口或数据库。SingleFlight.do(key, fn) 保证同一 key 同一时刻只有一个
+调用在执行：后到的调用等待这次执行完成并共享其结果（或异常），不再重复请求上游。
+
+只合并“正在进行”的调用，完成后立即移除，不是结果缓存；合并范围为当前进程
+（Streamlit 的各个会话运行在同一进程的不同线程中）。
+设置 ANALYTIBOT_SINGLEFLIGHT=0 可关闭。
+"""
+
+import hashlib
+import os
+import re
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+from tracing import REGISTRY
+
+ENABLED = os.getenv("ANALYTIBOT_SINGLEFLIGHT", "1") not in ("0", "false", "False", "")
+
+FLIGHT_TOTAL = REGISTRY.counter("analytibot_singleflight_total",
+                                "single-flight 调用次数（role=leader 实际执行，follower 共享结果）")
+
+_WS = re.compile(r"\s+")
+# 引号内的内容原样保留，其余连续空白压缩为一个空格（含换行时压缩为一个换行）
+_SQL_WS = re.compile(r"""('(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*"|`(?:[^`]|``)*`)|\s+""", re.DOTALL)
+
+
+def normalize_prompt(prompt: str) -> str:
+    """合并 key 用：去掉首尾空白并压缩连续空白（发送给模型的仍是原文）。"""
+    return _WS.sub(" ", prompt or "").strip()
+
+
+def _collapse_ws(m: "re.Match") -> str:
+    if m.group(1):
+        return m.group(1)
+    # 换行会结束 `--` / `#` 行注释，不能与空格等同：SELECT a -- x\nFROM t 与 SELECT a -- x FROM t 是不同语句
+    return "\n" if "\n" in m.group() else " "
+
+
+def normalize_sql(sql: str) -> str:
+    """合并 key 用：压缩字符串字面量以外的空白、去掉末尾分号；不改变大小写（表名可能区分大小写）。"""
+    text = _SQL_WS.sub(_collapse_ws, sql or "").strip()
+    return text.rstrip(";").strip()
+
+
+def flight_key(*parts: Any) -> str:
+    return hashlib.sha256("\x1f".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+
+
+class _Call:
+    __slots__ = ("done", "value", "error", "dups")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value: Any = None
+        self.error: Optional[BaseException] = None
+        self.dups = 0
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """执行 fn 或等待同 key 的进行中调用；返回 (结果, 是否为共享结果)。
+
+        fn 抛出的异常同样传给所有等待者。同一线程内不要对同一 key 嵌套调用。
+        """
+        if not ENABLED:
+            return fn(), False
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.dups += 1
+        if not leader:
+            call.done.wait()
+            FLIGHT_TOTAL.inc(kind=self.name, role="follower")
+            if call.error is not None:
+                raise call.error
+            return call.value, True
+        try:
+            call.value = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+            FLIGHT_TOTAL.inc(kind=self.name, role="leader")
+        return call.value, False
+
+
+LLM_FLIGHT = SingleFlight("llm")
+SQL_FLIGHT = SingleFlight("sql")
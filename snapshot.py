@@ -0,0 +1,645 @@
+# snapshot.py
+"""把数据库中的一张表（或一条 SELECT）抽取为本地列式快照。
+
+- 按主键（整数）或日期列的取值范围切分为若干分区，在连接池上并发读取；
+- 每个分区使用服务端游标分块读取（stream_results），每块直接写成一个 Arrow IPC
+  或 Parquet 文件，内存中只保留当前块；
+- 快照目录带 manifest.json，加载时对 Arrow 文件做内存映射（pa.memory_map），
+  作为 pandas 分析路径的数据源（等价于上传了一份 CSV，但不需要手工导出）；
+- manifest 记录水位列（自增 id / 日期 / update_time）及其最大值，refresh_snapshot()
+  只拉取水位之后的新增/变更行：追加为新的分块文件，按主键覆盖旧行时只重写
+  键范围（file_stats）有重叠的分块，代价与变更量成正比而不是与表大小成正比。
+
+目录结构：SNAPSHOT_DIR/<name>/{manifest.json, part-0000-00000.arrow, ...}
+"""
+
+import datetime as _dt
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+import pandas as pd
+from sqlalchemy import inspect, text
+
+from sql_guard import check_select
+from tracing import span
+
+try:
+    import pyarrow as pa  # type: ignore
+    import pyarrow.compute as pc  # type: ignore
+    import pyarrow.parquet as pq  # type: ignore
+except Exception:  # 可选依赖：未安装时快照功能不可用
+    pa = None
+    pc = None
+    pq = None
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_DIR = os.getenv("ANALYTIBOT_SNAPSHOT_DIR", "snapshots")
+SNAPSHOT_PARTITIONS = int(os.getenv("ANALYTIBOT_SNAPSHOT_PARTITIONS", "16"))
+SNAPSHOT_WORKERS = int(os.getenv("ANALYTIBOT_SNAPSHOT_WORKERS", "4"))   # 不超过连接池大小
+SNAPSHOT_CHUNK_ROWS = int(os.getenv("ANALYTIBOT_SNAPSHOT_CHUNK_ROWS", "200000"))
+MANIFEST = "manifest.json"
+FORMATS = ("arrow", "parquet")
+# 按名称识别“最后修改时间”列；存在时刷新会覆盖已变更的行
+UPDATE_COLUMNS = ("update_time", "updated_at", "update_at", "gmt_modified", "modify_time",
+                  "modified_at", "last_modified", "last_update")
+
+_NAME_RE = re.compile(r"[^0-9A-Za-z_\-\u0080-\uffff]+")
+
+
+def available() -> bool:
+    return pa is not None
+
+
+@dataclass
+class Partition:
+    index: int
+    where: str = ""                       # 空字符串表示不加条件（整表一个分区）
+    params: dict = field(default_factory=dict)
+
+
+@dataclass
+class SnapshotManifest:
+    name: str
+    source: str                           # 表名或 SELECT
+    is_query: bool = False
+    key: Optional[str] = None             # 分区列
+    key_kind: Optional[str] = None        # int / date
+    fmt: str = "arrow"
+    rows: int = 0
+    files: List[str] = field(default_factory=list)
+    partitions: int = 1
+    created_at: str = ""
+    elapsed_s: float = 0.0
+    merge_key: Optional[str] = None       # 唯一键（整数主键），刷新时据此覆盖旧行
+    watermark: Optional[str] = None       # 增量刷新使用的水位列
+    watermark_mode: str = "append"        # append：只拉取新增；upsert：新增 + 按 merge_key 覆盖
+    watermark_value: Any = None           # 已同步到的水位（日期以 ISO 字符串保存）
+    file_stats: Dict[str, list] = field(default_factory=dict)  # 文件 -> [merge_key 最小值, 最大值]
+    version: int = 0
+    refreshed_at: str = ""
+
+    @classmethod
+    def read(cls, path: str) -> "SnapshotManifest":
+        with open(os.path.join(path, MANIFEST), encoding="utf-8") as f:
+            data = json.load(f)
+        known = {k: v for k, v in data.items() if k in cls.__dataclass_fields__}
+        return cls(**known)
+
+    def write(self, path: str) -> None:
+        tmp = os.path.join(path, MANIFEST + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(asdict(self), f, ensure_ascii=False, indent=2, default=str)
+        os.replace(tmp, os.path.join(path, MANIFEST))
+
+
+def snapshot_path(name: str) -> str:
+    return os.path.join(SNAPSHOT_DIR, _NAME_RE.sub("_", name).strip("_") or "snapshot")
+
+
+def list_snapshots() -> List[SnapshotManifest]:
+    if not os.path.isdir(SNAPSHOT_DIR):
+        return []
+    out = []
+    for entry in sorted(os.listdir(SNAPSHOT_DIR)):
+        path = os.path.join(SNAPSHOT_DIR, entry)
+        if os.path.exists(os.path.join(path, MANIFEST)):
+            try:
+                out.append(SnapshotManifest.read(path))
+            except Exception:
+                logger.warning("忽略无法读取的快照 %s", path)
+    return out
+
+
+# ---------- 分区规划 ----------
+
+def _quote(engine, ident: str) -> str:
+    return engine.dialect.identifier_preparer.quote(ident)
+
+
+def _from_clause(engine, source: str, is_query: bool) -> str:
+    # 表来源直接 FROM 表名，使 MIN/MAX 与范围条件能走索引
+    if is_query:
+        return f"({source.strip().rstrip(';')}) AS _src"
+    return _quote(engine, source)
+
+
+def choose_partition_key(engine, table: str) -> Tuple[Optional[str], Optional[str]]:
+    """优先单列整数主键，其次日期/时间列；都没有时返回 (None, None)。"""
+    insp = inspect(engine)
+    cols = {c["name"]: c for c in insp.get_columns(table)}
+    pk = (insp.get_pk_constraint(table) or {}).get("constrained_columns") or []
+    if len(pk) == 1 and _kind(cols[pk[0]]["type"]) == "int":
+        return pk[0], "int"
+    for name, col in cols.items():
+        if _kind(col["type"]) == "int" and name.lower() == "id":
+            return name, "int"
+    for name, col in cols.items():
+        if _kind(col["type"]) == "date":
+            return name, "date"
+    return None, None
+
+
+def _kind(sa_type) -> Optional[str]:
+    try:
+        py = sa_type.python_type
+    except (NotImplementedError, AttributeError):
+        return None
+    if py is int:
+        return "int"
+    if py in (_dt.date, _dt.datetime):
+        return "date"
+    return None
+
+
+def plan_partitions(engine, from_clause: str, key: Optional[str], key_kind: Optional[str],
+                    parts: int = SNAPSHOT_PARTITIONS) -> Tuple[List[Partition], Optional[str]]:
+    """按分区列的 MIN/MAX 等分取值范围；另加一个 `key IS NULL` 分区（范围条件不会匹配 NULL）。
+
+    返回 (分区列表, 分区列类型)；key_kind 为 None 时按 MIN 的取值类型推断。
+    """
+    if not key or parts <= 1:
+        return [Partition(0)], key_kind
+    qk = _quote(engine, key)
+    with engine.connect() as conn:
+        lo, hi = conn.execute(text(f"SELECT MIN({qk}), MAX({qk}) FROM {from_clause}")).one()
+    if lo is None:
+        return [Partition(0)], key_kind
+    if key_kind is None:
+        key_kind = "int" if isinstance(lo, int) else "date" if isinstance(lo, (_dt.date, str)) else None
+        if key_kind is None:
+            return [Partition(0)], None
+    if key_kind == "date" and isinstance(lo, str):
+        lo, hi = pd.Timestamp(lo).to_pydatetime(), pd.Timestamp(hi).to_pydatetime()
+    bounds = _split_range(lo, hi, parts, key_kind)
+    partitions = []
+    for i in range(len(bounds) - 1):
+        last = i == len(bounds) - 2
+        op = "<=" if last else "<"
+        partitions.append(Partition(i, f"{qk} >= :lo AND {qk} {op} :hi", {"lo": bounds[i], "hi": bounds[i + 1]}))
+    # 无论整数还是日期分区列，取值为 NULL 的行都只能由这个分区取到
+    partitions.append(Partition(len(partitions), f"{qk} IS NULL"))
+    return partitions, key_kind
+
+
+def _split_range(lo: Any, hi: Any, parts: int, key_kind: Optional[str]) -> list:
+    if key_kind == "int":
+        span_ = int(hi) - int(lo)
+        parts = max(1, min(parts, span_ + 1))
+        bounds = [int(lo) + span_ * i // parts for i in range(parts)] + [int(hi)]
+    else:
+        if isinstance(lo, _dt.date) and not isinstance(lo, _dt.datetime):
+            lo = _dt.datetime.combine(lo, _dt.time())
+            hi = _dt.datetime.combine(hi, _dt.time())
+        step = (hi - lo) / parts
+        bounds = [lo + step * i for i in range(parts)] + [hi]
+    # 去掉重复边界（取值范围小于分区数时）
+    return list(dict.fromkeys(bounds)) if len(set(bounds)) > 1 else [bounds[0], bounds[-1]]
+
+
+# ---------- 抽取 ----------
+
+def _write_chunk(table, path: str, fmt: str) -> None:
+    if fmt == "parquet":
+        pq.write_table(table, path, compression="zstd")
+    else:
+        with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+@dataclass
+class _ChunkBatch:
+    files: List[str] = field(default_factory=list)
+    rows: int = 0
+    stats: Dict[str, list] = field(default_factory=dict)
+    watermark: Any = None
+    empty: Any = None   # 结果为空时的零行表（保留列与类型），不写成分块文件
+
+
+def _json_value(v: Any) -> Any:
+    """pyarrow 标量 -> 可写入 manifest 的值（日期转 ISO 字符串）。"""
+    v = v.as_py() if hasattr(v, "as_py") else v
+    if isinstance(v, (_dt.date, _dt.datetime)):
+        return v.isoformat(sep=" ") if isinstance(v, _dt.datetime) else v.isoformat()
+    if isinstance(v, pd.Timestamp):
+        return v.isoformat(sep=" ")
+    return v
+
+
+def _max_value(a: Any, b: Any) -> Any:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return max(a, b, key=lambda v: (pd.Timestamp(v) if isinstance(v, str) else v))
+
+
+def _stream_to_files(engine, sql: str, params: dict, out_dir: str, prefix: str, fmt: str, chunk_rows: int,
+                     stat_col: Optional[str] = None, watermark: Optional[str] = None) -> _ChunkBatch:
+    """用服务端游标分块执行查询，每块写成一个文件；同时记录 merge_key 范围与水位最大值。"""
+    batch = _ChunkBatch()
+    with engine.connect() as conn:
+        # 服务端游标：分块取回，不把整个结果读进内存
+        conn = conn.execution_options(stream_results=True)
+        for n, chunk in enumerate(pd.read_sql_query(text(sql), conn, params=params, chunksize=chunk_rows)):
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if not len(chunk):
+                # 空分区不写文件：否则会留下 [None, None] 的键范围统计，且每次刷新都多出一个空分块
+                if batch.empty is None:
+                    batch.empty = table
+                continue
+            fname = f"{prefix}-{n:05d}.{fmt}"
+            _write_chunk(table, os.path.join(out_dir, fname), fmt)
+            batch.files.append(fname)
+            batch.rows += len(chunk)
+            if stat_col and stat_col in table.column_names:
+                mm = pc.min_max(table[stat_col])
+                batch.stats[fname] = [_json_value(mm["min"]), _json_value(mm["max"])]
+            if watermark and watermark in table.column_names:
+                batch.watermark = _max_value(batch.watermark, _json_value(pc.max(table[watermark])))
+    return batch
+
+
+def _extract_partition(engine, from_clause: str, part: Partition, out_dir: str, fmt: str, chunk_rows: int,
+                       stat_col: Optional[str], watermark: Optional[str]) -> _ChunkBatch:
+    sql = f"SELECT * FROM {from_clause}" + (f" WHERE {part.where}" if part.where else "")
+    with span("snapshot_partition", partition=part.index) as sp:
+        batch = _stream_to_files(engine, sql, part.params, out_dir, f"part-{part.index:04d}", fmt, chunk_rows,
+                                 stat_col, watermark)
+        sp["rows"] = batch.rows
+    return batch
+
+
+def _columns(engine, from_clause: str) -> List[str]:
+    with engine.connect() as conn:
+        return list(conn.execute(text(f"SELECT * FROM {from_clause} WHERE 1 = 0")).keys())
+
+
+def choose_watermark(columns: List[str], key: Optional[str], key_kind: Optional[str]) -> Tuple[Optional[str], str]:
+    """选择水位列：优先“最后修改时间”列（upsert），其次自增整数键或日期分区列（append）。"""
+    lowered = {str(c).lower(): c for c in columns}
+    for name in UPDATE_COLUMNS:
+        if name in lowered:
+            return lowered[name], "upsert"
+    if key and key in columns and key_kind in ("int", "date"):
+        return key, "append"
+    return None, "append"
+
+
+def extract_snapshot(engine, source: str, name: Optional[str] = None, is_query: bool = False,
+                     allowed_tables=None, key: Optional[str] = None, fmt: str = "arrow",
+                     parts: int = SNAPSHOT_PARTITIONS, workers: int = SNAPSHOT_WORKERS,
+                     chunk_rows: int = SNAPSHOT_CHUNK_ROWS, watermark: Optional[str] = None) -> SnapshotManifest:
+    """抽取表或 SELECT 到 SNAPSHOT_DIR/<name>，返回 manifest。
+
+    表名需在 allowed_tables 中（None 表示不限制）；SELECT 需通过只读校验。
+    查询来源时需显式给出 key 才会分区，否则整条查询作为一个分区流式读取。
+    watermark 为增量刷新使用的水位列，留空时由 choose_watermark 自动选择。
+    """
+    if pa is None:
+        raise RuntimeError("未安装 pyarrow，无法生成本地快照（pip install pyarrow）")
+    if fmt not in FORMATS:
+        raise ValueError(f"不支持的快照格式：{fmt}")
+    if is_query:
+        analysis = check_select(source, allowed_tables)
+        if not analysis.ok:
+            raise ValueError("SQL 未通过安全校验：" + "；".join(analysis.errors))
+        key_kind = None
+    else:
+        if allowed_tables is not None and source.lower() not in allowed_tables:
+            raise ValueError(f"不允许抽取表 {source}")
+        if key:
+            col_types = {c["name"]: c["type"] for c in inspect(engine).get_columns(source)}
+            key_kind = _kind(col_types.get(key)) if key in col_types else None
+            if key_kind is None:
+                raise ValueError(f"分区列 {key} 不存在或不是整数/日期类型")
+        else:
+            key, key_kind = choose_partition_key(engine, source)
+
+    name = name or (source if not is_query else f"query_{int(time.time())}")
+    path = snapshot_path(name)
+    tmp = path + ".partial"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    start = time.perf_counter()
+    from_clause = _from_clause(engine, source, is_query)
+    with span("snapshot_extract", source="query" if is_query else "table", key=key) as sp:
+        try:
+            partitions, key_kind = plan_partitions(engine, from_clause, key, key_kind, parts)
+            columns = _columns(engine, from_clause)
+            if watermark and watermark not in columns:
+                raise ValueError(f"水位列 {watermark} 不存在")
+            wm_mode = "upsert" if watermark and str(watermark).lower() in UPDATE_COLUMNS else "append"
+            if not watermark:
+                watermark, wm_mode = choose_watermark(columns, key, key_kind)
+            merge_key = key if key_kind == "int" else None
+            total = _ChunkBatch()
+            with ThreadPoolExecutor(max_workers=max(1, min(workers, len(partitions))),
+                                    thread_name_prefix="snapshot") as pool:
+                futures = [pool.submit(_extract_partition, engine, from_clause, p, tmp, fmt, chunk_rows,
+                                       merge_key, watermark)
+                           for p in partitions]
+                for fut in futures:
+                    b = fut.result()
+                    total.files.extend(b.files)
+                    total.rows += b.rows
+                    total.stats.update(b.stats)
+                    total.watermark = _max_value(total.watermark, b.watermark)
+                    if total.empty is None:
+                        total.empty = b.empty
+            if not total.files and total.empty is not None:
+                # 整个结果为空：写一个零行分块，加载时仍能得到列名与类型
+                fname = f"part-empty.{fmt}"
+                _write_chunk(total.empty, os.path.join(tmp, fname), fmt)
+                total.files.append(fname)
+        except Exception:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        manifest = SnapshotManifest(
+            name=os.path.basename(path), source=source, is_query=is_query, key=key, key_kind=key_kind,
+            fmt=fmt, rows=total.rows, files=total.files, partitions=len(partitions),
+            created_at=_dt.datetime.now().isoformat(timespec="seconds"),
+            elapsed_s=round(time.perf_counter() - start, 3),
+            merge_key=merge_key, watermark=watermark, watermark_mode=wm_mode,
+            watermark_value=total.watermark, file_stats=total.stats,
+        )
+        manifest.write(tmp)
+        # 完整写完后再替换旧快照，读者不会看到半成品
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp, path)
+        sp.update(rows=total.rows, partitions=len(partitions), files=len(total.files), watermark=watermark)
+    logger.info("快照 %s 完成：%d 行，%d 个分区，耗时 %.1fs", manifest.name, total.rows, len(partitions),
+                manifest.elapsed_s)
+    return manifest
+
+
+# ---------- 加载 ----------
+
+def _read_file(path: str, fmt: str):
+    if fmt == "parquet":
+        return pq.read_table(path, memory_map=True)
+    # Arrow IPC 文件直接内存映射，读取不经过用户态拷贝
+    return pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+
+
+def load_snapshot_table(name: str):
+    """以 pyarrow.Table 形式读取快照（各分块 schema 不一致时自动提升类型）。"""
+    if pa is None:
+        raise RuntimeError("未安装 pyarrow，无法读取本地快照")
+    path = snapshot_path(name)
+    manifest = SnapshotManifest.read(path)
+    tables = [_read_file(os.path.join(path, f), manifest.fmt) for f in manifest.files]
+    if not tables:
+        return pa.table({})
+    return pa.concat_tables(tables, promote_options="permissive")
+
+
+def load_snapshot(name: str) -> pd.DataFrame:
+    with span("snapshot_load", name=name) as sp:
+        df = load_snapshot_table(name).to_pandas(split_blocks=True)
+        sp["rows"] = len(df)
+    return df
+
+
+# ---------- 增量刷新 ----------
+
+_REFRESH_LOCKS: Dict[str, threading.Lock] = {}
+_REFRESH_LOCKS_GUARD = threading.Lock()
+
+
+@dataclass
+class RefreshResult:
+    name: str
+    fetched: int = 0            # 拉取到的新增/变更行
+    replaced: int = 0           # 被覆盖且确有变化的旧行
+    rewritten_files: int = 0    # 因覆盖而重写的旧分块数
+    rows: int = 0               # 刷新后的总行数
+    version: int = 0
+    watermark_value: Any = None
+    elapsed_s: float = 0.0
+
+    @property
+    def changed(self) -> bool:
+        return self.fetched > 0
+
+
+def _watermark_param(value: Any, kind: Optional[str]) -> Any:
+    if isinstance(value, str) and kind != "int":
+        try:
+            return pd.Timestamp(value).to_pydatetime()
+        except (ValueError, TypeError):
+            return value
+    return value
+
+
+def _read_column(path: str, fmt: str, column: str):
+    if fmt == "parquet":
+        return pq.read_table(path, columns=[column], memory_map=True)[column]
+    return _read_file(path, fmt)[column]
+
+
+def _equals_value(column, value: Any):
+    """column == 水位值（按列类型转换）；无法比较时返回 None。"""
+    if not (pa.types.is_string(column.type) or pa.types.is_large_string(column.type)):
+        value = _watermark_param(value, None)
+    try:
+        return pc.equal(column, pa.scalar(value).cast(column.type))
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError, TypeError):
+        return None
+
+
+def _unchanged_rows(delta_tables: list, old_tables: list) -> int:
+    """本次拉取中与被取代的旧行完全相同的行数（每次都会重新拉到的水位边界行、并未真正修改的行）。"""
+    if not delta_tables or not old_tables:
+        return 0
+    new = pa.concat_tables(delta_tables, promote_options="permissive").to_pandas()
+    old = pa.concat_tables(old_tables, promote_options="permissive").to_pandas()
+    if sorted(map(str, new.columns)) != sorted(map(str, old.columns)):
+        return 0
+    try:
+        return len(new.merge(old.drop_duplicates(), how="inner", on=list(new.columns)))
+    except (TypeError, ValueError):
+        return 0
+
+
+def _full_refresh(engine, m: SnapshotManifest, allowed_tables, chunk_rows: int, start: float) -> RefreshResult:
+    """无法安全增量刷新时重新全量抽取（沿用原分区列、格式与水位列），版本号加一。"""
+    new = extract_snapshot(engine, m.source, name=m.name, is_query=m.is_query, allowed_tables=allowed_tables,
+                           key=m.key, fmt=m.fmt, chunk_rows=chunk_rows, watermark=m.watermark)
+    new.version = m.version + 1
+    new.refreshed_at = _dt.datetime.now().isoformat(timespec="seconds")
+    new.write(snapshot_path(m.name))
+    return RefreshResult(name=new.name, fetched=new.rows, replaced=m.rows, rewritten_files=len(m.files),
+                         rows=new.rows, version=new.version, watermark_value=new.watermark_value,
+                         elapsed_s=round(time.perf_counter() - start, 3))
+
+
+def refresh_snapshot(engine, name: str, allowed_tables=None, chunk_rows: int = SNAPSHOT_CHUNK_ROWS) -> RefreshResult:
+    """按水位列增量刷新快照。
+
+    append 模式只拉取 `watermark > 上次水位` 的行并追加为新分块；水位不是整数（日期、时间）时
+    同一取值之后仍可能插入新行，改为拉取 `>=` 并替换快照中等于上次水位的旧行。
+    upsert 模式拉取 `watermark >= 上次水位` 的行，按 merge_key 删除旧版本（只重写键范围重叠的分块）；
+    没有 merge_key 时无法去重，改为全量重新抽取。
+    `>=` 每次都会重新拉到边界上的行：与快照中旧行完全相同的不计入 fetched，全部相同时不产生新版本。
+    manifest 最后原子替换，之后才删除被取代的文件。
+    """
+    if pa is None:
+        raise RuntimeError("未安装 pyarrow，无法刷新本地快照")
+    path = snapshot_path(name)
+    with _REFRESH_LOCKS_GUARD:
+        lock = _REFRESH_LOCKS.setdefault(path, threading.Lock())
+    with lock, span("snapshot_refresh", name=name) as sp:
+        start = time.perf_counter()
+        m = SnapshotManifest.read(path)
+        if not m.watermark:
+            raise ValueError(f"快照 {m.name} 没有可用的水位列，只能重新全量抽取")
+        if m.is_query:
+            analysis = check_select(m.source, allowed_tables)
+            if not analysis.ok:
+                raise ValueError("SQL 未通过安全校验：" + "；".join(analysis.errors))
+        elif allowed_tables is not None and m.source.lower() not in allowed_tables:
+            raise ValueError(f"不允许抽取表 {m.source}")
+
+        if m.watermark_mode == "upsert" and not m.merge_key:
+            # 没有唯一键无法覆盖旧版本，直接追加会让被修改的行重复出现
+            sp["mode"] = "full"
+            result = _full_refresh(engine, m, allowed_tables, chunk_rows, start)
+            logger.info("快照 %s 没有 merge_key，已全量重新抽取：%d 行", m.name, result.rows)
+            return result
+
+        version = m.version + 1
+        upsert = m.watermark_mode == "upsert"
+        # 非整数水位（日期/时间）：同一取值之后仍可能插入新行，按 >= 拉取并替换边界上的旧行
+        boundary = not upsert and m.watermark_value is not None and not isinstance(m.watermark_value, int)
+        qw = _quote(engine, m.watermark)
+        sql = f"SELECT * FROM {_from_clause(engine, m.source, m.is_query)}"
+        params = {}
+        if m.watermark_value is not None:
+            # upsert 用 >=：同一时间戳内稍后发生的修改不会被漏掉，重复行由 merge_key 去重
+            sql += f" WHERE {qw} {'>=' if upsert or boundary else '>'} :wm"
+            wm_kind = m.key_kind if m.watermark == m.key else None
+            params["wm"] = _watermark_param(m.watermark_value, wm_kind)
+        delta = _stream_to_files(engine, sql, params, path, f"delta-v{version:04d}", m.fmt, chunk_rows,
+                                 m.merge_key, m.watermark)
+        result = RefreshResult(name=m.name, fetched=delta.rows, version=m.version, rows=m.rows,
+                               watermark_value=m.watermark_value)
+
+        def _discard_delta() -> None:
+            for f in delta.files:
+                os.remove(os.path.join(path, f))
+
+        if not delta.rows:
+            _discard_delta()
+            result.elapsed_s = round(time.perf_counter() - start, 3)
+            sp.update(fetched=0)
+            return result
+
+        # 找出被本次拉取取代的旧行：upsert 按 merge_key，边界模式按水位值
+        if upsert:
+            keys = pa.chunked_array([_read_column(os.path.join(path, f), m.fmt, m.merge_key) for f in delta.files])
+            keys = pc.unique(keys)
+            lo, hi = _json_value(pc.min(keys)), _json_value(pc.max(keys))
+
+        def _match(f: str):
+            if upsert:
+                st = m.file_stats.get(f)
+                if st and (st[0] is None or st[1] is None):
+                    # 键全为 NULL（或旧版本留下的空分块），不可能与本次变更的键重合
+                    return None
+                # 键范围与本次变更不相交的分块无需读取
+                if st and (st[1] < lo or st[0] > hi):
+                    return None
+                table = _read_file(os.path.join(path, f), m.fmt)
+                return table, pc.is_in(table[m.merge_key], value_set=keys)
+            col = _read_column(os.path.join(path, f), m.fmt, m.watermark)
+            if col.null_count == len(col):
+                # 空分块或水位全为 NULL（列类型为 null）
+                return None
+            hit = _equals_value(col, m.watermark_value)
+            if hit is None:
+                raise TypeError(f"无法比较水位列 {m.watermark} 的取值")
+            if not (pc.sum(hit).as_py() or 0):
+                return None
+            return _read_file(os.path.join(path, f), m.fmt), hit
+
+        files = list(m.files)
+        stats = dict(m.file_stats)
+        obsolete: List[str] = []
+        rewritten: List[str] = []
+        replaced_tables = []
+        if upsert or boundary:
+            try:
+                matches = [(f, _match(f)) for f in m.files]
+            except TypeError:
+                _discard_delta()
+                sp["mode"] = "full"
+                return _full_refresh(engine, m, allowed_tables, chunk_rows, start)
+            for f, match in matches:
+                if match is None:
+                    continue
+                table, hit = match
+                n_hit = pc.sum(hit).as_py() or 0
+                if not n_hit:
+                    continue
+                kept = table.filter(pc.invert(hit))
+                replaced_tables.append(table.filter(hit))
+                obsolete.append(f)
+                files.remove(f)
+                stats.pop(f, None)
+                result.replaced += n_hit
+                result.rewritten_files += 1
+                if kept.num_rows:
+                    stem = re.sub(r"-r\d{4}$", "", os.path.splitext(f)[0])
+                    new_name = f"{stem}-r{version:04d}.{m.fmt}"
+                    _write_chunk(kept, os.path.join(path, new_name), m.fmt)
+                    files.append(new_name)
+                    rewritten.append(new_name)
+                    if m.merge_key:
+                        mm = pc.min_max(kept[m.merge_key])
+                        stats[new_name] = [_json_value(mm["min"]), _json_value(mm["max"])]
+        # >= 拉取总会重新拿到边界上的旧行：与被取代的旧行完全相同的不算新增/变更；都没变时保持原快照不变
+        unchanged = _unchanged_rows([_read_file(os.path.join(path, f), m.fmt) for f in delta.files],
+                                    replaced_tables)
+        replaced_rows = result.replaced
+        result.fetched = delta.rows - unchanged
+        result.replaced -= unchanged
+        if not result.fetched:
+            _discard_delta()
+            for f in rewritten:
+                os.remove(os.path.join(path, f))
+            result.replaced = result.rewritten_files = 0
+            result.elapsed_s = round(time.perf_counter() - start, 3)
+            sp.update(fetched=0)
+            return result
+
+        files.extend(delta.files)
+        stats.update(delta.stats)
+        m.files = files
+        m.file_stats = stats
+        m.rows = m.rows - replaced_rows + delta.rows
+        m.watermark_value = _max_value(m.watermark_value, delta.watermark)
+        m.version = version
+        m.refreshed_at = _dt.datetime.now().isoformat(timespec="seconds")
+        m.write(path)
+        for f in obsolete:
+            try:
+                os.remove(os.path.join(path, f))
+            except OSError:
+                logger.warning("删除旧分块失败：%s", f)
+
+        result.rows, result.version, result.watermark_value = m.rows, m.version, m.watermark_value
+        result.elapsed_s = round(time.perf_counter() - start, 3)
+        sp.update(fetched=result.fetched, replaced=result.replaced, rewritten_files=result.rewritten_files)
+    logger.info("快照 %s 增量刷新：新增/变更 %d 行，覆盖 %d 行，重写 %d 个分块", m.name, result.fetched,
+                result.replaced, result.rewritten_files)
+    return result
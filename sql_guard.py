@@ -0,0 +1,435 @@
+# sql_guard.py
+"""SQL 解析与只读校验。
+
+对模型生成的 SQL 只做一次词法切分与轻量解析：
+- 拒绝多语句、非 SELECT 语句以及写操作/危险函数；
+- 提取 FROM / JOIN 引用的表名（排除 CTE 与子查询别名），
+  与白名单（frozenset）做 O(1) 查找，而不是在 SQL 文本里做子串匹配；
+- 通过 EXPLAIN FORMAT=JSON 在执行前估算扫描行数与是否走索引。
+"""
+
+import json
+import logging
+import re
+from dataclasses import dataclass, field
+from typing import FrozenSet, Iterable, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# 任何位置出现都视为不安全的关键字（字符串与注释中的内容不参与判断）；
+# 后面紧跟 "(" 时按函数处理（如 MySQL 的 REPLACE()/INSERT() 字符串函数）
+FORBIDDEN_KEYWORDS = frozenset({
+    "insert", "update", "delete", "drop", "create", "alter", "truncate", "replace",
+    "grant", "revoke", "rename", "lock", "unlock", "into", "outfile", "dumpfile",
+})
+FORBIDDEN_FUNCTIONS = frozenset({"sleep", "benchmark", "load_file", "get_lock", "release_lock"})
+
+# 出现在表名之后、说明不是别名的关键字
+_CLAUSE_KEYWORDS = frozenset({
+    "where", "group", "order", "having", "limit", "on", "using", "join", "inner", "left", "right",
+    "full", "outer", "cross", "natural", "straight_join", "union", "except", "intersect", "window",
+    "for", "lateral", "as", "force", "ignore", "use", "partition", "offset", "select", "from",
+})
+
+# 参数语法中带 FROM 的函数：EXTRACT(YEAR FROM d)、TRIM(BOTH ' ' FROM s)、SUBSTRING(s FROM 2) ……
+# 其括号内（不含嵌套子查询）的 FROM 不是表引用
+_FROM_FUNCTIONS = frozenset({"extract", "trim", "substring", "substr", "overlay"})
+
+_TOKEN_RE = re.compile(
+    r"""
+    (?P<ws>\s+)
+  | (?P<comment>--[^\n]*|\#[^\n]*|/\*.*?\*/)
+  | (?P<string>'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*")
+  | (?P<qident>`(?:[^`]|``)*`)
+  | (?P<number>\d+(?:\.\d*)?(?:[eE][+-]?\d+)?)
+  | (?P<ident>[A-Za-z_\u0080-\uffff][\w$\u0080-\uffff]*)
+  | (?P<op><=>|<=|>=|<>|!=|\|\||&&|[(),.;*=<>+\-/%!~^&|@:?])
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+
+@dataclass
+class Token:
+    kind: str   # keyword/ident 统一为 "ident"；另有 "qident" "string" "number" "op"
+    value: str  # ident 已转小写；qident 去掉反引号
+    start: int = 0   # 在原 SQL 中的位置 [start, end)
+    end: int = 0
+
+    def is_word(self, *words: str) -> bool:
+        return self.kind == "ident" and self.value in words
+
+
+def tokenize(sql: str) -> List[Token]:
+    """把 SQL 切分为 token（丢弃空白与注释）；无法识别的字符会抛出 ValueError。"""
+    tokens: List[Token] = []
+    pos = 0
+    n = len(sql)
+    while pos < n:
+        m = _TOKEN_RE.match(sql, pos)
+        if not m:
+            raise ValueError(f"无法解析的字符：{sql[pos:pos + 20]!r}")
+        kind = m.lastgroup
+        val = m.group()
+        start, pos = m.start(), m.end()
+        if kind in ("ws", "comment"):
+            continue
+        if kind == "ident":
+            val = val.lower()
+        elif kind == "qident":
+            val = val[1:-1].replace("``", "`").lower()
+        tokens.append(Token(kind, val, start, pos))
+    return tokens
+
+
+def strip_trailing(sql: str) -> str:
+    """去掉末尾的空白、注释与分号（追加 LIMIT 等子句前使用，避免被行尾注释吞掉）。"""
+    tokens = tokenize(sql or "")
+    while tokens and tokens[-1].kind == "op" and tokens[-1].value == ";":
+        tokens.pop()
+    return sql[:tokens[-1].end] if tokens else ""
+
+
+def top_level_select_end(sql: str) -> Optional[int]:
+    """最外层查询的 SELECT 关键字结束位置（跳过 WITH 中的 CTE 定义）；没有时返回 None。"""
+    depth = 0
+    for tok in tokenize(sql or ""):
+        if tok.kind == "op" and tok.value == "(":
+            depth += 1
+        elif tok.kind == "op" and tok.value == ")":
+            depth -= 1
+        elif depth == 0 and tok.is_word("select"):
+            return tok.end
+    return None
+
+
+@dataclass
+class SqlAnalysis:
+    sql: str
+    statement_type: str = ""
+    tables: Set[str] = field(default_factory=set)   # 小写，带库名时为 "schema.table"
+    errors: List[str] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+
+def _match_parens(tokens: List[Token]) -> List[int]:
+    """每个 "(" 对应的 ")" 下标；未闭合时为 len(tokens)。其余位置为 -1。"""
+    match = [-1] * len(tokens)
+    stack: List[int] = []
+    for i, tok in enumerate(tokens):
+        if tok.kind == "op" and tok.value == "(":
+            stack.append(i)
+        elif tok.kind == "op" and tok.value == ")" and stack:
+            match[stack.pop()] = i
+    for i in stack:
+        match[i] = len(tokens)
+    return match
+
+
+class _Scanner:
+    """按 token 区间扫描 SQL：检查危险关键字/函数，收集 FROM/JOIN 引用的表与 CTE 名称。
+
+    表引用按 MySQL 的 table_references 语法读取：逗号列表、括号中的表列表或 join、
+    派生表（子查询）、别名以及 USE/FORCE/IGNORE INDEX 提示，嵌套的括号递归处理。
+    """
+
+    def __init__(self, tokens: List[Token]):
+        self.tokens = tokens
+        self.match = _match_parens(tokens)
+        self.tables: Set[str] = set()
+        self.cte_names: Set[str] = set()
+        self.errors: List[str] = []
+
+    def _is_op(self, i: int, hi: int, value: str) -> bool:
+        return i < hi and self.tokens[i].kind == "op" and self.tokens[i].value == value
+
+    def _is_word(self, i: int, hi: int, *words: str) -> bool:
+        return i < hi and self.tokens[i].is_word(*words)
+
+    def _skip_parens(self, i: int, hi: int) -> int:
+        """i 指向 "(" 时跳过整个括号，返回其后的位置。"""
+        return min(self.match[i], hi) + 1
+
+    def scan(self, lo: int, hi: int) -> None:
+        tokens = self.tokens
+        parens: List[str] = []   # 每层括号前的函数名（非函数调用时为空串）
+        i = lo
+        while i < hi:
+            tok = tokens[i]
+            if tok.kind == "op" and tok.value == "(":
+                prev = tokens[i - 1] if i > lo else None
+                parens.append(prev.value if prev is not None and prev.kind == "ident" else "")
+            elif tok.kind == "op" and tok.value == ")":
+                if parens:
+                    parens.pop()
+            elif tok.kind == "ident":
+                is_call = self._is_op(i + 1, hi, "(")
+                if tok.value in FORBIDDEN_KEYWORDS and not is_call:
+                    self.errors.append(f"包含不允许的关键字：{tok.value.upper()}")
+                elif tok.value in FORBIDDEN_FUNCTIONS and is_call:
+                    self.errors.append(f"包含不允许的函数：{tok.value.upper()}")
+                elif tok.value == "for" and self._is_word(i + 1, hi, "update", "share"):
+                    self.errors.append("不允许加锁读（FOR UPDATE / FOR SHARE）")
+                if tok.value == "from" and parens and parens[-1] in _FROM_FUNCTIONS:
+                    i += 1
+                    continue
+                if tok.value in ("from", "join", "straight_join"):
+                    i = self.read_table_refs(i + 1, hi)
+                    continue
+                # WITH name [(cols)] AS (...)：记录 CTE 名称
+                if self._is_word(i + 1, hi, "as") and self._is_op(i + 2, hi, "("):
+                    prev = tokens[i - 1] if i > 0 else None
+                    if prev is not None and (prev.is_word("with", "recursive") or (prev.kind == "op" and prev.value == ",")):
+                        self.cte_names.add(tok.value)
+            elif tok.kind == "qident" and self._is_word(i + 1, hi, "as") and self._is_op(i + 2, hi, "("):
+                self.cte_names.add(tok.value)
+            i += 1
+
+    def read_table_refs(self, i: int, hi: int) -> int:
+        """从 FROM/JOIN 之后的位置读取逗号分隔的表引用，返回停止位置（JOIN/ON/WHERE 等交给 scan）。"""
+        while i < hi:
+            i = self._read_table_factor(i, hi)
+            if self._is_op(i, hi, ","):
+                i += 1
+                continue
+            return i
+        return i
+
+    def _read_table_factor(self, i: int, hi: int) -> int:
+        tokens = self.tokens
+        tok = tokens[i]
+        if tok.kind == "op" and tok.value == "(":
+            end = min(self.match[i], hi)
+            if self._is_word(i + 1, end, "select", "with"):
+                # 派生表：子查询整体重新扫描
+                self.scan(i + 1, end)
+            else:
+                # 括号中的表列表或 join，如 (t1, t2)、(t2 JOIN t3 ON ...)；内层再嵌套子查询时递归
+                k = self.read_table_refs(i + 1, end)
+                self.scan(k, end)
+            i = end + 1
+        elif tok.kind == "qident" or (tok.kind == "ident" and tok.value not in _CLAUSE_KEYWORDS
+                                      and tok.value not in FORBIDDEN_KEYWORDS):
+            name = tok.value
+            i += 1
+            if self._is_op(i, hi, ".") and i + 1 < hi and tokens[i + 1].kind in ("ident", "qident"):
+                name = f"{name}.{tokens[i + 1].value}"
+                i += 2
+            self.tables.add(name)
+            if self._is_word(i, hi, "partition") and self._is_op(i + 1, hi, "("):
+                i = self._skip_parens(i + 1, hi)
+        else:
+            return i
+        # 可选别名：[AS] alias
+        if self._is_word(i, hi, "as"):
+            i += 1
+        if i < hi and (tokens[i].kind == "qident" or (tokens[i].kind == "ident" and tokens[i].value not in _CLAUSE_KEYWORDS
+                                                      and tokens[i].value not in FORBIDDEN_KEYWORDS)):
+            i += 1
+        return self._skip_index_hints(i, hi)
+
+    def _skip_index_hints(self, i: int, hi: int) -> int:
+        """跳过 {USE|FORCE|IGNORE} {INDEX|KEY} [FOR {JOIN|ORDER BY|GROUP BY}] (...)，可连续多个。"""
+        while self._is_word(i, hi, "use", "force", "ignore") and self._is_word(i + 1, hi, "index", "key"):
+            i += 2
+            if self._is_word(i, hi, "for"):
+                i += 1
+                if self._is_word(i, hi, "join"):
+                    i += 1
+                elif self._is_word(i, hi, "order", "group") and self._is_word(i + 1, hi, "by"):
+                    i += 2
+            if self._is_op(i, hi, "("):
+                i = self._skip_parens(i, hi)
+        return i
+
+
+def analyze_sql(sql: str) -> SqlAnalysis:
+    """解析一次 SQL，返回语句类型、引用表集合与错误列表。"""
+    result = SqlAnalysis(sql=sql)
+    try:
+        tokens = tokenize(sql or "")
+    except ValueError as e:
+        result.errors.append(str(e))
+        return result
+    # 允许末尾一个分号，其余分号一律视为多语句
+    while tokens and tokens[-1].kind == "op" and tokens[-1].value == ";":
+        tokens.pop()
+    if not tokens:
+        result.errors.append("SQL 为空")
+        return result
+    if any(t.kind == "op" and t.value == ";" for t in tokens):
+        result.errors.append("检测到多条语句（包含分号）")
+
+    first = next((t for t in tokens if not (t.kind == "op" and t.value == "(")), tokens[0])
+    result.statement_type = first.value.upper() if first.kind == "ident" else ""
+    if result.statement_type not in ("SELECT", "WITH"):
+        result.errors.append(f"仅允许 SELECT 查询，检测到：{result.statement_type or first.value}")
+
+    scanner = _Scanner(tokens)
+    scanner.scan(0, len(tokens))
+    result.errors.extend(scanner.errors)
+    result.tables = {t for t in scanner.tables if t not in scanner.cte_names}
+    # 去重错误信息，保持顺序
+    result.errors = list(dict.fromkeys(result.errors))
+    return result
+
+
+def _top_level_limit_token(tokens: List[Token]) -> Optional[Token]:
+    """最外层 LIMIT 中表示行数的数字 token（LIMIT n / LIMIT off, n / LIMIT n OFFSET m）。"""
+    depth = 0
+    found = None
+    for i, tok in enumerate(tokens):
+        if tok.kind == "op" and tok.value == "(":
+            depth += 1
+        elif tok.kind == "op" and tok.value == ")":
+            depth -= 1
+        elif depth == 0 and tok.is_word("limit") and i + 1 < len(tokens) and tokens[i + 1].kind == "number":
+            found = tokens[i + 1]
+            if i + 3 < len(tokens) and tokens[i + 2].value == "," and tokens[i + 3].kind == "number":
+                found = tokens[i + 3]
+    return found
+
+
+def top_level_limit(sql: str) -> Optional[int]:
+    """返回最外层 LIMIT 的行数（LIMIT n / LIMIT off, n / LIMIT n OFFSET m）；无 LIMIT 时返回 None。"""
+    tok = _top_level_limit_token(tokenize(sql or ""))
+    return int(float(tok.value)) if tok is not None else None
+
+
+def replace_top_level_limit(sql: str, n: int) -> str:
+    """把最外层 LIMIT 的行数改为 n（保留 OFFSET 与其余文本）；没有最外层 LIMIT 时原样返回。"""
+    tok = _top_level_limit_token(tokenize(sql or ""))
+    if tok is None:
+        return sql
+    return sql[:tok.start] + str(int(n)) + sql[tok.end:]
+
+
+def build_allowlist(tables: Optional[Iterable[str]], schema: Optional[str] = None) -> Optional[FrozenSet[str]]:
+    """把表名列表规范化为小写 frozenset，供 is_safe_select 做 O(1) 查找；None 表示不限制。
+
+    给出 schema（当前库名）时，同时加入 "schema.table" 形式，允许带本库库名的引用；
+    "schema.*" 形式的条目放行该库下的所有表。
+    """
+    if tables is None:
+        return None
+    if isinstance(tables, frozenset) and not schema:
+        return tables
+    names = {str(t).lower() for t in tables if t}
+    if schema:
+        names |= {f"{schema.lower()}.{t}" for t in names if "." not in t}
+    return frozenset(names)
+
+
+def disallowed_tables(analysis: SqlAnalysis, allowed_tables) -> Set[str]:
+    """返回不在白名单中的表。
+
+    带库名的引用（schema.table）按完整名称匹配（见 build_allowlist 的 schema 参数）；
+    整库放行需显式写成 "schema.*"（如 information_schema.*）。
+    只有表名或库名碰巧在白名单中都不够：otherdb.users 不因 users 放行，orders.x 也不因 orders 放行。
+    """
+    allowed = build_allowlist(allowed_tables)
+    if allowed is None:
+        return set()
+    bad = set()
+    for t in analysis.tables:
+        if t in allowed:
+            continue
+        if "." in t and f"{t.partition('.')[0]}.*" in allowed:
+            continue
+        bad.add(t)
+    return bad
+
+
+def check_select(sql_text: str, allowed_tables=None) -> SqlAnalysis:
+    """解析并校验 SQL；白名单外的表会作为错误追加到返回结果中。"""
+    analysis = analyze_sql(sql_text)
+    bad = disallowed_tables(analysis, allowed_tables)
+    if bad:
+        analysis.errors.append(f"引用了不在白名单中的表：{', '.join(sorted(bad))}")
+    return analysis
+
+
+def is_safe_select(sql_text: str, allowed_tables=None) -> bool:
+    """只读 SELECT 且引用的表全部在白名单中（allowed_tables 为 None 时不检查表）。"""
+    return check_select(sql_text, allowed_tables).ok
+
+
+@dataclass
+class QueryCost:
+    """EXPLAIN FORMAT=JSON 的估算结果。"""
+    rows_examined: float = 0.0
+    query_cost: Optional[float] = None
+    full_scan_tables: List[str] = field(default_factory=list)
+    uses_index: bool = True
+    raw: Optional[dict] = None
+    error: Optional[str] = None   # EXPLAIN 执行失败时的错误信息
+
+
+def _walk_explain(node, tables: list):
+    if isinstance(node, dict):
+        if "table" in node and isinstance(node["table"], dict):
+            tables.append(node["table"])
+        for k, v in node.items():
+            if k != "table":
+                _walk_explain(v, tables)
+        if "table" in node and isinstance(node["table"], dict):
+            # table 节点内部可能还有 materialized_from_subquery 等嵌套
+            for k, v in node["table"].items():
+                if isinstance(v, (dict, list)):
+                    _walk_explain(v, tables)
+    elif isinstance(node, list):
+        for item in node:
+            _walk_explain(item, tables)
+
+
+def parse_explain_json(plan: dict) -> QueryCost:
+    """从 MySQL EXPLAIN FORMAT=JSON 的结果中提取扫描行数估算与全表扫描信息。"""
+    cost = QueryCost(raw=plan)
+    qb = plan.get("query_block", plan) if isinstance(plan, dict) else {}
+    try:
+        cost.query_cost = float(qb.get("cost_info", {}).get("query_cost"))
+    except (TypeError, ValueError):
+        cost.query_cost = None
+    tables: list = []
+    _walk_explain(plan, tables)
+    # 嵌套循环中，每张表被扫描的次数约等于前缀结果行数
+    prefix_rows = 1.0
+    for t in tables:
+        per_scan = float(t.get("rows_examined_per_scan") or 0)
+        cost.rows_examined += per_scan * max(prefix_rows, 1.0)
+        produced = t.get("rows_produced_per_join")
+        if produced is not None:
+            try:
+                prefix_rows = float(produced)
+            except (TypeError, ValueError):
+                pass
+        if t.get("access_type") == "ALL":
+            cost.full_scan_tables.append(str(t.get("table_name", "?")))
+    cost.uses_index = not cost.full_scan_tables
+    return cost
+
+
+def explain_cost(engine, sql_text: str) -> Optional[QueryCost]:
+    """执行 EXPLAIN FORMAT=JSON 估算代价；非 MySQL 时返回 None。
+
+    EXPLAIN 失败时返回带 error 的 QueryCost，由调用方拒绝执行（代价未知的查询不放行）。
+    SQL 按原文交给驱动（exec_driver_sql + no_parameters），
+    字面量中的 ':name'、'%H' 不会被当作绑定参数或格式占位符。
+    """
+    if engine is None or getattr(engine.dialect, "name", "") != "mysql":
+        return None
+    try:
+        with engine.connect() as conn:
+            row = conn.exec_driver_sql(
+                "EXPLAIN FORMAT=JSON " + sql_text.strip().rstrip(";"),
+                execution_options={"no_parameters": True},
+            ).fetchone()
+        if not row:
+            return QueryCost(error="EXPLAIN 未返回结果")
+        return parse_explain_json(json.loads(row[0]))
+    except Exception as e:
+        logger.warning("EXPLAIN 失败：%s", e)
+        return QueryCost(error=f"EXPLAIN 失败：{e}")
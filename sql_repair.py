@@ -0,0 +1,295 @@
+# sql_repair.py
+"""SQL 执行失败后的自动修复。
+
+一轮修复的流程：
+1. 把原始 SQL、错误信息与 schema 提示交给模型，取回一条或多条修正/探测 SELECT；
+2. 统一做只读校验后，在连接池上并发执行（每条带执行超时与行数上限）；
+3. 把所有结果汇总后一次性交回模型，得到最终 SQL 并经代价守卫执行。
+只返回一条修正 SQL 时直接执行；这一条若只是探测扫描（SELECT * FROM t LIMIT n），仍按探测处理。
+
+整轮最多两次模型调用、两批数据库查询，不再需要逐条点击按钮。
+"""
+
+import logging
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass, field, replace
+from typing import List, Optional
+
+import pandas as pd
+
+from db import QueryGuardConfig, execute_guarded
+from prompt_budget import RESULT, SCHEMA, Section, fit
+from sql_guard import analyze_sql, check_select, strip_trailing, tokenize, top_level_select_end
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+PROBE_ROW_CAP = 50          # 探测语句的行数上限
+PROBE_TIMEOUT_MS = 10_000   # 单条探测语句的执行超时
+PROBE_MAX_WORKERS = 4       # 并发度（不超过连接池默认大小）
+PROBE_TOTAL_TIMEOUT_S = 30  # 整批探测的等待上限
+ERROR_MAX_TOKENS = 800      # 错误信息（可能带很长的驱动堆栈）最多保留的 token 数
+
+FIX_PROMPT = (
+    "下面是一个 SQL 语句及其执行时的错误信息。请在确保只读的前提下修正该 SQL。"
+    "为了定位列名或数据问题，你可以采用以下两种策略之一："
+    "(1) 返回一个宽泛的安全扫描语句，例如 `SELECT * FROM <table> LIMIT 100`，用于查看表的真实列和值；"
+    "(2) 或者返回多条安全的探测查询（多条之间空一行、不要分号），每条用于检查某些候选列或筛选条件。"
+    "如果能直接修正，就只返回修正后的那一条 SQL。"
+    "请只返回 SQL 语句（一条或多条，多条之间空一行），不要任何解释或分号。\n"
+)
+
+FINAL_PROMPT = (
+    "下面是一个执行失败的 SQL、错误信息，以及为定位问题而执行的探测查询结果。"
+    "请根据探测结果写出最终的一条只读 SELECT 查询，使其能回答原始问题。"
+    "只返回这一条 SQL，不要解释、注释或分号。\n"
+)
+
+
+@dataclass
+class ProbeResult:
+    sql: str
+    ok: bool = False
+    df: Optional[pd.DataFrame] = None
+    error: str = ""
+    elapsed_ms: float = 0.0
+
+
+@dataclass
+class RepairOutcome:
+    final_sql: str = ""
+    df: Optional[pd.DataFrame] = None
+    error: str = ""
+    probes: List[ProbeResult] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return self.df is not None
+
+
+_FENCE_RE = re.compile(r"^\s*```[\w-]*\s*$")
+# 出现在行尾时，说明下一行的 SELECT 是同一条语句的一部分
+_CONTINUES = frozenset({"union", "all", "except", "intersect", "distinct", "as", "in", "exists", "("})
+
+
+def _strip_fences(text: str) -> str:
+    """整体去掉 Markdown 代码块标记（```sql ... ```），以及单独一行的 "sql" 标签；不动语句内的反引号标识符。"""
+    lines = [ln for ln in (text or "").strip().splitlines() if not _FENCE_RE.match(ln)]
+    body = "\n".join(lines).strip()
+    if body.startswith("```") and body.endswith("```"):
+        body = body[3:-3].strip()
+        if body.lower().startswith("sql") and body[3:4].isspace():
+            body = body[3:].strip()
+    if body.lower().startswith("sql\n"):
+        body = body[4:].strip()
+    return body
+
+
+def _paren_depth(sql: str) -> int:
+    try:
+        tokens = tokenize(sql)
+    except ValueError:
+        return sql.count("(") - sql.count(")")
+    return sum(1 if t.value == "(" else -1 for t in tokens if t.kind == "op" and t.value in "()")
+
+
+def _split_statements(block: str) -> List[str]:
+    """把一段文本按分号与"新起一行的顶层 SELECT/WITH"切成语句，续行拼回所属语句。"""
+    statements: List[str] = []
+    current: List[str] = []
+    for ln in block.splitlines():
+        s = ln.strip()
+        if not s:
+            continue
+        starts_new = s.lower().startswith(("select", "with"))
+        if current and starts_new:
+            joined = "\n".join(current)
+            last_word = joined.split()[-1].lower() if joined.split() else ""
+            # WITH 语句在主查询的 SELECT 出现之前都属于同一条
+            try:
+                in_cte = joined.lower().startswith("with") and top_level_select_end(joined) is None
+            except ValueError:
+                in_cte = False
+            if _paren_depth(joined) <= 0 and last_word not in _CONTINUES and not in_cte:
+                statements.append(joined)
+                current = []
+        current.append(s)
+    if current:
+        statements.append("\n".join(current))
+    out = []
+    for stmt in statements:
+        try:
+            tokens = tokenize(stmt)
+        except ValueError:
+            out.extend(p.strip() for p in stmt.split(";"))
+            continue
+        start = 0
+        for t in tokens:
+            if t.kind == "op" and t.value == ";":
+                out.append(stmt[start:t.start].strip())
+                start = t.end
+        out.append(stmt[start:].strip())
+    return [s for s in out if s]
+
+
+def parse_sql_statements(text: str) -> List[str]:
+    """解析模型返回的一条或多条 SQL。
+
+    语句之间以空行、分号或新起一行的顶层 SELECT/WITH 分隔，同一语句的续行（FROM/GROUP BY ……）拼回一起；
+    只保留 SELECT/WITH 开头的语句，都不匹配时退回首条；结果去重并保持顺序。
+    """
+    body = _strip_fences(text)
+    statements: List[str] = []
+    for block in re.split(r"\n\s*\n", body):
+        statements.extend(_split_statements(block))
+    sqls = [s for s in statements if s.lower().startswith(("select", "with"))]
+    if not sqls and statements:
+        sqls = [statements[0]]
+    return list(dict.fromkeys(sqls))
+
+
+def parse_single_statement(text: str) -> str:
+    """解析只应返回一条 SQL 的模型输出：去掉代码块标记后，从首个 SELECT/WITH 行到第一个分号（或结尾）整体作为一条语句。
+
+    与 parse_sql_statements 不同，不按行拆分，换行的子查询、UNION 等都保留在同一条语句里。
+    """
+    lines = _strip_fences(text).splitlines()
+    start = next((i for i, ln in enumerate(lines) if ln.strip().lower().startswith(("select", "with"))), 0)
+    stmt = "\n".join(lines[start:]).strip()
+    try:
+        semi = next((t for t in tokenize(stmt) if t.kind == "op" and t.value == ";"), None)
+    except ValueError:
+        return stmt.split(";")[0].strip()
+    return stmt[:semi.start].strip() if semi is not None else stmt
+
+
+def looks_like_probe(sql: str) -> bool:
+    """是否为探测语句：SELECT * FROM <table> [LIMIT n] 式的宽泛扫描，或只查询 information_schema。"""
+    try:
+        tokens = tokenize(strip_trailing(sql))
+    except ValueError:
+        return False
+    words = [t.value for t in tokens]
+    if words[:3] == ["select", "*", "from"]:
+        rest = words[3:]
+        # 表名可带库名：t / schema . t
+        if len(rest) >= 3 and rest[1] == ".":
+            rest = rest[3:]
+        elif rest:
+            rest = rest[1:]
+        if not rest or (len(rest) == 2 and rest[0] == "limit" and tokens[-1].kind == "number"):
+            return True
+    tables = analyze_sql(sql).tables
+    return bool(tables) and all(t.startswith("information_schema.") for t in tables)
+
+
+def _run_one(engine, sql: str, guard: QueryGuardConfig) -> ProbeResult:
+    start = time.perf_counter()
+    res = ProbeResult(sql=sql)
+    try:
+        with span("sql_execute", source="repair_probe"):
+            res.df, _ = execute_guarded(engine, sql, guard)
+        res.ok = True
+    except Exception as e:
+        res.error = str(e)
+    res.elapsed_ms = (time.perf_counter() - start) * 1000
+    return res
+
+
+def run_statements(engine, sqls: List[str], allowed_tables=None, guard: Optional[QueryGuardConfig] = None,
+                   row_cap: int = PROBE_ROW_CAP, timeout_ms: int = PROBE_TIMEOUT_MS,
+                   max_workers: int = PROBE_MAX_WORKERS, total_timeout_s: float = PROBE_TOTAL_TIMEOUT_S) -> List[ProbeResult]:
+    """校验并并发执行多条只读 SQL，结果顺序与输入一致。"""
+    base = guard or QueryGuardConfig.load()
+    probe_guard = replace(base, row_cap=row_cap, max_execution_ms=min(timeout_ms, base.max_execution_ms or timeout_ms))
+    results: List[Optional[ProbeResult]] = [None] * len(sqls)
+    pending = {}
+    pool = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(sqls) or 1)), thread_name_prefix="sql-probe")
+    try:
+        for idx, sql in enumerate(sqls):
+            analysis = check_select(sql, allowed_tables)
+            if not analysis.ok:
+                results[idx] = ProbeResult(sql=sql, error="未通过安全校验：" + "；".join(analysis.errors))
+                continue
+            pending[pool.submit(_run_one, engine, sql, probe_guard)] = idx
+        done, not_done = wait(pending, timeout=total_timeout_s)
+        for fut in done:
+            results[pending[fut]] = fut.result()
+        for fut in not_done:
+            results[pending[fut]] = ProbeResult(sql=sqls[pending[fut]], error=f"超过 {total_timeout_s}s 未完成")
+    finally:
+        # 不等待超时的查询：服务端 MAX_EXECUTION_TIME 会终止它们，连接随后归还连接池
+        pool.shutdown(wait=False, cancel_futures=True)
+    return [r for r in results if r is not None]
+
+
+def summarize_probes(probes: List[ProbeResult], max_rows: int = 5, max_chars: int = 4000) -> str:
+    """把探测结果压缩成给模型看的文本（列名 + 前几行）。"""
+    parts = []
+    for i, p in enumerate(probes, 1):
+        if p.ok and p.df is not None:
+            head = p.df.head(max_rows).astype(str).to_csv(index=False)
+            parts.append(f"[{i}] {p.sql}\n成功，{len(p.df)} 行，列：{list(p.df.columns)}\n{head}")
+        else:
+            parts.append(f"[{i}] {p.sql}\n失败：{p.error}")
+    text = "\n".join(parts)
+    return text[:max_chars] + ("..." if len(text) > max_chars else "")
+
+
+def _repair_prompt(name: str, head: str, schema_info: str, sql: str, error: str, tail: str,
+                   probes: str = "") -> str:
+    """按 token 预算组装修复 prompt：指令与原始 SQL 不裁剪，超预算时依次裁剪探测结果、表结构、错误信息。"""
+    sections = [
+        Section("instruction", head),
+        Section("schema", schema_info, SCHEMA),
+        Section("sql", f"原始 SQL: {sql}\n"),
+        Section("error", f"错误信息: {error}\n", SCHEMA + 10, max_tokens=ERROR_MAX_TOKENS),
+        Section("probes", f"探测结果：\n{probes}\n" if probes else "", RESULT),
+        Section("tail", tail),
+    ]
+    return fit(sections, name=name).text
+
+
+def auto_repair(llm, engine, sql: str, error: str, allowed_tables=None, schema_info: str = "",
+                guard: Optional[QueryGuardConfig] = None) -> RepairOutcome:
+    """一轮有界的自动修复：修正/探测 -> 并发执行 -> 汇总给模型 -> 执行最终 SQL。"""
+    outcome = RepairOutcome()
+    with span("sql_auto_repair") as sp:
+        fix_resp = llm.predict(_repair_prompt("sql_fix", FIX_PROMPT, schema_info, sql, error,
+                                              "请返回修正后的 SQL（一条或多条，多条之间空一行）："))
+        candidates = parse_sql_statements(fix_resp)
+        if not candidates:
+            outcome.error = f"模型未返回修正后的 SQL：{fix_resp}"
+            sp["status"] = "no_candidates"
+            return outcome
+
+        if len(candidates) == 1 and not looks_like_probe(candidates[0]):
+            # 只有一条且不是探测扫描：直接作为修正结果按正常上限执行，不再额外探测
+            final_sql = candidates[0]
+        else:
+            outcome.probes = run_statements(engine, candidates, allowed_tables, guard)
+            sp["probes"] = len(outcome.probes)
+            final_resp = llm.predict(_repair_prompt("sql_final", FINAL_PROMPT, schema_info, sql, error,
+                                                    "最终 SQL：", probes=summarize_probes(outcome.probes)))
+            final = parse_sql_statements(final_resp)
+            if not final:
+                outcome.error = f"模型未给出最终 SQL：{final_resp}"
+                sp["status"] = "no_final"
+                return outcome
+            final_sql = final[0]
+
+        outcome.final_sql = final_sql
+        analysis = check_select(final_sql, allowed_tables)
+        if not analysis.ok:
+            outcome.error = "最终 SQL 未通过安全校验：" + "；".join(analysis.errors)
+            sp["status"] = "unsafe_final"
+            return outcome
+        try:
+            with span("sql_execute", source="repair_final"):
+                outcome.df, _ = execute_guarded(engine, final_sql, guard)
+        except Exception as e:
+            outcome.error = str(e)
+            sp["status"] = "final_failed"
+    return outcome
@@ -1,55 +1,64 @@
 import os
-import io
 import streamlit as st
 import pandas as pd
 
-from analytibot import load_data, get_analysis_code, execute_code, DATA_FILE
+from analytibot import load_data, get_analysis_code, execute_code, DATA_FILE, llm
+import local_sql
+import progressive
+from rollup import build_rollup
+from column_select import profile_columns
+from upload_loader import UPLOAD_TYPES, load_upload, stream_key
+from sql_repair import parse_single_statement
+from tracing import span
+from result_view import ResultPager, render_page
+from export import render_export
+from jobs import SCHEDULER, JobCancelled, handle_cancel_requests, render_jobs, run_job, session_user, wait_job
+from datastore import STORE
 
 st.set_page_config(page_title="AnalytiBot-Mini", layout="wide")
 
 st.title("AnalytiBot-Mini — Streamlit 界面")
+# 模型调用与执行在共享作业池中进行（见 jobs.py）；先处理上一轮点击的取消
+handle_cancel_requests()
+render_jobs()
 
-uploaded = st.file_uploader("上传 CSV 文件（可选）", type=["csv"])
+uploaded = st.file_uploader("上传数据文件（CSV，可 gzip/zstd 压缩；或 Parquet、Feather）", type=UPLOAD_TYPES)
 
-if uploaded is not None:
-    content = uploaded.getvalue()
-    last_exc = None
-    for enc in ("utf-8", "utf-8-sig", "gbk", "gb2312", "latin1", "cp1252"):
-        try:
-            # 使用 BytesIO + encoding 以兼容不同 pandas 版本
-            df = pd.read_csv(io.BytesIO(content), encoding=enc)
-            st.success(f"已上传（encoding={enc}），{len(df)} 行，列：{list(df.columns)}")
-            break
-        except Exception as e:
-            last_exc = e
-    else:
-        st.error(f"读取上传文件失败：{last_exc}")
-        st.stop()
-else:
-    st.warning("请上传 CSV 文件。")
+if uploaded is None:
+    st.warning("请上传数据文件。")
     st.stop()
 
-question = st.text_input("请输入你的分析问题：", value="数据分析")
-plot_name = st.text_input("生成图表文件名：", value="output_plot.png")
-
-if st.button("开始分析"):
-    with st.spinner("正在生成分析代码..."):
+# 数据集放在跨会话共享的存储中（按内容去重，见 datastore.py），会话只保存 key；
+# 同一上传文件在页面重跑时不重复解析
+df = STORE.get(st.session_state["dataset_key"], session_user()) \
+    if st.session_state.get("upload_id") == uploaded.file_id else None
+if df is None:
+    # 按块读取上传对象（哈希、解压、解析），不复制整份原始字节
+    with span("csv_load", source="upload", size_bytes=uploaded.size) as sp:
         try:
-            code = get_analysis_code(question, df.columns.tolist(), plot_file=plot_name)
+            key, plan, reused = STORE.put(session_user(), stream_key(uploaded),
+                                          lambda: load_upload(uploaded, uploaded.name), label=uploaded.name)
         except Exception as e:
-            st.error(f"生成代码失败：{e}")
+            sp["status"] = "error"
+            st.error(f"读取上传文件失败：{e}")
             st.stop()
+        df = STORE.get(key, session_user())
+        sp.update(format=plan.format, encoding=plan.encoding, repairs=plan.repairs, rows=len(df), shared=reused)
+    st.session_state.update(dataset_key=key, upload_id=uploaded.file_id, upload_plan=plan.describe())
+st.success(f"已上传（{st.session_state['upload_plan']}），{len(df)} 行，列：{list(df.columns)}")
 
-    st.subheader("生成的代码")
-    st.code(code, language="python")
+# 预聚合立方体与列画像按数据集共享，只构建一次
+rollup = STORE.derived(st.session_state["dataset_key"], "rollup", build_rollup)
+profile = STORE.derived(st.session_state["dataset_key"], "column_profile", profile_columns)
 
-    with st.spinner("正在执行代码..."):
-        result, has_plot = execute_code(code, df)
 
+def show_result(result, has_plot, plot_name):
     st.subheader("分析结果")
     if isinstance(result, pd.DataFrame):
-        st.dataframe(result)
+        st.session_state["app_result"] = ResultPager.from_df(result)
+        render_page(st.session_state["app_result"], key="app_result")
     else:
+        st.session_state.pop("app_result", None)
         st.write(result)
 
     if has_plot and os.path.exists(plot_name):
@@ -60,3 +69,130 @@ if st.button("开始分析"):
             st.image("output_plot.png", caption="生成的图表")
         else:
             st.info("已生成图表文件，但未找到指定路径。")
+
+
+def show_progressive(cancel_button: bool):
+    """先展示抽样得到的近似结果，等待后台全量计算完成后替换为精确结果（见 progressive.py）。"""
+    state = st.session_state["progressive"]
+    job = SCHEDULER.get(state["job_id"])
+    approx = state["approx"]
+    slot = st.empty()
+    with slot.container():
+        st.subheader("分析结果（近似）")
+        if approx.error:
+            st.warning(f"抽样试算失败，等待全量结果：{approx.error}")
+        else:
+            st.info(approx.describe())
+            if isinstance(approx.result, pd.DataFrame):
+                render_page(ResultPager.from_df(approx.result), key="app_approx")
+            else:
+                st.write(approx.result)
+            if approx.plot:
+                st.image(approx.plot, caption="图表（基于抽样，近似）")
+    if job is None:
+        # 作业记录已过期
+        st.session_state.pop("progressive", None)
+        return
+    try:
+        result, has_plot = wait_job(job, cancel_button=cancel_button)
+    except JobCancelled:
+        st.session_state.pop("progressive", None)
+        st.warning("已取消全量计算，上方为近似结果。")
+        return
+    except Exception as e:
+        st.session_state.pop("progressive", None)
+        st.error(f"全量计算失败：{e}")
+        return
+    st.session_state.pop("progressive", None)
+    slot.empty()
+    show_result(result, has_plot, state["plot_name"])
+
+
+question = st.text_input("请输入你的分析问题：", value="数据分析")
+plot_name = st.text_input("生成图表文件名：", value="output_plot.png")
+modes = ["Python 代码（pandas）"] + (["SQL（本地 DuckDB）"] if local_sql.available() else [])
+mode = st.radio("分析方式", modes, horizontal=True)
+
+run = st.button("开始分析")
+
+if run and "progressive" in st.session_state:
+    # 新的分析开始：放弃上一次尚未完成的全量计算
+    SCHEDULER.cancel(st.session_state.pop("progressive")["job_id"])
+
+if run and mode.startswith("SQL"):
+    with st.spinner("正在生成 SQL..."):
+        try:
+            prompt = local_sql.build_local_sql_prompt(question, df)
+            # 只要一条语句：整段解析，多行 SELECT 不会被截成首行
+            sql = parse_single_statement(run_job("chat", lambda ctx: llm.predict(prompt), "生成 SQL"))
+        except JobCancelled:
+            st.warning("已取消。")
+            st.stop()
+        except Exception as e:
+            st.error(f"生成 SQL 失败：{e}")
+            st.stop()
+    if not sql:
+        st.error("模型未生成有效 SQL。")
+        st.stop()
+    st.subheader("生成的 SQL")
+    st.code(sql, language="sql")
+    with st.spinner("正在执行 SQL..."):
+        try:
+            result = run_job("query", lambda ctx: local_sql.run_local_sql(df, sql, rollup=rollup), "执行 SQL")
+        except JobCancelled:
+            st.warning("已取消。")
+            st.stop()
+        except Exception as e:
+            st.error(f"执行 SQL 失败：{e}")
+            st.stop()
+    st.subheader("分析结果")
+    # 结果保存为 Arrow 表并分页展示，翻页时（页面重跑）只发送当前页
+    st.session_state["app_result"] = ResultPager.from_df(result)
+    render_page(st.session_state["app_result"], key="app_result")
+elif run:
+    with st.spinner("正在生成分析代码..."):
+        try:
+            code = run_job("chat", lambda ctx: get_analysis_code(question, df.columns.tolist(), plot_file=plot_name,
+                                                                 rollup=rollup, profile=profile), "生成分析代码")
+        except JobCancelled:
+            st.warning("已取消。")
+            st.stop()
+        except Exception as e:
+            st.error(f"生成代码失败：{e}")
+            st.stop()
+
+    st.subheader("生成的代码")
+    st.code(code, language="python")
+
+    if progressive.should_sample(df, code):
+        # 大表：先在分层抽样上试算，立即展示近似结果；全量结果在后台计算，完成后替换
+        with st.spinner("正在抽样试算..."):
+            try:
+                approx = run_job("query", lambda ctx: progressive.run_on_sample(code, df, plot_name, rollup=rollup),
+                                 "抽样试算")
+            except JobCancelled:
+                st.warning("已取消。")
+                st.stop()
+        full_job = SCHEDULER.submit(session_user(), "query", lambda ctx: execute_code(code, df, rollup=rollup),
+                                    label="全量计算")
+        st.session_state.pop("app_result", None)
+        st.session_state["progressive"] = {"job_id": full_job.id, "approx": approx, "plot_name": plot_name}
+        show_progressive(cancel_button=True)
+    else:
+        with st.spinner("正在执行代码..."):
+            try:
+                result, has_plot = run_job("query", lambda ctx: execute_code(code, df, rollup=rollup), "执行分析代码")
+            except JobCancelled:
+                st.warning("已取消。")
+                st.stop()
+        show_result(result, has_plot, plot_name)
+elif "progressive" in st.session_state:
+    # 页面重跑（如翻页、点击其他控件）时继续等待后台的全量计算
+    show_progressive(cancel_button=False)
+elif "app_result" in st.session_state:
+    st.subheader("分析结果（上次）")
+    render_page(st.session_state["app_result"], key="app_result")
+
+if "app_result" in st.session_state:
+    with st.expander("导出完整结果"):
+        render_export("app_export", result=st.session_state["app_result"], name="analysis")
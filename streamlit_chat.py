@@ -1,12 +1,22 @@
 import os
-import io
-import re
 import streamlit as st
 import pandas as pd
-from datetime import datetime
 from qwen_llm import Qwen
-from sqlalchemy import create_engine, inspect
-from datetime import datetime
+from sqlalchemy import inspect
+from tracing import span, start_metrics_server
+from sql_guard import analyze_sql, build_allowlist, check_select
+from db import get_engine
+import local_sql
+from rollup import build_rollup
+from upload_loader import UPLOAD_TYPES, load_upload, stream_key
+import snapshot
+import schema_index
+from column_select import profile_columns
+from result_view import ResultPager, render_page
+from export import render_export
+from jobs import JobCancelled, handle_cancel_requests, render_jobs, run_job, session_user
+from datastore import STORE
+from chat_turn import ChatState, execute_sql, run_turn
 
 # 支持从本地 config.py 读取 DB 配置（优先）
 try:
@@ -36,6 +46,8 @@ except Exception:
     CONFIG_API_KEY = None
 
 st.set_page_config(page_title="AnalytiBot-Chat", layout='wide')
+# 若设置了 ANALYTIBOT_METRICS_PORT，则暴露 Prometheus /metrics 端点（幂等）
+start_metrics_server()
 st.title("AnalytiBot — Chat 模式")
 
 # 将输入框固定到页面底部（影响所有 form；若有问题可进一步限定选择器）
@@ -97,8 +109,8 @@ st.markdown(
 
 if 'history' not in st.session_state:
     st.session_state.history = []  # list of {'role':'user'|'assistant','content':...}
-if 'df' not in st.session_state:
-    st.session_state.df = None
+# 模型调用、SQL、导出、快照都作为作业在共享线程池中执行（见 jobs.py）；先处理上一轮点击的取消
+handle_cancel_requests()
 
 
 def _prune_consecutive_assistant_duplicates():
@@ -124,12 +136,171 @@ def _escape_html(s: str) -> str:
     return (s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
             .replace('\n', '<br/>'))
 
+LOCAL_SQL_TARGET = '上传数据（本地 DuckDB）'
+DB_SQL_TARGET = '数据库'
+
+
+
+def _current_df():
+    """当前会话的数据集：共享存储中的只读 DataFrame（见 datastore.py），未加载时为 None。"""
+    key = st.session_state.get('dataset_key')
+    if key is None:
+        return None
+    df = STORE.get(key, session_user())
+    if df is None:
+        # 会话空闲过久，数据集已被释放
+        for k in ('dataset_key', 'data_source', 'loaded_upload_id') + _DATASET_CACHE_KEYS:
+            st.session_state.pop(k, None)
+    return df
+
+
+def _use_local_sql() -> bool:
+    """SQL 是否以已上传的 DataFrame（表名 df）为目标。"""
+    return (st.session_state.get('sql_target') == LOCAL_SQL_TARGET
+            and st.session_state.get('dataset_key') is not None and local_sql.available())
+
+
+def _sql_backend_ready() -> bool:
+    return _use_local_sql() or bool(DEFAULT_DB_URL)
+
+
+def _sql_engine():
+    if _use_local_sql():
+        return local_sql.LocalEngine(_current_df(), rollup=st.session_state.get('rollup'))
+    return get_engine(DEFAULT_DB_URL)
+
+
+def _sql_allowlist():
+    """SQL 可引用的表：本地模式仅 df；数据库模式为库中表名 + information_schema（失败时不限制）。"""
+    if _use_local_sql():
+        return local_sql.LOCAL_ALLOWLIST
+    try:
+        if DEFAULT_DB_URL:
+            # 允许查询 information_schema 以便模型返回基于 schema 的探测 SQL
+            engine = get_engine(DEFAULT_DB_URL)
+            return build_allowlist(list(inspect(engine).get_table_names() or []) + ['information_schema.*'],
+                                   schema=engine.url.database)
+    except Exception:
+        pass
+    return None
+
+
+def _predict(q, prompt: str, label: str) -> str:
+    """以 chat 作业调用模型（优先于导出、快照等重活调度）。"""
+    return run_job('chat', lambda ctx: q.predict(prompt), label)
+
+
+def _schema_context(question: str, allowed=None) -> str:
+    """数据库模式下按问题检索相关表及其列（BM25，见 schema_index.py）；本地模式或检索失败时返回空串。"""
+    if _use_local_sql() or not DEFAULT_DB_URL:
+        return ''
+    try:
+        return schema_index.get_schema_index(get_engine(DEFAULT_DB_URL)).render(question, allowed_tables=allowed)
+    except Exception:
+        return ''
+
+
+# 依赖当前数据集的缓存：数据切换或快照刷新后必须失效
+_DATASET_CACHE_KEYS = ('rollup', 'column_profile', 'last_exec_sql', 'last_exec_result', 'last_exec_meta', 'followup')
+
+
+def _set_dataset(key: str, source: str) -> None:
+    """切换当前分析数据（共享存储中的数据集 key），失效旧缓存；预聚合与列画像按数据集共享、只计算一次。"""
+    for k in _DATASET_CACHE_KEYS:
+        st.session_state.pop(k, None)
+    st.session_state['dataset_key'] = key
+    st.session_state['data_source'] = source
+    # 预计算常用维度上的聚合立方体，供本地 SQL 与分析代码直接读取
+    st.session_state['rollup'] = STORE.derived(key, 'rollup', build_rollup)
+    # 列画像（类型 + 高频取值），供按问题挑选相关列
+    st.session_state['column_profile'] = STORE.derived(key, 'column_profile', profile_columns)
+
+
+def _put_snapshot(user: str, name: str, version) -> str:
+    """按快照名与版本放入共享存储（同一版本只读取一次）并设为该会话的当前数据集，返回 key。"""
+    key, _, _ = STORE.put(user, f"snapshot:{name}:v{version}", lambda: (snapshot.load_snapshot(name), None),
+                          label=f"快照 {name}")
+    return key
+
+
+def _table_candidates():
+    """数据库中的表名，供“是否明确要求查询某张表”的启发式判断；未配置或读取失败时为 None。"""
+    try:
+        if DEFAULT_DB_URL:
+            return inspect(get_engine(DEFAULT_DB_URL)).get_table_names()
+    except Exception:
+        pass
+    return None
+
+
+def _chat_state() -> ChatState:
+    """由 session_state 组装 chat_turn 使用的会话状态（history 为同一个列表，原地追加）。"""
+    return ChatState(history=st.session_state.history, df=_current_df(),
+                     column_profile=st.session_state.get('column_profile'),
+                     last_exec_sql=st.session_state.get('last_exec_sql', ''),
+                     last_exec_result=st.session_state.get('last_exec_result'))
+
+
+def _save_chat_state(state: ChatState) -> None:
+    """把一轮对话后的会话状态写回 session_state。"""
+    st.session_state.history = state.history
+    if state.last_exec_result is not None and state.last_exec_result is not st.session_state.get('last_exec_result'):
+        st.session_state['last_exec_sql'] = state.last_exec_sql
+        st.session_state['last_exec_result'] = state.last_exec_result
+        st.session_state['last_exec_meta'] = {'rows': state.last_exec_result.num_rows,
+                                              'cols': list(state.last_exec_result.columns)}
+
+
+def _execute_generated_sql(sql_text: str, allowed) -> None:
+    """“执行生成的 SQL”按钮：经 chat_turn.execute_sql 执行（失败时自动修复），并展示代价估算、探测查询与结果。"""
+    api_key = CONFIG_API_KEY or os.getenv('DASHSCOPE_API_KEY')
+    llm = Qwen(model='qwen-plus', api_key=api_key) if api_key else None
+    state = _chat_state()
+    state.history.append({'role': 'assistant', 'content': f'[开始执行 SQL] {sql_text}'})
+    try:
+        with st.spinner('正在执行 SQL（失败时自动修复，探测查询并发执行）...'):
+            res = execute_sql(state, sql_text, _sql_engine(), st.session_state.get('generated_question', ''),
+                              allowed_tables=allowed, local=_use_local_sql(),
+                              schema_context=lambda text: _schema_context(text, allowed), llm=llm,
+                              run_sql=lambda fn: run_job('query', lambda ctx: fn(), '执行 SQL'))
+    except JobCancelled:
+        # 用户主动取消，不进入自动修复
+        st.warning('已取消执行。')
+        state.history.append({'role': 'assistant', 'content': '[已取消执行]'})
+        _save_chat_state(state)
+        return
+    _save_chat_state(state)
+    decision = res.decision
+    if decision is not None and decision.cost is not None:
+        st.caption(f'EXPLAIN 估算：扫描约 {int(decision.cost.rows_examined)} 行，'
+                   f'全表扫描：{", ".join(decision.cost.full_scan_tables) or "无"}')
+    for note in (decision.notes if decision is not None else []):
+        st.caption(note)
+    if res.repair is not None and res.repair.probes:
+        with st.expander(f'探测查询（{len(res.repair.probes)} 条，已并发执行）'):
+            for idx, probe in enumerate(res.repair.probes):
+                st.code(probe.sql, language='sql')
+                if probe.ok:
+                    st.caption(f'第 {idx+1} 条：{len(probe.df)} 行，{probe.elapsed_ms:.0f} ms')
+                else:
+                    st.caption(f'第 {idx+1} 条失败：{probe.error}')
+    if not res.executed:
+        st.error(f'自动修复失败：{res.error}' if res.repair is not None else f'执行 SQL 失败：{res.error}')
+        return
+    if res.repaired:
+        st.session_state['fixed_sql'] = res.executed_sql
+        st.subheader('自动修复后 SQL 执行结果')
+        st.code(res.executed_sql, language='sql')
+    else:
+        st.subheader('SQL 执行结果')
+    render_page(st.session_state['last_exec_result'], key='exec_result')
+
 # 布局：左侧会话与数据预览，右侧数据加载控件
 left, right = st.columns([3, 1])
 
 with right:
     st.header("数据源")
-    uploaded = st.file_uploader("上传 CSV (可选)", type=["csv"])
+    uploaded = st.file_uploader("上传数据文件 (可选：CSV，可 gzip/zstd 压缩；Parquet、Feather)", type=UPLOAD_TYPES)
     st.markdown("\n")
     if DEFAULT_DB_URL:
         st.info("已配置默认数据库连接（使用代码内 DEFAULT_DB_URL）")
@@ -137,29 +308,103 @@ with right:
         st.warning("未配置默认数据库连接；若需执行模型生成的 SQL，请在 `config.py` 中配置 DEFAULT_DB_CONFIG 或联系管理员。")
     # 使用代码内默认数据库（若已配置 DEFAULT_DB_URL）
 
-    if uploaded is not None:
-        content = uploaded.getvalue()
-        last_exc = None
-        for enc in ("utf-8", "utf-8-sig", "gbk", "gb2312", "latin1", "cp1252"):
+    # 同一个上传文件只解析一次（按 file_id 判断），避免每次重跑都重新读取 CSV、重建预聚合
+    if uploaded is not None and st.session_state.get('loaded_upload_id') != uploaded.file_id:
+        with span("csv_load", source="upload", size_bytes=uploaded.size) as sp:
             try:
-                st.session_state.df = pd.read_csv(io.BytesIO(content), encoding=enc)
-                st.success(f"已加载上传文件（encoding={enc}），共 {len(st.session_state.df)} 行")
-                break
+                # 按内容哈希去重：其他会话已上传过相同文件时直接共享，不再解析；
+                # 哈希、解压与解析都按块读取上传对象，不复制整份原始字节
+                key, plan, reused = STORE.put(session_user(), stream_key(uploaded),
+                                              lambda: load_upload(uploaded, uploaded.name), label=uploaded.name)
             except Exception as e:
-                last_exc = e
-        else:
-            st.error(f"读取上传文件失败：{last_exc}")
+                sp["status"] = "error"
+                st.error(f"读取上传文件失败：{e}")
+            else:
+                _set_dataset(key, f"上传文件 {uploaded.name}")
+                rows = len(_current_df())
+                sp.update(format=plan.format, encoding=plan.encoding, repairs=plan.repairs, rows=rows, shared=reused)
+                st.success(f"已加载上传文件（{plan.describe()}），共 {rows} 行" + ("（与其他会话共享）" if reused else ""))
+                st.session_state['loaded_upload_id'] = uploaded.file_id
+    elif _current_df() is not None:
+        st.success(f"当前数据：{st.session_state.get('data_source', '上传文件')}，共 {len(_current_df())} 行")
+
+    # 从数据库抽取整表/查询结果到本地列式快照，作为 pandas 分析的数据源（无需手工导出 CSV）
+    if DEFAULT_DB_URL and snapshot.available():
+        with st.expander("从数据库抽取到本地快照"):
+            try:
+                db_tables = sorted(inspect(get_engine(DEFAULT_DB_URL)).get_table_names() or [])
+            except Exception as e:
+                db_tables = []
+                st.caption(f"读取表列表失败：{e}")
+            snap_table = st.selectbox("数据表", db_tables) if db_tables else None
+            snap_query = st.text_area("或输入 SELECT（填写后优先使用）", value="", height=80)
+            snap_key = st.text_input("分区列（可选，留空自动选择主键或日期列）", value="")
+            snap_fmt = st.radio("格式", list(snapshot.FORMATS), horizontal=True)
+            if st.button("抽取") and (snap_query.strip() or snap_table):
+                is_query = bool(snap_query.strip())
+                try:
+                    user = session_user()
+
+                    def _extract(ctx):
+                        manifest = snapshot.extract_snapshot(
+                            get_engine(DEFAULT_DB_URL), snap_query.strip() if is_query else snap_table,
+                            is_query=is_query, allowed_tables=build_allowlist(db_tables),
+                            key=snap_key.strip() or None, fmt=snap_fmt)
+                        ctx.check()
+                        return manifest, _put_snapshot(user, manifest.name, manifest.version)
+
+                    with st.spinner("正在并发抽取..."):
+                        manifest, snap_key_ = run_job("snapshot", _extract, "抽取快照")
+                        _set_dataset(snap_key_, f"快照 {manifest.name}")
+                    st.success(f"快照 {manifest.name}：{manifest.rows} 行，{manifest.partitions} 个分区，"
+                               f"耗时 {manifest.elapsed_s:.1f}s")
+                except Exception as e:
+                    st.error(f"抽取失败：{e}")
+            existing = {m.name: m for m in snapshot.list_snapshots()}
+            if existing:
+                snap_name = st.selectbox("已有快照", list(existing))
+                snap_m = existing[snap_name]
+                if snap_m.watermark:
+                    st.caption(f"水位列 {snap_m.watermark}（{snap_m.watermark_mode}）= {snap_m.watermark_value}，"
+                               f"版本 {snap_m.version}")
+                load_col, refresh_col = st.columns(2)
+                if load_col.button("加载快照"):
+                    _set_dataset(_put_snapshot(session_user(), snap_name, snap_m.version), f"快照 {snap_name}")
+                    st.success(f"已加载快照 {snap_name}，共 {len(_current_df())} 行")
+                if refresh_col.button("增量刷新", disabled=not snap_m.watermark):
+                    try:
+                        with st.spinner("正在拉取水位之后的变更..."):
+                            res = run_job("snapshot", lambda ctx: snapshot.refresh_snapshot(
+                                get_engine(DEFAULT_DB_URL), snap_name, allowed_tables=build_allowlist(db_tables)),
+                                "增量刷新快照")
+                        if res.changed:
+                            # 只有数据确实变化时才重新加载并失效依赖缓存（新版本是新的数据集 key）
+                            version = snapshot.SnapshotManifest.read(snapshot.snapshot_path(snap_name)).version
+                            _set_dataset(_put_snapshot(session_user(), snap_name, version), f"快照 {snap_name}")
+                        st.success(f"拉取 {res.fetched} 行，覆盖 {res.replaced} 行，重写 {res.rewritten_files} 个分块；"
+                                   f"当前 {res.rows} 行，耗时 {res.elapsed_s:.1f}s")
+                    except Exception as e:
+                        st.error(f"增量刷新失败：{e}")
 
     # 不再在界面中直接接收 db_url 或 table_name，执行 SQL 时使用 DEFAULT_DB_URL（若已配置）
+    # 已上传数据时，可选择让生成的 SQL 直接在上传数据上执行（DuckDB，表名 df）
+    if _current_df() is not None and local_sql.available():
+        st.radio('SQL 目标', [DB_SQL_TARGET, LOCAL_SQL_TARGET], key='sql_target',
+                 index=0 if DEFAULT_DB_URL else 1, help='选择本地时，生成的 SQL 以表 df 直接查询上传的数据')
 
     if st.button("清空会话/数据"):
         st.session_state.history = []
-        st.session_state.df = None
+        STORE.release(session_user())
+        st.session_state.pop('dataset_key', None)
+        st.session_state.pop('rollup', None)
+        st.session_state.pop('column_profile', None)
+        st.session_state.pop('loaded_upload_id', None)
+        st.session_state.pop('data_source', None)
+    render_jobs()
     # SQL 由模型生成并执行流程（只读）
     st.markdown("---")
     # 已移除界面上的“生成 SQL”开关。默认不对所有输入自动生成 SQL，
     # 系统将根据用户意图与启发式规则决定是否生成 SQL（仅在明确请求时触发）。
-    generate_sql = False
 
 with left:
     st.subheader("会话历史")
@@ -191,26 +436,51 @@ with left:
 
     st.markdown("---")
 
-    if st.session_state.df is not None:
-        st.subheader("当前数据预览 (前 100 行)")
-        st.dataframe(st.session_state.df.head(100))
+    if _current_df() is not None:
+        st.subheader("当前数据预览")
+        # 只切出当前页发送到浏览器，而不是每次重跑都发送固定的前 100 行
+        render_page(ResultPager(_current_df()), key='preview')
 
     # 显示最近一次执行的 SQL 结果（若存在），保证即使发生重跑也能看到结果
-    if 'last_exec_df' in st.session_state:
+    if 'last_exec_result' in st.session_state:
         st.markdown('')
-        st.subheader('上次执行结果（已缓存，前 200 行）')
+        st.subheader('上次执行结果（已缓存）')
         last_sql = st.session_state.get('last_exec_sql', '')
         if last_sql:
             st.code(last_sql, language='sql')
-        try:
-            st.dataframe(st.session_state['last_exec_df'])
-        except Exception:
-            # 兼容性：若保存为 dict，可重建 DataFrame
-            try:
-                import pandas as _pd
-                st.dataframe(_pd.DataFrame(st.session_state['last_exec_df']))
-            except Exception:
-                st.write('无法显示上次执行的结果。')
+        render_page(st.session_state['last_exec_result'], key='last_exec')
+        # 执行结果为会话私有，上报给数据内存页面展示
+        local_bytes = st.session_state['last_exec_result'].nbytes
+        if isinstance((st.session_state.get('followup') or {}).get('result'), ResultPager):
+            local_bytes += st.session_state['followup']['result'].nbytes
+        STORE.report_local(session_user(), local_bytes)
+        with st.expander('导出完整结果'):
+            # 有 SQL 时重新执行并流式写出全部行（界面只缓存分页结果，行数受上限约束）
+            if last_sql and _sql_backend_ready():
+                render_export('last_exec_export', sql=last_sql, engine_factory=_sql_engine,
+                              allowlist_factory=_sql_allowlist, name='query')
+            else:
+                render_export('last_exec_export', result=st.session_state['last_exec_result'], name='result')
+
+    # 追问分析的结果（仅当它基于当前缓存的上次结果时展示）
+    followup = st.session_state.get('followup')
+    if (followup and 'last_exec_result' in st.session_state
+            and followup['base_sql'] == st.session_state.get('last_exec_sql', '')):
+        st.subheader('追问分析（基于上次结果，未重新查询数据库）')
+        st.caption(followup['question'])
+        if followup.get('truncated'):
+            st.warning('上次结果被自动行数上限截断，以下分析只基于已取回的行，不代表全量数据；需要全量结果请直接提问以重新查询。')
+        if followup['code']:
+            with st.expander('分析代码'):
+                st.code(followup['code'], language='python')
+        if followup['error']:
+            st.error(followup['error'])
+        elif isinstance(followup['result'], ResultPager):
+            render_page(followup['result'], key='followup_result')
+        elif followup['result'] is not None:
+            st.write(followup['result'])
+        if followup['plot']:
+            st.image(followup['plot'], caption='生成的图表')
 
     # 在页面底部渲染固定输入表单（放在主逻辑之前以便发送能立即触发）
     if 'send_now' not in st.session_state:
@@ -236,476 +506,76 @@ with left:
         # 清空临时存储，避免重复处理（该键不是当前表单的 widget key，安全清空）
         st.session_state['chat_input'] = ''
 
-    def build_dataset_summary(df: pd.DataFrame, max_chars=1500) -> str:
-        cols = list(df.columns)
-        types = {c: str(df[c].dtype) for c in cols}
-        sample_lines = []
-        try:
-            sample = df.head(5).astype(str).to_dict(orient='records')
-            for r in sample:
-                sample_lines.append(' | '.join([f"{k}:{v}" for k, v in r.items()]))
-        except Exception:
-            sample_lines = []
-        summary = f"COLUMNS: {', '.join(cols)}\nTYPES: {types}\nSAMPLE:\n" + '\n'.join(sample_lines)
-        if len(summary) > max_chars:
-            return summary[:max_chars] + '...'
-        return summary
-
     # 注意：意图检测由大模型完成，不在本地进行关键词检测。
 
     if user_input:
-        st.session_state.history.append({'role': 'user', 'content': user_input})
         # 清理上一次生成/修正的 SQL，确保新会话使用新的 SQL
-        st.session_state.pop('generated_sql', None)
-        st.session_state.pop('fixed_sql', None)
-
-        # build conversation text (include dataset summary when available)
-        conv_lines = []
-        for m in st.session_state.history:
-            role = 'User' if m['role'] == 'user' else 'Assistant'
-            conv_lines.append(f"{role}: {m['content']}")
-        if st.session_state.df is not None:
-            conv_lines.append('\n--- DATASET SUMMARY ---')
-            conv_lines.append(build_dataset_summary(st.session_state.df))
-        # 若之前执行过 SQL，把其结果摘要也加入对话上下文，便于模型在后续分析时参考
-        if 'last_exec_df' in st.session_state:
-            try:
-                conv_lines.append('\n--- LAST SQL RESULT ---')
-                last_sql_text = st.session_state.get('last_exec_sql', '')
-                if last_sql_text:
-                    conv_lines.append(f'LAST_SQL: {last_sql_text}')
-                conv_lines.append(build_dataset_summary(st.session_state['last_exec_df']))
-            except Exception:
-                # 若构建摘要失败则忽略，不阻塞主流程
-                pass
-        conversation = "\n".join(conv_lines)
-        # 显式加入当前时间，确保模型能看到今天的日期
-        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        conversation = f"当前时间：{current_time}\n" + conversation
+        for k in ('generated_sql', 'generated_sql_editor', 'generated_question', 'fixed_sql'):
+            st.session_state.pop(k, None)
 
         api_key = CONFIG_API_KEY or os.getenv('DASHSCOPE_API_KEY')
         if not api_key:
+            st.session_state.history.append({'role': 'user', 'content': user_input})
             st.error('未检测到 DASHSCOPE_API_KEY 环境变量，请先设置后重试。')
         else:
+            state = _chat_state()
             with st.spinner('等待模型回复...'):
-                reply = ""
                 try:
                     q = Qwen(model='qwen-plus', api_key=api_key)
-                    # 判断是否需要生成 SQL：优先使用用户勾选；否则使用启发式规则或模型判定
-                    def _heuristic_needs_sql(text: str, table_candidates: list | None = None) -> bool:
-                        if not text:
-                            return False
-                        t = text.lower()
-                        # 明确的写 SQL 请求或常见关键词
-                        if '帮我写' in t and ('sql' in t or '查询' in t):
-                            return True
-                        if re.search(r'写(一条|一个)?\s*(sql|查询)', t):
-                            return True
-                        # 如果直接包含表名提示（如查询 wx_tm_market_goods_data）
-                        m = re.search(r'查询\s+([\w\.]+)', t)
-                        if m:
-                            return True
-                        # 若已知的表名出现在请求中，则也触发
-                        if table_candidates:
-                            for tbl in table_candidates:
-                                if tbl and tbl.lower() in t:
-                                    return True
-                        return False
-
-                    # 先尝试从数据库获取表名用于启发式匹配（若配置了 DEFAULT_DB_URL）
-                    allowed_for_heuristic = None
-                    try:
-                        if DEFAULT_DB_URL:
-                            eng_tmp = create_engine(DEFAULT_DB_URL)
-                            allowed_for_heuristic = inspect(eng_tmp).get_table_names()
-                    except Exception:
-                        allowed_for_heuristic = None
-
-                    explicit_sql_request = _heuristic_needs_sql(user_input, allowed_for_heuristic)
-                    # 若用户意图明显为数据分析/描述类请求，则优先不生成 SQL（除非显式请求 SQL）
-                    analysis_keywords = ['分析', '描述', '统计', '汇总', '可视化', '画图', '总结', '解释', '洞察', '趋势', '分布', '关联']
-                    is_analysis_request = False
-                    if user_input:
-                        for kw in analysis_keywords:
-                            if kw in user_input:
-                                is_analysis_request = True
-                                break
-                    if is_analysis_request and not explicit_sql_request:
-                        need_sql = False
-                    else:
-                        need_sql = bool(generate_sql) or explicit_sql_request
-                    generated_sql = ""
-                    if not need_sql:
-                        # 更保守的意图检测：只有当用户明确要求查询数据库、写 SQL、或指定表名时才返回 SQL。
-                        # 对于常见的数据分析请求（例如：描述数据、计算统计量、作图建议、解释模型结果等），请返回 NO_SQL。
-                       
-                        intent_prompt = (
-                            "当前时间：" + current_time + "\n"
-                            "请判断下面的用户请求是否确实需要对数据库表执行查询并返回结果。"
-                            " 仅在用户明确要求：\n  - 运行或构造 SQL 查询；\n  - 指定表名或列名需要从数据库检索；\n  - 或明确写出如 '请帮我写 SQL' / '查询 <table>' 等需求时，才返回一条合法的 SELECT SQL 语句。"
-                        )
-                        intent_prompt += "\n如果不需要查询数据库（例如用户要求对已加载的数据做统计分析、可视化、解读或建议），请只返回 NO_SQL。"
-                        intent_prompt += f"\n用户请求：{user_input}\n请仅返回一行：要么是一条 SQL（以 SELECT 开头，不要任何解释、标点或分号），要么返回 NO_SQL。"
-                        intent_response = q.predict(intent_prompt)
-                        # 如果模型返回了 SQL（包含 select），则视为需要生成 SQL
-                        for ln in intent_response.splitlines():
-                            s = ln.strip()
-                            if not s:
-                                continue
-                            if s.upper() == 'NO_SQL':
-                                break
-                            # 以首个非空行作为可能的 SQL
-                            generated_sql = s
-                            break
-                        if generated_sql:
-                            # 持久化生成的 SQL，保证在脚本重跑后仍可执行
-                            st.session_state['generated_sql'] = generated_sql
-                            need_sql = True
-                            # 告知用户模型生成 SQL（未执行）
-                            st.info('模型判断需要查询；已生成 SQL，需你确认后执行。')
-                    # 若需要生成 SQL（用户勾选或模型判定），则使用模型或上一步生成的 SQL
-                    if need_sql:
-                        # 给模型明确的指令，要求仅返回 SQL 查询，不要多余文字
-                        # 构造 prompt：若有已加载的 DataFrame，附带数据摘要；否则只用会话上下文
-                        sql_prompt = (
-                            "当前时间：" + current_time + "\n"
-                            "请基于下面的对话，生成一个只包含单条 SELECT SQL 查询的语句，"
-                            "仅使用目标表，并使用 CURRENT_DATE 替代当天日期相关条件。"
-                        )
-                        sql_prompt += (
-                            "\n如果目标表的列名可能未知，请返回一条或多条安全的探测 SQL（每行一条、仅使用 SELECT），"
-                            "用于定位列名或查看样例数据。例如：查询 `information_schema.columns` 获取列名，或使用 `SELECT * FROM <table> LIMIT 10` 查看样本。"
-                            "不要包含分号或任何注释，也不要包含插入/更新/删除等写操作。"
-                        )
-                        if st.session_state.df is not None:
-                            sql_prompt += f"数据摘要：\n{build_dataset_summary(st.session_state.df)}\n"
-                        sql_prompt += f"对话：\n{conversation}\n只返回 SQL，不要解释。"
-                        generated = q.predict(sql_prompt)
-                        # 清理模型输出，取首个非空行作为 SQL
-                        generated_sql = ""
-                        for ln in generated.splitlines():
-                            s = ln.strip()
-                            if s:
-                                generated_sql = s
-                                break
-                        # 持久化生成的 SQL，保证在脚本重跑后仍可执行
-                        if generated_sql:
-                            st.session_state['generated_sql'] = generated_sql
-                        # 如果之前 intent 阶段已经生成了 SQL，则优先使用；否则使用本次生成结果
-                        if not generated_sql:
-                            if not generated_sql:
-                                generated_sql = ""
-                            if not generated_sql and not generated.strip():
-                                st.error('模型未生成有效 SQL。')
-                                reply = f"[模型未生成 SQL] {generated}"
-                        if not generated_sql:
-                            # 清理模型输出，取首个非空行作为 SQL
-                            for ln in generated.splitlines():
-                                s = ln.strip()
-                                if s:
-                                    generated_sql = s
-                                    break
-                        if not generated_sql:
-                            st.error('模型未生成有效 SQL。')
-                            reply = f"[模型未生成 SQL] {generated}"
-                        else:
-                            # 可编辑的 SQL 文本区域，允许用户修改模型生成的 SQL
-                            st.text_area('生成的 SQL（可编辑）', value=st.session_state.get('generated_sql', generated_sql), height=140, key='generated_sql_editor')
-                            # 将编辑器内容同步回主生成 SQL 存储
-                            st.session_state['generated_sql'] = st.session_state.get('generated_sql_editor', generated_sql)
-                            # 调试信息：显示生成的 SQL 与校验状态，便于排查按钮消失问题
-                            try:
-                                debug_expanded = st.checkbox('显示 SQL 调试信息', value=False, key='debug_sql_info')
-                                if debug_expanded:
-                                    st.write('generated_sql:', generated_sql)
-                                    st.write('DEFAULT_DB_URL configured:', bool(DEFAULT_DB_URL))
-                                    try:
-                                        st.write('allowed tables:', allowed)
-                                    except Exception:
-                                        st.write('allowed tables: <未定义>')
-                                    try:
-                                        st.write('is_safe_select:', is_safe_select(generated_sql, allowed))
-                                    except Exception:
-                                        st.write('is_safe_select: <error>')
-                                    st.warning('若你确定 SQL 安全，也可启用下方调试开关强制执行（仅用于调试环境）。')
-                                    force = st.checkbox('允许调试强制执行生成的 SQL（跳过表白名单）', value=False, key='debug_force_exec')
-                            except Exception:
-                                pass
-                            # 将生成的 SQL 插入会话历史，便于追溯（但不自动执行）
-                            st.session_state.history.append({'role': 'assistant', 'content': f'[生成的 SQL] {generated_sql}'})
-                            # 始终显示一个可见的调试执行按钮，便于在 UI 中手动触发执行（会执行安全检查）
-                            try:
-                                exec_always = st.button('执行生成的 SQL（始终可见，调试）', key='always_exec_button')
-                            except Exception:
-                                exec_always = False
-                            if exec_always:
-                                sql_to_execute = st.session_state.get('generated_sql', generated_sql)
-                                low = sql_to_execute.lower()
-                                if ';' in low:
-                                    st.error('检测到不安全的 SQL（包含分号/多语句），已拒绝执行。')
-                                else:
-                                    forbidden = ['insert ', 'update ', 'delete ', 'drop ', 'create ', 'alter ', 'truncate ', 'replace ']
-                                    if any(k in low for k in forbidden):
-                                        st.error('检测到写操作或不安全关键词，已拒绝执行。')
-                                    else:
-                                        if not DEFAULT_DB_URL:
-                                            st.error('未配置默认数据库连接，无法执行 SQL。请在 config.py 中配置 DEFAULT_DB_CONFIG。')
-                                        else:
-                                            try:
-                                                st.session_state.history.append({'role': 'assistant', 'content': f'[开始执行 SQL 调试按钮] {sql_to_execute}'})
-                                                eng = create_engine(DEFAULT_DB_URL)
-                                                df_res = pd.read_sql_query(sql_to_execute, con=eng)
-                                                rows = len(df_res)
-                                                cols_res = list(df_res.columns)
-                                                st.session_state['last_exec_sql'] = sql_to_execute
-                                                st.session_state['last_exec_df'] = df_res.head(200)
-                                                st.session_state['last_exec_meta'] = {'rows': rows, 'cols': cols_res}
-                                                st.session_state.history.append({'role': 'assistant', 'content': f'[SQL 调试执行完成] rows={rows}, cols={cols_res}'})
-                                                st.subheader('SQL 执行结果（前 200 行）')
-                                                st.dataframe(st.session_state['last_exec_df'])
-                                            except Exception as e:
-                                                st.error(f'执行 SQL 失败：{e}')
-                                                st.session_state.history.append({'role': 'assistant', 'content': f'[调试执行失败] {e}'})
-
-                            # 验证 SQL 安全性
-                            def is_safe_select(sql_text: str, allowed_tables: list = None) -> bool:
-                                low = sql_text.lower()
-                                # 禁止 ; 多语句
-                                if ';' in low:
-                                    return False
-                                # 禁止写操作关键词
-                                forbidden = ['insert ', 'update ', 'delete ', 'drop ', 'create ', 'alter ', 'truncate ', 'replace ']
-                                if any(k in low for k in forbidden):
-                                    return False
-                                # 必须以 select 开头
-                                if not low.strip().startswith('select'):
-                                    return False
-                                # 简单检查表名白名单
-                                if allowed_tables is not None:
-                                    found = False
-                                    for t in allowed_tables:
-                                        if t.lower() in low:
-                                            found = True
-                                            break
-                                    if not found:
-                                        return False
-                                return True
-
-                            # 获取可用表用于校验（若配置 DEFAULT_DB_URL）
-                            allowed = None
-                            try:
-                                if DEFAULT_DB_URL:
-                                    eng = create_engine(DEFAULT_DB_URL)
-                                    allowed = inspect(eng).get_table_names()
-                                    if allowed is None:
-                                        allowed = []
-                                    # 允许查询 information_schema 以便模型返回基于 schema 的探测 SQL
-                                    if 'information_schema' not in [t.lower() for t in allowed]:
-                                        allowed.append('information_schema')
-                            except Exception:
-                                allowed = None
-
-                            safe = is_safe_select(generated_sql, allowed)
-                            # 支持调试强制执行：若用户在界面勾选了 debug_force_exec，则允许跳过表名白名单
-                            force_exec = bool(st.session_state.get('debug_force_exec', False))
-                            can_execute = safe or force_exec
-                            if not can_execute:
-                                st.error('模型生成的 SQL 未通过安全校验，已拒绝执行。')
-                                st.session_state.history.append({'role': 'assistant', 'content': f'[生成的 SQL 被拒绝] {generated_sql}'})
-                                if force_exec:
-                                    st.warning('已启用强制执行，但 SQL 未通过安全校验：请确认只读并谨慎执行。')
-                            else:
-                                st.session_state.history.append({'role': 'assistant', 'content': f'[生成的 SQL 已通过安全校验（未执行）] {generated_sql}'})
-                                if not DEFAULT_DB_URL:
-                                    st.error('未配置默认数据库连接，无法执行 SQL。请在 config.py 中配置 DEFAULT_DB_CONFIG。')
-                                else:
-                                    if st.button('执行生成的 SQL'):
-                                        sql_to_execute = st.session_state.get('generated_sql', generated_sql)
-                                        try:
-                                            st.session_state.history.append({'role': 'assistant', 'content': f'[开始执行 SQL] {sql_to_execute}'})
-                                            eng = create_engine(DEFAULT_DB_URL)
-                                            df_res = pd.read_sql_query(sql_to_execute, con=eng)
-                                            rows = len(df_res)
-                                            cols_res = list(df_res.columns)
-                                            st.session_state.history.append({'role': 'assistant', 'content': f'[SQL 执行完成] rows={rows}, cols={cols_res}'})
-                                            # 缓存执行结果，便于在重跑后查看
-                                            st.session_state['last_exec_sql'] = sql_to_execute
-                                            st.session_state['last_exec_df'] = df_res.head(200)
-                                            st.session_state['last_exec_meta'] = {'rows': rows, 'cols': cols_res}
-                                            st.subheader('SQL 执行结果（前 200 行）')
-                                            st.dataframe(st.session_state['last_exec_df'])
-                                        except Exception as e:
-                                            err = str(e)
-                                            st.error(f'执行 SQL 失败：{err}')
-                                            st.session_state.history.append({'role': 'assistant', 'content': f'[执行失败] {err}'})
-                                            # 将执行错误和原始 SQL 返回给模型，请求修正（仅在用户允许的情况下）
-                                            fix_prompt = (
-                                                "下面是一个 SQL 语句及其执行时的错误信息。请在确保只读的前提下修正该 SQL。"
-                                                "为了定位列名或数据问题，你可以采用以下两种策略之一："
-                                                "(1) 返回一个宽泛的安全扫描语句，例如 `SELECT * FROM <table> LIMIT 100`，用于查看表的真实列和值；"
-                                                "(2) 或者返回多条安全的探测查询（每行一条 SELECT、不要分号），每条用于检查某些候选列或筛选条件。"
-                                                "请只返回 SQL 语句（可以是一条或多条，每行一条），不要任何解释或分号。\n"
-                                            )
-                                            # 附带可用表名和前几列信息（若有）以帮助模型修正
-                                            schema_info = ''
-                                            if allowed:
-                                                schema_info += '可用表：' + ', '.join(allowed) + '\n'
-                                            if st.session_state.df is not None:
-                                                cols = ', '.join(list(st.session_state.df.columns)[:30])
-                                                schema_info += f'当前上传数据列（示例）: {cols}\n'
-                                            fix_prompt += schema_info
-                                            fix_prompt += f"原始 SQL: {generated_sql}\n错误信息: {err}\n请返回修正后的 SQL（一条或多条，每行一条）："
-                                            fixed_sql_resp = q.predict(fix_prompt)
-                                            # 解析模型返回：允许多行，每行为一条 SQL
-                                            fixed_sqls = []
-                                            for ln in fixed_sql_resp.splitlines():
-                                                s = ln.strip()
-                                                if not s:
-                                                    continue
-                                                # 忽略非以 select 开头的无关行
-                                                if s.lower().startswith('select'):
-                                                    fixed_sqls.append(s)
-                                            if not fixed_sqls:
-                                                # 退回兼容旧逻辑：尝试取第一非空行
-                                                fallback = ''
-                                                for ln in fixed_sql_resp.splitlines():
-                                                    s = ln.strip()
-                                                    if s:
-                                                        fallback = s
-                                                        break
-                                                if fallback:
-                                                    fixed_sqls = [fallback]
-
-                                            if not fixed_sqls:
-                                                st.error('模型未返回修正后的 SQL。')
-                                                st.session_state.history.append({'role': 'assistant', 'content': f'[修正失败] {fixed_sql_resp}'})
-                                            else:
-                                                # 持久化修正后的 SQL 列表
-                                                st.session_state['fixed_sql_list'] = fixed_sqls
-                                                # 显示每条 SQL 并提供独立执行按钮
-                                                st.session_state.history.append({'role': 'assistant', 'content': f'[模型修正 SQL 列表] {fixed_sqls}'})
-                                                for idx, ssql in enumerate(fixed_sqls):
-                                                    st.code(ssql, language='sql')
-                                                    safe_fixed = is_safe_select(ssql, allowed)
-                                                    if not safe_fixed:
-                                                        st.error(f'第 {idx+1} 条 SQL 未通过安全校验，已拒绝执行。')
-                                                        st.session_state.history.append({'role': 'assistant', 'content': f'[第 {idx+1} 条 SQL 被拒绝] {ssql}'})
-                                                        continue
-                                                    btn_key = f'exec_fixed_{idx}'
-                                                    if st.button(f'执行第 {idx+1} 条 SQL', key=btn_key):
-                                                        try:
-                                                            st.session_state.history.append({'role': 'assistant', 'content': f'[开始执行 修正后 SQL 第 {idx+1} 条] {ssql}'})
-                                                            eng = create_engine(DEFAULT_DB_URL)
-                                                            df_fixed = pd.read_sql_query(ssql, con=eng)
-                                                            rows = len(df_fixed)
-                                                            cols_fixed = list(df_fixed.columns)
-                                                            st.session_state.history.append({'role': 'assistant', 'content': f'[修正后 SQL 第 {idx+1} 条 执行完成] rows={rows}, cols={cols_fixed}'})
-                                                            # 缓存执行结果
-                                                            st.session_state['last_exec_sql'] = ssql
-                                                            st.session_state['last_exec_df'] = df_fixed.head(200)
-                                                            st.session_state['last_exec_meta'] = {'rows': rows, 'cols': cols_fixed}
-                                                            st.subheader(f'修正后 SQL 第 {idx+1} 条 执行结果（前 200 行）')
-                                                            st.dataframe(st.session_state['last_exec_df'])
-                                                        except Exception as e2:
-                                                            st.error(f'执行修正后的 SQL 第 {idx+1} 条 失败：{e2}')
-                                                            st.session_state.history.append({'role': 'assistant', 'content': f'[修正后执行失败 第 {idx+1} 条] {e2}'})
-                                    else:
-                                        st.info('如果确认该 SQL 安全，请点击上方按钮执行。')
-                    else:
-                        reply = q.predict(conversation)
+                    allowed = _sql_allowlist()
+                    # 判定、追问分析、SQL 生成与校验都走 chat_turn.run_turn（与压测相同的一轮逻辑）；
+                    # SQL 在这里只生成不执行（execute=False），由下方按钮确认后经 execute_sql 执行
+                    res = run_turn(state, user_input, lambda p, label: _predict(q, p, label),
+                                   allowed_tables=allowed, local=_use_local_sql(),
+                                   schema_context=lambda text: _schema_context(text, allowed),
+                                   table_candidates=_table_candidates(), llm=q, execute=False,
+                                   run_sql=lambda fn: run_job('query', lambda ctx: fn(), '追问分析'))
+                    if res.followup is not None:
+                        outcome = res.followup
+                        st.session_state['followup'] = {
+                            'base_sql': state.last_exec_sql, 'question': user_input,
+                            'code': outcome.code, 'error': outcome.error, 'plot': outcome.plot,
+                            'truncated': outcome.truncated,
+                            'result': (ResultPager.from_df(outcome.result) if isinstance(outcome.result, pd.DataFrame)
+                                       else outcome.result),
+                        }
+                    elif res.need_sql and res.generated_sql:
+                        # 持久化生成的 SQL（包括未通过校验的，便于编辑后重试），保证在脚本重跑后仍可执行
+                        st.session_state['generated_sql'] = res.generated_sql
+                        st.session_state['generated_question'] = user_input
+                except JobCancelled:
+                    state.history.append({'role': 'assistant', 'content': '[已取消]'})
                 except Exception as e:
-                    reply = f"[调用错误] {e}"
-
-            # 当不是 SQL-生成/执行流程时，把模型回复加入会话（仅在 reply 非空时）
-            if not (generate_sql and st.session_state.df is not None):
-                if reply:
-                    st.session_state.history.append({'role': 'assistant', 'content': reply})
-                st.rerun()
-
-    # 如果上一次会话已经生成了 SQL（保存在 session），但当前无新的 user_input，
-    # 仍然需要在界面上渲染生成的 SQL 与执行按钮，避免用户在点击执行时按钮闪现消失。
-    if 'generated_sql' in st.session_state and not user_input:
-        generated_sql = st.session_state.get('generated_sql', '')
-        if generated_sql:
-            # 在持久化视图中也提供一个可编辑的 SQL 文本区域（与生成时使用相同的编辑器 key，从而保持同步）
-            st.text_area('生成的 SQL（可编辑）', value=st.session_state.get('generated_sql', generated_sql), height=140, key='generated_sql_editor')
-            st.session_state['generated_sql'] = st.session_state.get('generated_sql_editor', generated_sql)
-            # 简单安全校验函数（与上面逻辑保持一致）
-            def _is_safe_select(sql_text: str, allowed_tables: list = None) -> bool:
-                low = sql_text.lower()
-                if ';' in low:
-                    return False
-                forbidden = ['insert ', 'update ', 'delete ', 'drop ', 'create ', 'alter ', 'truncate ', 'replace ']
-                if any(k in low for k in forbidden):
-                    return False
-                if not low.strip().startswith('select'):
-                    return False
-                if allowed_tables is not None:
-                    found = False
-                    for t in allowed_tables:
-                        if t.lower() in low:
-                            found = True
-                            break
-                    if not found:
-                        return False
-                return True
-
-            # 显示调试信息开关
-            debug_expanded = st.checkbox('显示 SQL 调试信息', value=False, key='debug_sql_info_persist')
-            if debug_expanded:
-                st.write('generated_sql:', generated_sql)
-                st.write('DEFAULT_DB_URL configured:', bool(DEFAULT_DB_URL))
-                # 重新获取 allowed 表
-                allowed = None
-                try:
-                    if DEFAULT_DB_URL:
-                        eng = create_engine(DEFAULT_DB_URL)
-                        allowed = inspect(eng).get_table_names()
-                        if allowed is None:
-                            allowed = []
-                except Exception:
-                    allowed = None
-                st.write('allowed tables:', allowed)
-                try:
-                    st.write('is_safe_select:', _is_safe_select(generated_sql, allowed))
-                except Exception:
-                    st.write('is_safe_select: <error>')
-                st.warning('若你确定 SQL 安全，也可启用下方调试开关强制执行（仅用于调试环境）。')
-                force = st.checkbox('允许调试强制执行生成的 SQL（跳过表白名单）', value=False, key='debug_force_exec_persist')
-
-            # 始终可见的调试执行按钮（与上方按钮行为一致）
-            try:
-                exec_always = st.button('执行生成的 SQL（始终可见，调试）', key='always_exec_button_persist')
-            except Exception:
-                exec_always = False
-            if exec_always:
-                sql_to_execute = generated_sql
-                low = sql_to_execute.lower()
-                if ';' in low:
-                    st.error('检测到不安全的 SQL（包含分号/多语句），已拒绝执行。')
-                else:
-                    forbidden = ['insert ', 'update ', 'delete ', 'drop ', 'create ', 'alter ', 'truncate ', 'replace ']
-                    if any(k in low for k in forbidden):
-                        st.error('检测到写操作或不安全关键词，已拒绝执行。')
-                    else:
-                        if not DEFAULT_DB_URL:
-                            st.error('未配置默认数据库连接，无法执行 SQL。请在 config.py 中配置 DEFAULT_DB_CONFIG。')
-                        else:
-                            try:
-                                st.session_state.history.append({'role': 'assistant', 'content': f'[开始执行 SQL 调试按钮] {sql_to_execute}'})
-                                eng = create_engine(DEFAULT_DB_URL)
-                                df_res = pd.read_sql_query(sql_to_execute, con=eng)
-                                rows = len(df_res)
-                                cols_res = list(df_res.columns)
-                                st.session_state['last_exec_sql'] = sql_to_execute
-                                st.session_state['last_exec_df'] = df_res.head(200)
-                                st.session_state['last_exec_meta'] = {'rows': rows, 'cols': cols_res}
-                                st.session_state.history.append({'role': 'assistant', 'content': f'[SQL 调试执行完成] rows={rows}, cols={cols_res}'})
-                                st.subheader('SQL 执行结果（前 200 行）')
-                                st.dataframe(st.session_state['last_exec_df'])
-                            except Exception as e:
-                                st.error(f'执行 SQL 失败：{e}')
-                                st.session_state.history.append({'role': 'assistant', 'content': f'[调试执行失败] {e}'})
+                    state.history.append({'role': 'assistant', 'content': f'[调用错误] {e}'})
+            _save_chat_state(state)
+            st.rerun()
+
+    # 上一轮生成的 SQL：可编辑，点击按钮后经代价守卫执行，失败时自动修复（见 chat_turn.execute_sql）
+    generated_sql = st.session_state.get('generated_sql', '')
+    if generated_sql and not user_input:
+        sql_to_execute = st.text_area('生成的 SQL（可编辑）', value=generated_sql, height=140,
+                                      key='generated_sql_editor').strip()
+        allowed = _sql_allowlist()
+        force_exec = False
+        if st.checkbox('显示 SQL 调试信息', value=False, key='debug_sql_info'):
+            st.write('generated_sql:', sql_to_execute)
+            st.write('DEFAULT_DB_URL configured:', bool(DEFAULT_DB_URL))
+            st.write('allowed tables:', sorted(allowed) if allowed is not None else None)
+            debug_analysis = check_select(sql_to_execute, allowed)
+            st.write('referenced tables:', sorted(debug_analysis.tables))
+            st.write('is_safe_select:', debug_analysis.ok, debug_analysis.errors)
+            st.warning('若你确定 SQL 安全，也可启用下方调试开关强制执行（仅用于调试环境）。')
+            # 强制执行只跳过表白名单，仍须是只读单条 SELECT
+            force_exec = st.checkbox('允许调试强制执行生成的 SQL（跳过表白名单）', value=False, key='debug_force_exec')
+        analysis = check_select(sql_to_execute, allowed)
+        if not analysis.ok and not (force_exec and analyze_sql(sql_to_execute).ok):
+            st.error('SQL 未通过安全校验，已拒绝执行：' + '；'.join(analysis.errors))
+        elif not _sql_backend_ready():
+            st.error('未配置默认数据库连接，无法执行 SQL。请在 config.py 中配置 DEFAULT_DB_CONFIG。')
+        elif st.button('执行生成的 SQL'):
+            _execute_generated_sql(sql_to_execute, allowed)
+        else:
+            st.info('如果确认该 SQL 安全，请点击上方按钮执行。')
 
 # 底部固定表单将被渲染在主流程开始处以确保按下发送能立即触发处理（见上方插入点）。
 
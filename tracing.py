@@ -0,0 +1,239 @@
+# tracing.py
+"""轻量的耗时追踪与指标导出。
+
+- `span(stage, **attrs)`：记录一个阶段的耗时，自动维护父子关系，
+  并把结构化 JSON 记录交给后台写入器（见 log_writer.py）。
+- 计数器与直方图可按 Prometheus 文本格式导出（`render_prometheus`），
+  设置环境变量 ANALYTIBOT_METRICS_PORT 后会启动一个 /metrics HTTP 端点。
+"""
+
+import bisect
+import contextvars
+import functools
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, Optional, Tuple
+
+from log_writer import get_writer
+
+logger = logging.getLogger(__name__)
+
+TRACE_LOG = os.getenv("ANALYTIBOT_TRACE_LOG", "traces.log")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _label_key(labels: dict) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((str(k), str(v)) for k, v in labels.items()))
+
+
+def _fmt_labels(key: Iterable[Tuple[str, str]], extra: Optional[dict] = None) -> str:
+    items = list(key) + (list(extra.items()) if extra else [])
+    if not items:
+        return ""
+    body = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in items)
+    return "{" + body + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1.0, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + value
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, v in sorted(self._values.items()):
+                lines.append(f"{self.name}{_fmt_labels(key)} {v}")
+        return "\n".join(lines)
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        # key -> [每个桶的计数..., sum, count]
+        self._values: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = [0] * len(self.buckets) + [0.0, 0]
+                self._values[key] = row
+            if idx < len(self.buckets):
+                row[idx] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, row in sorted(self._values.items()):
+                cumulative = 0
+                for b, c in zip(self.buckets, row):
+                    cumulative += c
+                    lines.append(f"{self.name}_bucket{_fmt_labels(key, {'le': b})} {cumulative}")
+                lines.append(f"{self.name}_bucket{_fmt_labels(key, {'le': '+Inf'})} {row[-1]}")
+                lines.append(f"{self.name}_sum{_fmt_labels(key)} {row[-2]}")
+                lines.append(f"{self.name}_count{_fmt_labels(key)} {row[-1]}")
+        return "\n".join(lines)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        with self._lock:
+            m = self._metrics.get(name)
+            if m is None:
+                m = Counter(name, help_text)
+                self._metrics[name] = m
+            return m  # type: ignore[return-value]
+
+    def histogram(self, name: str, help_text: str, buckets=DEFAULT_BUCKETS) -> Histogram:
+        with self._lock:
+            m = self._metrics.get(name)
+            if m is None:
+                m = Histogram(name, help_text, buckets)
+                self._metrics[name] = m
+            return m  # type: ignore[return-value]
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(m.render() for m in metrics) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+STAGE_SECONDS = REGISTRY.histogram("analytibot_stage_seconds", "各处理阶段耗时（秒）")
+STAGE_TOTAL = REGISTRY.counter("analytibot_stage_total", "各处理阶段调用次数（按结果状态）")
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar("analytibot_span", default=None)
+
+
+@contextmanager
+def span(stage: str, **attrs):
+    """记录一个阶段的耗时。
+
+    使用示例：
+        with span("sql_execute", source="button") as sp:
+            ...
+            sp["rows"] = len(df)
+
+    yield 出的 dict 可在块内追加属性，会一并写入 JSON 日志；
+    指标只使用 stage 与 status 两个标签，避免高基数。
+    """
+    parent = _current_span.get()
+    span_id = uuid.uuid4().hex[:16]
+    trace_id = parent["trace_id"] if parent else uuid.uuid4().hex
+    info = {"trace_id": trace_id, "span_id": span_id}
+    token = _current_span.set(info)
+    status = "ok"
+    start = time.perf_counter()
+    try:
+        yield attrs
+    except BaseException as e:
+        status = "error"
+        attrs.setdefault("error", repr(e))
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        _current_span.reset(token)
+        status = attrs.pop("status", status)
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        STAGE_TOTAL.inc(stage=stage, status=status)
+        record = {
+            "type": "span",
+            "stage": stage,
+            "trace_id": trace_id,
+            "span_id": span_id,
+            "parent_id": parent["span_id"] if parent else None,
+            "duration_ms": round(elapsed * 1000, 3),
+            "status": status,
+        }
+        record.update(attrs)
+        get_writer(TRACE_LOG).write_json(record)
+
+
+def traced(stage: str):
+    """装饰器版本的 span，用于整函数计时。"""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+
+def render_prometheus() -> str:
+    """返回 Prometheus 文本格式的全部指标。"""
+    return REGISTRY.render()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # noqa: A002 - 覆盖基类签名
+        return
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port: Optional[int] = None, host: str = "0.0.0.0"):
+    """启动 /metrics 端点（幂等；Streamlit 重跑脚本时不会重复启动）。
+
+    未传入 port 时读取环境变量 ANALYTIBOT_METRICS_PORT，未设置则不启动。
+    """
+    global _server
+    if port is None:
+        env_port = os.getenv("ANALYTIBOT_METRICS_PORT")
+        if not env_port:
+            return None
+        try:
+            port = int(env_port)
+        except ValueError:
+            logger.warning("ANALYTIBOT_METRICS_PORT 不是合法端口：%s", env_port)
+            return None
+    with _server_lock:
+        if _server is not None:
+            return _server
+        try:
+            _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        except OSError as e:
+            # 多进程部署时端口可能已被同机其它 worker 占用
+            logger.warning("无法启动指标端点 %s:%s：%s", host, port, e)
+            return None
+        threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+        return _server
@@ -0,0 +1,135 @@
+# upload_loader.py
+"""上传文件的统一加载：CSV（可 gzip / zstd 压缩）、Parquet、Feather / Arrow IPC。
+
+- 格式按文件头的魔数识别，识别不了时看扩展名，默认当作 CSV；
+- 压缩 CSV 流式解压后交给 csv_loader.load_csv（同样的编码识别与修复）：
+  gzip 直接用可回绕的 GzipFile；zstd 解压流不能回绕，按块解压到磁盘临时文件再解析；
+- Parquet / Feather 由 pyarrow 直接读取，to_pandas(split_blocks, self_destruct) 边转换边释放 Arrow 缓冲，
+  峰值内存约为一份 DataFrame；
+- 上传对象只按块顺序读取（计算内容哈希、解压、解析），不调用 getvalue()，
+  不会在解析期间额外复制一份完整的原始字节。
+
+zstandard 为可选依赖，未安装时上传 .zst 会给出明确提示。
+"""
+
+import gzip
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+import pandas as pd
+
+from csv_loader import CsvRepairPlan, load_csv
+
+try:
+    import pyarrow.feather as feather  # type: ignore
+    import pyarrow.parquet as pq  # type: ignore
+except Exception:  # 可选依赖：未安装时不支持列式格式
+    feather = None
+    pq = None
+
+try:
+    import zstandard  # type: ignore
+except Exception:  # 可选依赖：未安装时不支持 zstd 压缩的 CSV
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+CHUNK_BYTES = 1024 * 1024
+
+# st.file_uploader 接受的扩展名（.csv.gz / .csv.zst 按最后一段扩展名匹配）
+UPLOAD_TYPES = ["csv", "gz", "zst", "parquet", "feather", "arrow"]
+
+CSV, CSV_GZIP, CSV_ZSTD, PARQUET, FEATHER = "csv", "csv+gzip", "csv+zstd", "parquet", "feather"
+FORMAT_TEXT = {CSV: "CSV", CSV_GZIP: "gzip 压缩 CSV", CSV_ZSTD: "zstd 压缩 CSV",
+               PARQUET: "Parquet", FEATHER: "Feather/Arrow"}
+
+_MAGIC = [
+    (b"\x1f\x8b", CSV_GZIP),
+    (b"\x28\xb5\x2f\xfd", CSV_ZSTD),
+    (b"PAR1", PARQUET),
+    (b"ARROW1", FEATHER),
+    (b"FEA1", FEATHER),   # Feather V1
+]
+_EXTENSIONS = {".gz": CSV_GZIP, ".gzip": CSV_GZIP, ".zst": CSV_ZSTD, ".zstd": CSV_ZSTD,
+               ".parquet": PARQUET, ".pq": PARQUET, ".feather": FEATHER, ".arrow": FEATHER, ".ipc": FEATHER}
+
+
+@dataclass
+class UploadPlan:
+    """加载方式与 CSV 修复方案（列式格式没有 CSV 修复）。"""
+    format: str = CSV
+    csv: Optional[CsvRepairPlan] = None
+    notes: List[str] = field(default_factory=list)
+
+    @property
+    def encoding(self) -> str:
+        return self.csv.encoding if self.csv is not None else "binary"
+
+    @property
+    def repairs(self) -> List[str]:
+        """CSV 修复项（编码、整行引号、千分位……）。"""
+        return list(self.csv.notes) if self.csv is not None else []
+
+    def describe(self) -> str:
+        parts = [FORMAT_TEXT.get(self.format, self.format)] + self.notes
+        if self.csv is not None and self.csv.notes:
+            parts.append(self.csv.describe())
+        return "；".join(parts)
+
+
+def stream_key(fh) -> str:
+    """按块计算内容哈希（与 datastore.content_key 相同的格式），计算后回到开头。"""
+    h = hashlib.sha256()
+    fh.seek(0)
+    for chunk in iter(lambda: fh.read(CHUNK_BYTES), b""):
+        h.update(chunk)
+    fh.seek(0)
+    return "sha256:" + h.hexdigest()
+
+
+def detect_format(fh, name: str = "") -> str:
+    head = fh.read(8)
+    fh.seek(0)
+    for magic, fmt in _MAGIC:
+        if head.startswith(magic):
+            return fmt
+    return _EXTENSIONS.get(os.path.splitext(name or "")[1].lower(), CSV)
+
+
+def _arrow_to_pandas(table) -> pd.DataFrame:
+    # self_destruct：每转换完一列就释放对应的 Arrow 缓冲，避免两份数据同时在内存中
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def load_upload(fh, name: str = "") -> Tuple[pd.DataFrame, UploadPlan]:
+    """从可回绕的二进制文件对象（如 Streamlit 的 UploadedFile）加载数据，返回 (DataFrame, 加载方式)。"""
+    fmt = detect_format(fh, name)
+    plan = UploadPlan(format=fmt)
+    if fmt in (PARQUET, FEATHER):
+        if pq is None:
+            raise RuntimeError(f"未安装 pyarrow，无法读取 {FORMAT_TEXT[fmt]} 文件（pip install pyarrow）")
+        table = pq.read_table(fh) if fmt == PARQUET else feather.read_table(fh)
+        plan.notes.append(f"{table.num_columns} 列")
+        return _arrow_to_pandas(table), plan
+    if fmt == CSV_GZIP:
+        with gzip.GzipFile(fileobj=fh, mode="rb") as stream:
+            df, plan.csv = load_csv(stream)
+        return df, plan
+    if fmt == CSV_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("未安装 zstandard，无法解压 .zst 文件（pip install zstandard）")
+        # zstd 解压流不能回绕（编码识别失败时需要从头重读），先按块解压到磁盘临时文件
+        with tempfile.TemporaryFile() as spool:
+            with zstandard.ZstdDecompressor().stream_reader(fh, closefd=False) as stream:
+                shutil.copyfileobj(stream, spool, CHUNK_BYTES)
+            spool.seek(0)
+            df, plan.csv = load_csv(spool)
+        return df, plan
+    df, plan.csv = load_csv(fh)
+    return df, plan
+
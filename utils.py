@@ -3,6 +3,8 @@
 import os
 import matplotlib.pyplot as plt
 
+from result_view import print_result
+
 def clear_previous_plot(plot_file):
     """删除旧图表"""
     if os.path.exists(plot_file):
@@ -15,10 +17,8 @@ def display_result(result, has_plot=False, plot_file="output_plot.png"):
     if isinstance(result, dict):
         for k, v in result.items():
             print(f"{k}: {v}")
-    elif hasattr(result, "to_string"):
-        print(result.to_string(index=False))
     else:
-        print(result)
+        print_result(result)
     
     if has_plot and os.path.exists(plot_file):
         print(f"\n🖼️  图表已生成 → {plot_file}")